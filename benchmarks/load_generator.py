@@ -0,0 +1,252 @@
+"""
+WebSocket load generator for the chat app.
+
+Creates rooms through POST /room/{mode}, then drives many concurrent conversations
+over the room WebSockets and reports throughput and p50/p95/p99 TTFT and latency as JSON.
+When the app runs with LOOP_MONITOR=true the report includes its event loop lag during the run.
+
+    python -m benchmarks.load_generator --mode cm --users 50 --turns 5 --output results.json
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import statistics
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List
+import httpx
+
+try:
+    import websockets
+except ImportError:  # pragma: no cover - reported when the generator is started
+    websockets = None
+
+
+@dataclass
+class TurnResult:
+    ttft_ms: float | None
+    latency_ms: float
+    error: bool
+
+
+@dataclass
+class LoadResults:
+    turns: List[TurnResult] = field(default_factory=list)
+    failed_users: int = 0
+
+
+def percentile(values: List[float], pct: float) -> float | None:
+    """Linear interpolation between closest ranks"""
+
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    low, high = math.floor(rank), math.ceil(rank)
+    if low == high:
+        return ordered[low]
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(values: List[float]) -> dict:
+    return {
+        "count": len(values),
+        "mean": statistics.fmean(values) if values else None,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+
+def histogram_series(metrics_text: str, name: str) -> Dict[str, float]:
+    """Bucket counts by upper bound, plus "sum" and "count", of an unlabelled histogram"""
+
+    series = {}
+    for line in metrics_text.splitlines():
+        if line.startswith(f'{name}_bucket{{le="'):
+            bound = line[len(name) + len('_bucket{le="'):line.index('"}')]
+            series[bound] = float(line.rsplit(" ", 1)[1])
+        elif line.startswith((f"{name}_sum ", f"{name}_count ")):
+            key, value = line.split(" ")
+            series[key[len(name) + 1:]] = float(value)
+
+    return series
+
+
+async def scrape_metrics(client: httpx.AsyncClient, base_url: str) -> str:
+    try:
+        response = await client.get(f"{base_url}/metrics")
+        return response.text if response.status_code == 200 else ""
+    except httpx.HTTPError:
+        return ""
+
+
+def event_loop_report(before: str, after: str) -> dict | None:
+    """Server event loop lag during the run, from two scrapes of its /metrics"""
+
+    lag_before = histogram_series(before, "event_loop_lag_seconds")
+    lag = histogram_series(after, "event_loop_lag_seconds")
+    if not lag:
+        return None
+
+    diff = {key: value - lag_before.get(key, 0.0) for key, value in lag.items()}
+    count = diff.pop("count", 0.0)
+    total = diff.pop("sum", 0.0)
+    if not count:
+        return None
+
+    # Upper bound of the bucket the 99th percentile falls in
+    p99 = None
+    for bound, cumulative in diff.items():
+        if cumulative >= 0.99 * count:
+            p99 = float(bound)
+            break
+
+    blocked_before = histogram_series(before, "event_loop_blocked_seconds")
+    blocked = histogram_series(after, "event_loop_blocked_seconds")
+
+    return {
+        "lag_mean_ms": total / count * 1000,
+        "lag_p99_ms_at_most": p99 * 1000 if p99 is not None else None,
+        "blocked": blocked.get("count", 0.0) - blocked_before.get("count", 0.0),
+        "blocked_ms": (blocked.get("sum", 0.0) - blocked_before.get("sum", 0.0)) * 1000,
+    }
+
+
+# Frames sent instead of a reply, the turn was not run
+REJECTED_FRAME_TYPES = ("rate_limited", "error")
+
+
+def is_rejected(frame: dict) -> bool:
+    return frame.get("type") in REJECTED_FRAME_TYPES
+
+
+def is_turn_done(mode: str, frame: dict) -> bool:
+    if mode == "cm":
+        # A rejected comparison turn gets a single frame for both conversations
+        return frame.get("type") == "comparison" or (
+            is_rejected(frame) and "conversation_id" not in frame
+        )
+    return frame.get("type") != "delta"
+
+
+def ws_url(base_url: str, mode: str, room: dict) -> str:
+    base = base_url.replace("https://", "wss://").replace("http://", "ws://")
+    if mode == "cm":
+        return f"{base}/room/ws/cm/{room['id']}"
+    return f"{base}/room/ws/sm/{room['id']}/{room['conversations'][0]['id']}"
+
+
+async def create_room(client: httpx.AsyncClient, args) -> dict | None:
+    try:
+        response = await client.post(f"{args.base_url}/room/{args.mode}")
+        response.raise_for_status()
+        return response.json()
+    except httpx.HTTPError as e:
+        print(f"Could not create room: {e}")
+        return None
+
+
+async def run_conversation(room: dict, args, results: LoadResults):
+    try:
+        async with websockets.connect(ws_url(args.base_url, args.mode, room)) as socket:
+            for turn in range(args.turns):
+                start = time.perf_counter()
+                first_frame = None
+                error = False
+
+                await socket.send(f"{args.prompt} (turn {turn})")
+
+                while True:
+                    frame = json.loads(
+                        await asyncio.wait_for(socket.recv(), timeout=args.turn_timeout)
+                    )
+                    if first_frame is None:
+                        first_frame = time.perf_counter()
+                    error = error or bool(frame.get("error")) or is_rejected(frame)
+                    if is_turn_done(args.mode, frame):
+                        break
+
+                end = time.perf_counter()
+                results.turns.append(
+                    TurnResult(
+                        ttft_ms=(first_frame - start) * 1000 if first_frame else None,
+                        latency_ms=(end - start) * 1000,
+                        error=error,
+                    )
+                )
+    except Exception as e:
+        print(f"User failed: {type(e).__name__}: {e}")
+        results.failed_users += 1
+
+
+async def run(args) -> dict:
+    results = LoadResults()
+    limits = httpx.Limits(max_connections=args.users)
+
+    async with httpx.AsyncClient(limits=limits, timeout=args.turn_timeout) as client:
+        # Rooms are created up front so room creation does not skew turn latency
+        rooms = await asyncio.gather(*(create_room(client, args) for _ in range(args.users)))
+        metrics_before = await scrape_metrics(client, args.base_url)
+
+    results.failed_users = sum(room is None for room in rooms)
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(run_conversation(room, args, results) for room in rooms if room is not None)
+    )
+    duration = time.perf_counter() - start
+
+    async with httpx.AsyncClient(timeout=args.turn_timeout) as client:
+        metrics_after = await scrape_metrics(client, args.base_url)
+
+    ok_turns = [turn for turn in results.turns if not turn.error]
+
+    return {
+        "config": {
+            "base_url": args.base_url,
+            "mode": args.mode,
+            "users": args.users,
+            "turns_per_user": args.turns,
+        },
+        "duration_sec": duration,
+        "turns": len(results.turns),
+        "errors": len(results.turns) - len(ok_turns),
+        "failed_users": results.failed_users,
+        "throughput_turns_per_sec": len(ok_turns) / duration if duration > 0 else None,
+        "ttft_ms": summarize([t.ttft_ms for t in ok_turns if t.ttft_ms is not None]),
+        "latency_ms": summarize([t.latency_ms for t in ok_turns]),
+        "server_event_loop": event_loop_report(metrics_before, metrics_after),
+        "raw": [asdict(turn) for turn in results.turns] if args.raw else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--base-url", default="http://localhost:8002")
+    parser.add_argument("--mode", choices=("sm", "cm"), default="cm")
+    parser.add_argument("--users", type=int, default=10, help="concurrent conversations")
+    parser.add_argument("--turns", type=int, default=3, help="turns per conversation")
+    parser.add_argument("--prompt", default="Explain how a transformer decoder works.")
+    parser.add_argument("--turn-timeout", type=float, default=120.0)
+    parser.add_argument("--output", default="-", help="JSON report path, '-' for stdout")
+    parser.add_argument("--raw", action="store_true", help="include every turn in the report")
+    args = parser.parse_args()
+
+    if websockets is None:
+        parser.error("the 'websockets' package is required: pip install websockets")
+
+    report = asyncio.run(run(args))
+    output = json.dumps(report, indent=2)
+
+    if args.output == "-":
+        print(output)
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+OpenAI-compatible stand-in for a vLLM server, for benchmarking the app on CPU.
+
+Serves /v1/chat/completions with configurable prefill delay, decode rate, jitter and
+error injection, in both streaming (SSE) and non-streaming mode.
+
+    python -m benchmarks.mock_vllm_server --port 8000 --prefill-ms 150 --tokens-per-sec 40
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from dataclasses import dataclass
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+@dataclass
+class MockSettings:
+    model: str = "mock-model"
+    prefill_ms: float = 100.0
+    tokens_per_sec: float = 50.0
+    jitter_ms: float = 0.0
+    output_tokens: int = 64
+    error_rate: float = 0.0
+    seed: int | None = None
+
+
+WORDS = ("lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit")
+
+
+def create_app(settings: MockSettings) -> FastAPI:
+    app = FastAPI()
+    rng = random.Random(settings.seed)
+
+    def jitter() -> float:
+        if settings.jitter_ms <= 0:
+            return 0.0
+        return max(0.0, rng.gauss(0.0, settings.jitter_ms / 1000))
+
+    def token_delay() -> float:
+        base = 1 / settings.tokens_per_sec if settings.tokens_per_sec > 0 else 0.0
+        return base + jitter() / 4
+
+    def prompt_tokens(messages) -> int:
+        return sum(len(str(message.get("content", ""))) // 4 + 4 for message in messages)
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        messages = body.get("messages") or []
+        max_tokens = body.get("max_tokens") or settings.output_tokens
+        n_tokens = max(1, min(settings.output_tokens, max_tokens))
+        n_prompt = prompt_tokens(messages)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        if rng.random() < settings.error_rate:
+            return JSONResponse(
+                {"error": {"message": "injected error", "type": "server_error"}},
+                status_code=500,
+            )
+
+        await asyncio.sleep(settings.prefill_ms / 1000 + jitter())
+
+        usage = {
+            "prompt_tokens": n_prompt,
+            "completion_tokens": n_tokens,
+            "total_tokens": n_prompt + n_tokens,
+        }
+
+        if not body.get("stream"):
+            await asyncio.sleep(sum(token_delay() for _ in range(n_tokens - 1)))
+            text = " ".join(WORDS[i % len(WORDS)] for i in range(n_tokens))
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": settings.model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": text},
+                        "finish_reason": "length",
+                    }
+                ],
+                "usage": usage,
+            }
+
+        include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+
+        def chunk(delta: dict, finish_reason=None, chunk_usage=None) -> str:
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": settings.model,
+                "choices": (
+                    [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+                    if delta is not None
+                    else []
+                ),
+            }
+            if chunk_usage is not None:
+                payload["usage"] = chunk_usage
+            return f"data: {json.dumps(payload)}\n\n"
+
+        async def events():
+            yield chunk({"role": "assistant", "content": ""})
+            for i in range(n_tokens):
+                if i:
+                    await asyncio.sleep(token_delay())
+                word = WORDS[i % len(WORDS)]
+                yield chunk({"content": word if i == 0 else f" {word}"})
+            yield chunk({}, finish_reason="length")
+            if include_usage:
+                yield chunk(None, chunk_usage=usage)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.get("/health")
+    async def health():
+        return {"status": "ok"}
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--model", default=MockSettings.model)
+    parser.add_argument("--prefill-ms", type=float, default=MockSettings.prefill_ms)
+    parser.add_argument("--tokens-per-sec", type=float, default=MockSettings.tokens_per_sec)
+    parser.add_argument("--jitter-ms", type=float, default=MockSettings.jitter_ms)
+    parser.add_argument("--output-tokens", type=int, default=MockSettings.output_tokens)
+    parser.add_argument("--error-rate", type=float, default=MockSettings.error_rate)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    import uvicorn  # pylint: disable=import-outside-toplevel
+
+    settings = MockSettings(
+        model=args.model,
+        prefill_ms=args.prefill_ms,
+        tokens_per_sec=args.tokens_per_sec,
+        jitter_ms=args.jitter_ms,
+        output_tokens=args.output_tokens,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
+    uvicorn.run(create_app(settings), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
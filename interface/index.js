@@ -6,22 +6,149 @@ const inputWrapper = document.querySelector(".input-wrapper");
 const chatContainer = document.querySelector(".chat");
 
 let socketConnections = [];
+// Assistant message elements that are still receiving delta frames, by conversation id
+let streamingMessages = {};
+
+const RECONNECT_MIN_DELAY_MS = 500;
+const RECONNECT_MAX_DELAY_MS = 10000;
+const RECONNECT_MAX_ATTEMPTS = 10;
+
+// Closes that a reconnect cannot fix: policy violations, server errors such as an
+// unknown or expired room, and application close codes
+const isFinalClose = (code) =>
+  code === 1008 || code === 1011 || (code >= 4000 && code <= 4999);
+
+let connectionLostShown = false;
+
+const showConnectionLost = (code) => {
+  if (connectionLostShown) {
+    return;
+  }
+  connectionLostShown = true;
+  const reason = isFinalClose(code)
+    ? "the room was not found or the server failed"
+    : "the server is unreachable";
+  appendMessageToAllChats(
+    `Connection lost, ${reason}. Create a new room to go on.`,
+    "assistant"
+  );
+};
+
+// Opens the socket of a connection and reopens it when it drops. The reconnect sends
+// the sequence number of the last frame received, the server replays the frames missed
+// in between and carries on with the reply that was being generated. It gives up after
+// RECONNECT_MAX_ATTEMPTS failed attempts or a close that a reconnect cannot fix.
+const openSocket = (connection, url, onMessage) => {
+  const query = connection.lastSeq === null ? "" : `?last_seq=${connection.lastSeq}`;
+  const socket = new WebSocket(url + query);
+  connection.socket = socket;
+
+  socket.addEventListener("open", () => {
+    console.log(`Connected to WebSocket server for ${connection.model}`);
+    connection.reconnectDelay = RECONNECT_MIN_DELAY_MS;
+    connection.reconnectAttempts = 0;
+  });
+
+  socket.addEventListener("message", (event) => {
+    const message = JSON.parse(event.data);
+    console.log("Message from server:", message);
+
+    if (message.seq !== undefined) {
+      connection.lastSeq = message.seq;
+    }
+    if (message.type === "resume_unavailable") {
+      console.warn("Frames missed while disconnected are no longer available");
+      return;
+    }
+
+    onMessage(message);
+  });
+
+  socket.addEventListener("close", (event) => {
+    if (
+      isFinalClose(event.code) ||
+      connection.reconnectAttempts >= RECONNECT_MAX_ATTEMPTS
+    ) {
+      console.error(
+        `Connection for ${connection.model} closed with code ${event.code}, giving up`
+      );
+      showConnectionLost(event.code);
+      return;
+    }
+
+    console.log(`Connection for ${connection.model} closed, reconnecting`);
+    connection.reconnectAttempts += 1;
+    setTimeout(() => openSocket(connection, url, onMessage), connection.reconnectDelay);
+    connection.reconnectDelay = Math.min(
+      connection.reconnectDelay * 2,
+      RECONNECT_MAX_DELAY_MS
+    );
+  });
+};
+
+const createConnection = (model, url, onMessage) => {
+  const connection = {
+    model,
+    socket: null,
+    lastSeq: null,
+    reconnectDelay: RECONNECT_MIN_DELAY_MS,
+    reconnectAttempts: 0,
+  };
+
+  openSocket(connection, url, onMessage);
+  socketConnections.push(connection);
+};
+
+const establishComparisonConnection = (active_room) => {
+  const url = `ws://localhost:8002/room/ws/cm/${active_room.id}`;
+
+  createConnection("comparison", url, (message) => {
+    if (message.type === "comparison") {
+      return;
+    }
+
+    if (message.type === "rate_limited") {
+      active_room.conversations.forEach((conv) => {
+        appendMessageToCmChat(conv.id, message.response, "assistant");
+      });
+      return;
+    }
+
+    if (message.type === "delta") {
+      appendDeltaToChat("cm", message.conversation_id, message.delta);
+      return;
+    }
+
+    if (streamingMessages[message.conversation_id]) {
+      finishStreamingMessage(message.conversation_id, message.response);
+      return;
+    }
+
+    appendMessageToCmChat(message.conversation_id, message.response, "assistant");
+  });
+};
 
 const establishConnection = (mode) => {
   active_room = JSON.parse(localStorage.getItem("active_room"));
 
+  if (mode === "cm") {
+    establishComparisonConnection(active_room);
+    return;
+  }
+
   active_room.conversations.forEach((conv) => {
-    newSocket = new WebSocket(
-      `ws://localhost:8002/room/ws/${mode}/${active_room.id}/${conv.id}`
-    );
+    const url = `ws://localhost:8002/room/ws/${mode}/${active_room.id}/${conv.id}`;
 
-    newSocket.addEventListener("open", () => {
-      console.log(`Connected to WebSocket server for ${conv.model}`);
-    });
+    createConnection(conv.model, url, (message) => {
+      if (message.type === "delta") {
+        appendDeltaToChat(mode, conv.id, message.delta);
+        return;
+      }
 
-    newSocket.addEventListener("message", (event) => {
-      const message = JSON.parse(event.data);
-      console.log("Message from server:", message);
+      if (message.type === "done" && streamingMessages[conv.id]) {
+        finishStreamingMessage(conv.id, message.response);
+        return;
+      }
 
       if (mode === "sm") {
         appendMessageToSmChat(message.response, "assistant");
@@ -29,11 +156,6 @@ const establishConnection = (mode) => {
         appendMessageToCmChat(conv.id, message.response, "assistant");
       }
     });
-
-    socketConnections.push({
-      model: conv.model,
-      socket: newSocket,
-    });
   });
 };
 
@@ -69,6 +191,37 @@ const appendMessageToSmChat = (message, role) => {
   messageWrapper.appendChild(messageItem);
 };
 
+const appendDeltaToChat = (mode, conversation_id, delta) => {
+  let streaming = streamingMessages[conversation_id];
+
+  if (!streaming) {
+    const messageItem = createMessageItem("", "assistant");
+
+    if (mode === "sm") {
+      document.querySelector(".sm-conv").appendChild(messageItem);
+    } else {
+      document.querySelectorAll(".cm-conv").forEach((container) => {
+        if (container.className.includes(conversation_id)) {
+          container.appendChild(messageItem);
+        }
+      });
+    }
+
+    streaming = { element: messageItem, text: "" };
+    streamingMessages[conversation_id] = streaming;
+  }
+
+  streaming.text += delta;
+  streaming.element.textContent = streaming.text;
+};
+
+const finishStreamingMessage = (conversation_id, message) => {
+  const streaming = streamingMessages[conversation_id];
+
+  streaming.element.innerHTML = marked.parse(message);
+  delete streamingMessages[conversation_id];
+};
+
 const appendMessageToAllChats = (message, role) => {
   const convContainers = document.querySelectorAll(".conv");
 
@@ -81,8 +234,12 @@ const appendMessageToAllChats = (message, role) => {
 const sendMessage = () => {
   const message = messageInput.value;
 
-  if (socketConnections.length && message) {
-    socketConnections.forEach((socket) => socket.socket.send(message));
+  const connected = socketConnections.every(
+    (connection) => connection.socket.readyState === WebSocket.OPEN
+  );
+
+  if (socketConnections.length && connected && message) {
+    socketConnections.forEach((connection) => connection.socket.send(message));
     messageInput.value = "";
     console.log("Sent to server: ", message);
 
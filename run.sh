@@ -3,6 +3,8 @@
 VENV_DIR=".venv"
 HOST="0.0.0.0"
 PORT="8002"
+# More than one worker shares rooms through SQLite, see "Multiple workers" in README.md
+WORKERS="${WORKERS:-1}"
 
 # Ray setup for distributed model serving
 RAY_PORT="6379"
@@ -40,7 +42,17 @@ fi
 
 # Starting main application
 echo "Starting FastAPI application"
-uvicorn main:app --host $HOST --port $PORT --reload &
+if [ "$WORKERS" -gt 1 ]; then
+    export SHARED_STATE=true
+    # Every worker would load its own single mode engine on the same GPU
+    export SM_ENABLED="${SM_ENABLED:-false}"
+    if [[ "${SM_ENABLED,,}" =~ ^(1|true|yes|on)$ ]]; then
+        echo "Warning: SM_ENABLED=true loads a single mode engine in each of the $WORKERS workers"
+    fi
+    uvicorn src.main:app --host $HOST --port $PORT --workers $WORKERS &
+else
+    uvicorn src.main:app --host $HOST --port $PORT --reload &
+fi
 MAIN_PID=$!
 echo "FastAPI application started with PID: $MAIN_PID"
 
@@ -0,0 +1,402 @@
+"""
+Offline batch comparison runner.
+
+Runs every prompt or conversation of a JSONL file against the models of the app and
+appends one result line per item and target to an output JSONL as soon as it finishes.
+Re-running the same command resumes: items already in the output are skipped, items
+that failed are run again.
+
+    python -m src.batch_runner --input prompts.jsonl --output results.jsonl
+
+Input lines are objects with a "prompt" string or a "messages" list, an optional "id"
+(the line number otherwise) and optional generation "settings", e.g.
+
+    {"id": "q1", "prompt": "What is KV caching?", "settings": {"temperature": 0}}
+
+Targets:
+    model1, model2 - MODEL1 / MODEL2 over their HTTP endpoints, as in comparison mode
+    sm - the in-process vLLM engine of single mode, items are batched into llm.chat calls
+    sm:<model> - the in-process engine of another model of SM_MODELS
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Set, Tuple
+from pydantic import ValidationError
+from src.app_logging import setup_logging
+from src.config import config
+from src.room.context import context_manager
+from src.room.models import ChatMode, Conversation, GenerationSettings, Message, Role
+from src.room.room_service import RoomService
+from src.services import json_codec
+from src.services.circuit_breaker import ModelUnavailableError
+from src.services.endpoint_pool import endpoint_pools
+from src.services.http_client import http_clients
+from src.services.vllm_service import SM_MODEL, VLLMService, engine_registry
+
+logger = logging.getLogger(__name__)
+
+TARGETS = ("model1", "model2", "sm")
+
+
+def is_local(target: str) -> bool:
+    return target == "sm" or target.startswith("sm:")
+
+
+@dataclass
+class BatchItem:
+    id: str
+    messages: List[Message]
+    settings: GenerationSettings | None = None
+
+
+def parse_item(line_number: int, line: str) -> BatchItem:
+    """
+    Raises:
+        ValueError: if the line is not a valid item
+    """
+    data = json_codec.loads(line)
+    if not isinstance(data, dict):
+        raise ValueError("item must be a JSON object")
+
+    if isinstance(data.get("prompt"), str):
+        messages = [Message(Role.USER.value, data["prompt"])]
+    elif isinstance(data.get("messages"), list) and data["messages"]:
+        messages = [
+            Message(message["role"], message["content"]) for message in data["messages"]
+        ]
+    else:
+        raise ValueError("item needs a 'prompt' string or a non-empty 'messages' list")
+
+    settings = data.get("settings")
+
+    return BatchItem(
+        id=str(data.get("id", line_number)),
+        messages=messages,
+        settings=GenerationSettings.model_validate(settings) if settings else None,
+    )
+
+
+def read_items(path: str) -> List[BatchItem]:
+    items = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                items.append(parse_item(line_number, line))
+            except (ValueError, KeyError, TypeError, ValidationError) as e:
+                logger.warning("Skipping input line %d: %s", line_number, e)
+
+    return items
+
+
+def completed_results(path: str) -> Set[Tuple[str, str]]:
+    """
+    (item id, target) pairs already answered in the output. Error lines do not count, so
+    failed items are retried and get another line. A line cut short by an interrupted
+    run is dropped so that appending continues on a fresh line.
+    """
+    if not os.path.exists(path):
+        return set()
+
+    with open(path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+            data = data[: data.rfind(b"\n") + 1]
+
+    done = set()
+    for line in data.splitlines():
+        try:
+            result = json_codec.loads(line)
+            if not result["error"]:
+                done.add((result["id"], result["target"]))
+        except (ValueError, KeyError, TypeError):
+            continue
+
+    return done
+
+
+class ResultWriter:
+    """Appends results to the output JSONL, flushed per line so progress survives a crash"""
+
+    def __init__(self, path: str):
+        self._file = open(path, "ab")  # pylint: disable=consider-using-with
+        self.written = 0
+        self.errors = 0
+
+    def write(self, result: dict):
+        self._file.write(json_codec.dumps(result) + b"\n")
+        self._file.flush()
+        self.written += 1
+        self.errors += bool(result["error"])
+        if self.written % 100 == 0:
+            logger.info("%d results written, %d errors", self.written, self.errors)
+
+    def close(self):
+        self._file.close()
+
+
+class BatchRunner:
+    """
+    Runs items against one target with bounded parallelism: `concurrency` requests
+    in flight per HTTP target, llm.chat batches of up to `concurrency` items in-process.
+    An item waits up to `unavailable_wait_sec` for an unavailable model, then fails.
+    """
+
+    def __init__(self, writer: ResultWriter, concurrency: int, unavailable_wait_sec: float):
+        self.writer = writer
+        self.concurrency = max(1, concurrency)
+        self.unavailable_wait_sec = unavailable_wait_sec
+        self.service = RoomService()
+        self.vllm_service = VLLMService()
+
+    def target_model(self, target: str) -> str | None:
+        if target.startswith("sm:"):
+            return target[len("sm:"):]
+        return {"model1": config.MODEL1, "model2": config.MODEL2, "sm": SM_MODEL}[target]
+
+    def conversation(self, target: str, item: BatchItem) -> Conversation:
+        if is_local(target):
+            model = self.target_model(target)
+        else:
+            model = config.MODEL2 if target == "model2" else config.MODEL1
+        return Conversation(model=model, messages=list(item.messages))
+
+    def result(self, item: BatchItem, target: str, sampling: dict, **fields) -> dict:
+        return {
+            "id": item.id,
+            "target": target,
+            "model": self.target_model(target),
+            "sampling": sampling,
+            "finished_at": datetime.now().isoformat(),
+            **fields,
+        }
+
+    async def run_http(self, target: str, items: List[BatchItem]):
+        # Workers share one iterator, each takes the next item once its request is done
+        pending = iter(items)
+
+        async def worker():
+            for item in pending:
+                await self.http_item(target, item)
+
+        await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(items)))))
+
+    async def http_item(self, target: str, item: BatchItem):
+        conversation = self.conversation(target, item)
+        sampling = self.service.resolve_sampling(
+            ChatMode.COMPARISON_MODE, conversation, item.settings
+        )
+        messages = context_manager.build(conversation)
+        response = None
+        give_up_at = time.monotonic() + self.unavailable_wait_sec
+
+        while True:
+            start_time = time.monotonic()
+            try:
+                response = await self.service.make_model_request(
+                    messages=messages, model=conversation.model, sampling=sampling
+                )
+                break
+            except ModelUnavailableError as e:
+                # Wait for the breaker instead of burning through the items as errors,
+                # but not forever: a model that stays down fails its items
+                wait_sec = max(1.0, e.retry_after_sec)
+                if time.monotonic() + wait_sec > give_up_at:
+                    logger.warning("%s still unavailable, item %s failed", target, item.id)
+                    break
+                await asyncio.sleep(wait_sec)
+
+        latency_ms = (time.monotonic() - start_time) * 1000
+
+        if not response:
+            self.writer.write(
+                self.result(
+                    item,
+                    target,
+                    sampling,
+                    response=None,
+                    error=True,
+                    timing={"latency_ms": latency_ms},
+                )
+            )
+            return
+
+        self.writer.write(
+            self.result(
+                item,
+                target,
+                sampling,
+                response=response["choices"][0]["message"]["content"],
+                error=False,
+                usage=response.get("usage"),
+                cached=response.get("cached", False),
+                timing={**(response.get("timing") or {}), "latency_ms": latency_ms},
+            )
+        )
+
+    async def run_local(self, target: str, items: List[BatchItem]):
+        for start in range(0, len(items), self.concurrency):
+            await self.local_batch(target, items[start:start + self.concurrency])
+
+    async def local_batch(self, target: str, items: List[BatchItem]):
+        model = self.target_model(target)
+        factory = engine_registry.factory(model)
+        requests, samplings = [], []
+        for item in items:
+            conversation = self.conversation(target, item)
+            sampling = self.service.resolve_sampling(
+                ChatMode.SINGLE_MODE, conversation, item.settings
+            )
+            messages = [message.to_dict() for message in context_manager.build(conversation)]
+            requests.append((messages, factory.sampling_params_for(sampling)))
+            samplings.append(sampling)
+
+        start_time = time.monotonic()
+        try:
+            outputs = await asyncio.to_thread(self.vllm_service.generate_batch, requests, model)
+        except Exception as e:
+            logger.error("Batch of %d failed: %s", len(items), e)
+            outputs = [None] * len(items)
+        latency_ms = (time.monotonic() - start_time) * 1000
+
+        for item, sampling, output in zip(items, samplings, outputs):
+            if output is None or not output.outputs:
+                self.writer.write(
+                    self.result(
+                        item,
+                        target,
+                        sampling,
+                        response=None,
+                        error=True,
+                        timing={"latency_ms": latency_ms},
+                    )
+                )
+                continue
+
+            timing = {"latency_ms": latency_ms, "batch_size": len(items)}
+            metrics = getattr(output, "metrics", None)
+            if metrics and metrics.first_token_time and metrics.arrival_time:
+                timing["ttft_ms"] = (metrics.first_token_time - metrics.arrival_time) * 1000
+
+            self.writer.write(
+                self.result(
+                    item,
+                    target,
+                    sampling,
+                    response=output.outputs[0].text,
+                    error=False,
+                    usage={
+                        "prompt_tokens": len(output.prompt_token_ids or []),
+                        "completion_tokens": len(output.outputs[0].token_ids),
+                    },
+                    timing=timing,
+                )
+            )
+
+
+async def run(args) -> dict:
+    targets = [target.strip() for target in args.targets.split(",") if target.strip()]
+    items = read_items(args.input)
+    done = completed_results(args.output)
+    pending: Dict[str, List[BatchItem]] = {
+        target: [item for item in items if (item.id, target) not in done]
+        for target in targets
+    }
+    logger.info(
+        "%d items, %d results already in %s, running %s",
+        len(items),
+        len(done),
+        args.output,
+        {target: len(target_items) for target, target_items in pending.items()},
+    )
+
+    writer = ResultWriter(args.output)
+    runner = BatchRunner(writer, args.concurrency, args.unavailable_wait_sec)
+    http_clients.start(endpoint_pools.urls)
+    start = time.perf_counter()
+
+    async def run_local_targets(local: Dict[str, List[BatchItem]]):
+        # One in-process model after the other, the engines may not fit the GPU together
+        for target, target_items in local.items():
+            await runner.run_local(target, target_items)
+
+    try:
+        jobs = []
+        local = {}
+        for target, target_items in pending.items():
+            if not target_items:
+                continue
+            if is_local(target):
+                local[target] = target_items
+            elif endpoint_pools.get(runner.target_model(target)) is None:
+                logger.error("No endpoint configured for %s, skipping it", target)
+            else:
+                jobs.append(runner.run_http(target, target_items))
+        if local:
+            jobs.append(run_local_targets(local))
+        # Targets run side by side, each bounded by its own concurrency
+        await asyncio.gather(*jobs)
+    finally:
+        writer.close()
+        await endpoint_pools.aclose()
+        await http_clients.aclose()
+
+    return {
+        "items": len(items),
+        "skipped": sum(len(items) - len(target_items) for target_items in pending.values()),
+        "written": writer.written,
+        "errors": writer.errors,
+        "duration_sec": time.perf_counter() - start,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--input", required=True, help="JSONL file of prompts or conversations")
+    parser.add_argument("--output", required=True, help="results JSONL, appended to")
+    parser.add_argument(
+        "--targets",
+        default="model1,model2",
+        help=f"comma separated, any of {', '.join(TARGETS)}",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="requests in flight per HTTP target, llm.chat batch size in-process",
+    )
+    parser.add_argument(
+        "--unavailable-wait-sec",
+        type=float,
+        default=300.0,
+        help="how long an item waits for a model whose circuit breakers are open",
+    )
+    args = parser.parse_args()
+
+    targets = set(args.targets.split(","))
+    unknown = {
+        target
+        for target in targets - set(TARGETS)
+        if not (target.startswith("sm:") and target[len("sm:"):] in config.SM_MODELS)
+    }
+    if unknown:
+        parser.error(f"unknown targets: {', '.join(sorted(unknown))}")
+    if any(is_local(target) for target in targets):
+        # Batches go through llm.chat, the offline engine
+        config.STREAMING = False
+
+    setup_logging()
+    summary = asyncio.run(run(args))
+    print(json_codec.dumps_text(summary))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,160 @@
 import os
 from dotenv import load_dotenv
 
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def _env_list(name: str, default: list) -> list:
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return default
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def _env_float_map(name: str, default: dict) -> dict:
+    """Comma separated key=number pairs, e.g. org/model-a=6,org/model-b=12.5"""
+    return {
+        key.strip(): float(value)
+        for key, value in (item.split("=", 1) for item in _env_list(name, []) if "=" in item)
+    } or default
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    return int(value)
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    return float(value)
+
+
 class Config():
     """Config class allows easier models and endpoints configuration"""
     MODEL1_ENDPOINT=None
     MODEL2_ENDPOINT=None
     MODEL1=None
     MODEL2=None
+    # Replicas per model, comma separated, default to the single endpoint above
+    MODEL1_ENDPOINTS=[]
+    MODEL2_ENDPOINTS=[]
+    # Route repeated turns of a conversation to the same replica (prefix cache reuse)
+    ROUTING_AFFINITY=True
+    AFFINITY_SLACK=2
+    REPLICA_MAX_FAILURES=3
+    HEALTH_CHECK_PATH="/health"
+    HEALTH_CHECK_INTERVAL_SEC=10.0
+    HEALTH_CHECK_TIMEOUT=2.0
+    # Per-replica circuit breaker over the last CIRCUIT_WINDOW requests
+    CIRCUIT_WINDOW=20
+    CIRCUIT_MIN_REQUESTS=5
+    CIRCUIT_FAILURE_RATE=0.5
+    # Slow calls are judged by their time to first token
+    CIRCUIT_SLOW_CALL_SEC=30.0
+    CIRCUIT_SLOW_CALL_RATE=0.8
+    CIRCUIT_OPEN_SEC=15.0
+    CIRCUIT_HALF_OPEN_PROBES=1
+    # Retries of requests that never reached a model (connect errors, 502/503/504)
+    REQUEST_RETRIES=2
+    RETRY_BACKOFF_BASE_SEC=0.2
+    RETRY_BACKOFF_MAX_SEC=2.0
+    # Send responses token by token (delta frames) instead of one final frame
+    STREAMING=False
+    # Non-streaming comparison mode still reads the vLLM response as a stream,
+    # so that time to first token and inter-token latency can be measured
+    CM_UPSTREAM_STREAMING=True
+    # slowapi limit for HTTP routes, per client IP
+    RATE_LIMIT="10/minute"
+    # WebSocket token budgets (estimated prompt + generated tokens), 0 disables a scope
+    WS_TOKENS_PER_MINUTE_PER_IP=100000
+    WS_TOKENS_PER_MINUTE_PER_ROOM=50000
+    # A turn still running after this many seconds is cancelled, 0 disables the deadline
+    TURN_DEADLINE_SEC=180.0
+    # A turn whose client disconnected keeps generating this long for it to reconnect,
+    # 0 cancels it right away
+    RESUME_GRACE_SEC=30.0
+    # Frames of the last finished turn of a conversation are kept this long for replay
+    RESUME_TTL_SEC=300.0
+    # Event loop lag histogram and stack traces of calls blocking the loop, see loop_monitor.py
+    LOOP_MONITOR=False
+    LOOP_MONITOR_INTERVAL_MS=50.0
+    LOOP_BLOCK_THRESHOLD_MS=100.0
+    # Shared HTTP clients for model endpoints
+    HTTP2=False
+    HTTP_MAX_CONNECTIONS=100
+    HTTP_MAX_KEEPALIVE_CONNECTIONS=20
+    HTTP_KEEPALIVE_EXPIRY=30.0
+    HTTP_CONNECT_TIMEOUT=5.0
+    HTTP_READ_TIMEOUT=120.0
+    HTTP_WRITE_TIMEOUT=10.0
+    HTTP_POOL_TIMEOUT=10.0
+    # Micro-batching of single mode turns
+    SM_BATCH_WINDOW_MS=10.0
+    SM_MAX_BATCH_SIZE=32
+    # In-memory room registry eviction
+    ROOM_IDLE_TTL_SEC=3600.0
+    ROOM_MAX_MESSAGE_BYTES=256 * 1024 * 1024
+    ROOM_SWEEP_INTERVAL_SEC=60.0
+    # Durable room storage: "memory" or "sqlite"
+    STORAGE_BACKEND="memory"
+    STORAGE_PATH="data/rooms.sqlite3"
+    # How long an SQLite statement waits for another worker's write lock
+    STORAGE_BUSY_TIMEOUT_SEC=2.0
+    # Several uvicorn workers share rooms through SQLite storage and lock rooms across processes
+    SHARED_STATE=False
+    ROOM_LOCK_LEASE_SEC=60.0
+    # Prompt token budget per request, the full history stays in storage
+    CONTEXT_TOKEN_BUDGET=8000
+    MODEL1_CONTEXT_TOKEN_BUDGET=None
+    MODEL2_CONTEXT_TOKEN_BUDGET=None
+    CONTEXT_POLICY="system_recent"
+    CONTEXT_TOKENIZER=None
+    # Background W&B metrics sink
+    METRICS_QUEUE_SIZE=10000
+    METRICS_BATCH_SIZE=100
+    METRICS_FLUSH_INTERVAL_SEC=5.0
+    # Share of turns traced, spans go to rotating JSONL files in TRACE_DIR
+    TRACE_SAMPLE_RATE=0.0
+    TRACE_DIR="data/traces"
+    TRACE_MAX_BYTES=50000000
+    TRACE_BACKUP_COUNT=5
+    TRACE_QUEUE_SIZE=10000
+    # Single mode engine: "vllm" or "fake" for CPU-only benchmarking
+    SM_ENGINE="vllm"
+    # Load and warm up the single mode engine at startup, disable for comparison-only front ends
+    SM_ENABLED=True
+    # Models single mode rooms can pick, the first one is the default
+    SM_MODELS=["google/gemma-3-1b-it"]
+    # GPU memory taken by each in-process engine (weights + KV cache), in GB
+    SM_MODEL_MEMORY_GB={}
+    SM_DEFAULT_MODEL_MEMORY_GB=8.0
+    # Engines are evicted least recently used to stay within this, 0 keeps one engine at a time
+    SM_MEMORY_BUDGET_GB=0.0
+    # How long a request waits for busy engines to finish before its engine can be loaded
+    SM_ENGINE_SWAP_TIMEOUT_SEC=30.0
+    FAKE_ENGINE_PREFILL_MS=100.0
+    FAKE_ENGINE_TOKENS_PER_SEC=50.0
+    FAKE_ENGINE_OUTPUT_TOKENS=64
+    # Default sampling of rooms, temperature 0 makes replies deterministic and cacheable
+    SM_TEMPERATURE=0.8
+    SM_MAX_TOKENS=2000
+    CM_TEMPERATURE=0.8
+    CM_MAX_TOKENS=500
+    # Deadline mode never sizes a reply below this, even if the budget looks too tight
+    DEADLINE_MIN_TOKENS=16
+    # Response cache, only deterministic requests are cached unless sampling is allowed
+    RESPONSE_CACHE_MAX_ENTRIES=1024
+    RESPONSE_CACHE_TTL_SEC=600.0
+    RESPONSE_CACHE_ALLOW_SAMPLING=False
 
     @classmethod
     def from_env (cls):
@@ -17,6 +165,128 @@ class Config():
         cnf.MODEL2_ENDPOINT = os.getenv("MODEL2_ENDPOINT", cls.MODEL2_ENDPOINT)
         cnf.MODEL1 = os.getenv("MODEL1", cls.MODEL1)
         cnf.MODEL2 = os.getenv("MODEL2", cls.MODEL2)
+        cnf.MODEL1_ENDPOINTS = _env_list(
+            "MODEL1_ENDPOINTS", [cnf.MODEL1_ENDPOINT] if cnf.MODEL1_ENDPOINT else []
+        )
+        cnf.MODEL2_ENDPOINTS = _env_list(
+            "MODEL2_ENDPOINTS", [cnf.MODEL2_ENDPOINT] if cnf.MODEL2_ENDPOINT else []
+        )
+        cnf.ROUTING_AFFINITY = _env_bool("ROUTING_AFFINITY", cls.ROUTING_AFFINITY)
+        cnf.AFFINITY_SLACK = _env_int("AFFINITY_SLACK", cls.AFFINITY_SLACK)
+        cnf.REPLICA_MAX_FAILURES = _env_int("REPLICA_MAX_FAILURES", cls.REPLICA_MAX_FAILURES)
+        cnf.HEALTH_CHECK_PATH = os.getenv("HEALTH_CHECK_PATH") or cls.HEALTH_CHECK_PATH
+        cnf.HEALTH_CHECK_INTERVAL_SEC = _env_float(
+            "HEALTH_CHECK_INTERVAL_SEC", cls.HEALTH_CHECK_INTERVAL_SEC
+        )
+        cnf.HEALTH_CHECK_TIMEOUT = _env_float("HEALTH_CHECK_TIMEOUT", cls.HEALTH_CHECK_TIMEOUT)
+        cnf.CIRCUIT_WINDOW = _env_int("CIRCUIT_WINDOW", cls.CIRCUIT_WINDOW)
+        cnf.CIRCUIT_MIN_REQUESTS = _env_int("CIRCUIT_MIN_REQUESTS", cls.CIRCUIT_MIN_REQUESTS)
+        cnf.CIRCUIT_FAILURE_RATE = _env_float("CIRCUIT_FAILURE_RATE", cls.CIRCUIT_FAILURE_RATE)
+        cnf.CIRCUIT_SLOW_CALL_SEC = _env_float("CIRCUIT_SLOW_CALL_SEC", cls.CIRCUIT_SLOW_CALL_SEC)
+        cnf.CIRCUIT_SLOW_CALL_RATE = _env_float(
+            "CIRCUIT_SLOW_CALL_RATE", cls.CIRCUIT_SLOW_CALL_RATE
+        )
+        cnf.CIRCUIT_OPEN_SEC = _env_float("CIRCUIT_OPEN_SEC", cls.CIRCUIT_OPEN_SEC)
+        cnf.CIRCUIT_HALF_OPEN_PROBES = _env_int(
+            "CIRCUIT_HALF_OPEN_PROBES", cls.CIRCUIT_HALF_OPEN_PROBES
+        )
+        cnf.REQUEST_RETRIES = _env_int("REQUEST_RETRIES", cls.REQUEST_RETRIES)
+        cnf.RETRY_BACKOFF_BASE_SEC = _env_float(
+            "RETRY_BACKOFF_BASE_SEC", cls.RETRY_BACKOFF_BASE_SEC
+        )
+        cnf.RETRY_BACKOFF_MAX_SEC = _env_float("RETRY_BACKOFF_MAX_SEC", cls.RETRY_BACKOFF_MAX_SEC)
+        cnf.STREAMING = _env_bool("STREAMING", cls.STREAMING)
+        cnf.CM_UPSTREAM_STREAMING = _env_bool("CM_UPSTREAM_STREAMING", cls.CM_UPSTREAM_STREAMING)
+        cnf.RATE_LIMIT = os.getenv("RATE_LIMIT") or cls.RATE_LIMIT
+        cnf.WS_TOKENS_PER_MINUTE_PER_IP = _env_int(
+            "WS_TOKENS_PER_MINUTE_PER_IP", cls.WS_TOKENS_PER_MINUTE_PER_IP
+        )
+        cnf.WS_TOKENS_PER_MINUTE_PER_ROOM = _env_int(
+            "WS_TOKENS_PER_MINUTE_PER_ROOM", cls.WS_TOKENS_PER_MINUTE_PER_ROOM
+        )
+        cnf.TURN_DEADLINE_SEC = _env_float("TURN_DEADLINE_SEC", cls.TURN_DEADLINE_SEC)
+        cnf.RESUME_GRACE_SEC = _env_float("RESUME_GRACE_SEC", cls.RESUME_GRACE_SEC)
+        cnf.RESUME_TTL_SEC = _env_float("RESUME_TTL_SEC", cls.RESUME_TTL_SEC)
+        cnf.LOOP_MONITOR = _env_bool("LOOP_MONITOR", cls.LOOP_MONITOR)
+        cnf.LOOP_MONITOR_INTERVAL_MS = _env_float(
+            "LOOP_MONITOR_INTERVAL_MS", cls.LOOP_MONITOR_INTERVAL_MS
+        )
+        cnf.LOOP_BLOCK_THRESHOLD_MS = _env_float(
+            "LOOP_BLOCK_THRESHOLD_MS", cls.LOOP_BLOCK_THRESHOLD_MS
+        )
+        cnf.HTTP2 = _env_bool("HTTP2", cls.HTTP2)
+        cnf.HTTP_MAX_CONNECTIONS = _env_int("HTTP_MAX_CONNECTIONS", cls.HTTP_MAX_CONNECTIONS)
+        cnf.HTTP_MAX_KEEPALIVE_CONNECTIONS = _env_int(
+            "HTTP_MAX_KEEPALIVE_CONNECTIONS", cls.HTTP_MAX_KEEPALIVE_CONNECTIONS
+        )
+        cnf.HTTP_KEEPALIVE_EXPIRY = _env_float("HTTP_KEEPALIVE_EXPIRY", cls.HTTP_KEEPALIVE_EXPIRY)
+        cnf.HTTP_CONNECT_TIMEOUT = _env_float("HTTP_CONNECT_TIMEOUT", cls.HTTP_CONNECT_TIMEOUT)
+        cnf.HTTP_READ_TIMEOUT = _env_float("HTTP_READ_TIMEOUT", cls.HTTP_READ_TIMEOUT)
+        cnf.HTTP_WRITE_TIMEOUT = _env_float("HTTP_WRITE_TIMEOUT", cls.HTTP_WRITE_TIMEOUT)
+        cnf.HTTP_POOL_TIMEOUT = _env_float("HTTP_POOL_TIMEOUT", cls.HTTP_POOL_TIMEOUT)
+        cnf.SM_BATCH_WINDOW_MS = _env_float("SM_BATCH_WINDOW_MS", cls.SM_BATCH_WINDOW_MS)
+        cnf.SM_MAX_BATCH_SIZE = _env_int("SM_MAX_BATCH_SIZE", cls.SM_MAX_BATCH_SIZE)
+        cnf.ROOM_IDLE_TTL_SEC = _env_float("ROOM_IDLE_TTL_SEC", cls.ROOM_IDLE_TTL_SEC)
+        cnf.ROOM_MAX_MESSAGE_BYTES = _env_int("ROOM_MAX_MESSAGE_BYTES", cls.ROOM_MAX_MESSAGE_BYTES)
+        cnf.ROOM_SWEEP_INTERVAL_SEC = _env_float(
+            "ROOM_SWEEP_INTERVAL_SEC", cls.ROOM_SWEEP_INTERVAL_SEC
+        )
+        cnf.STORAGE_BACKEND = os.getenv("STORAGE_BACKEND") or cls.STORAGE_BACKEND
+        cnf.STORAGE_PATH = os.getenv("STORAGE_PATH") or cls.STORAGE_PATH
+        cnf.STORAGE_BUSY_TIMEOUT_SEC = _env_float(
+            "STORAGE_BUSY_TIMEOUT_SEC", cls.STORAGE_BUSY_TIMEOUT_SEC
+        )
+        cnf.SHARED_STATE = _env_bool("SHARED_STATE", cls.SHARED_STATE)
+        cnf.ROOM_LOCK_LEASE_SEC = _env_float("ROOM_LOCK_LEASE_SEC", cls.ROOM_LOCK_LEASE_SEC)
+        cnf.CONTEXT_TOKEN_BUDGET = _env_int("CONTEXT_TOKEN_BUDGET", cls.CONTEXT_TOKEN_BUDGET)
+        cnf.MODEL1_CONTEXT_TOKEN_BUDGET = _env_int(
+            "MODEL1_CONTEXT_TOKEN_BUDGET", cls.MODEL1_CONTEXT_TOKEN_BUDGET
+        )
+        cnf.MODEL2_CONTEXT_TOKEN_BUDGET = _env_int(
+            "MODEL2_CONTEXT_TOKEN_BUDGET", cls.MODEL2_CONTEXT_TOKEN_BUDGET
+        )
+        cnf.CONTEXT_POLICY = os.getenv("CONTEXT_POLICY") or cls.CONTEXT_POLICY
+        cnf.CONTEXT_TOKENIZER = os.getenv("CONTEXT_TOKENIZER") or cls.CONTEXT_TOKENIZER
+        cnf.METRICS_QUEUE_SIZE = _env_int("METRICS_QUEUE_SIZE", cls.METRICS_QUEUE_SIZE)
+        cnf.METRICS_BATCH_SIZE = _env_int("METRICS_BATCH_SIZE", cls.METRICS_BATCH_SIZE)
+        cnf.METRICS_FLUSH_INTERVAL_SEC = _env_float(
+            "METRICS_FLUSH_INTERVAL_SEC", cls.METRICS_FLUSH_INTERVAL_SEC
+        )
+        cnf.TRACE_SAMPLE_RATE = _env_float("TRACE_SAMPLE_RATE", cls.TRACE_SAMPLE_RATE)
+        cnf.TRACE_DIR = os.getenv("TRACE_DIR") or cls.TRACE_DIR
+        cnf.TRACE_MAX_BYTES = _env_int("TRACE_MAX_BYTES", cls.TRACE_MAX_BYTES)
+        cnf.TRACE_BACKUP_COUNT = _env_int("TRACE_BACKUP_COUNT", cls.TRACE_BACKUP_COUNT)
+        cnf.TRACE_QUEUE_SIZE = _env_int("TRACE_QUEUE_SIZE", cls.TRACE_QUEUE_SIZE)
+        cnf.SM_ENGINE = os.getenv("SM_ENGINE") or cls.SM_ENGINE
+        cnf.SM_MODELS = _env_list("SM_MODELS", cls.SM_MODELS)
+        cnf.SM_MODEL_MEMORY_GB = _env_float_map("SM_MODEL_MEMORY_GB", cls.SM_MODEL_MEMORY_GB)
+        cnf.SM_DEFAULT_MODEL_MEMORY_GB = _env_float(
+            "SM_DEFAULT_MODEL_MEMORY_GB", cls.SM_DEFAULT_MODEL_MEMORY_GB
+        )
+        cnf.SM_MEMORY_BUDGET_GB = _env_float("SM_MEMORY_BUDGET_GB", cls.SM_MEMORY_BUDGET_GB)
+        cnf.SM_ENGINE_SWAP_TIMEOUT_SEC = _env_float(
+            "SM_ENGINE_SWAP_TIMEOUT_SEC", cls.SM_ENGINE_SWAP_TIMEOUT_SEC
+        )
+        cnf.SM_ENABLED = _env_bool("SM_ENABLED", cls.SM_ENABLED)
+        cnf.FAKE_ENGINE_PREFILL_MS = _env_float("FAKE_ENGINE_PREFILL_MS", cls.FAKE_ENGINE_PREFILL_MS)
+        cnf.FAKE_ENGINE_TOKENS_PER_SEC = _env_float(
+            "FAKE_ENGINE_TOKENS_PER_SEC", cls.FAKE_ENGINE_TOKENS_PER_SEC
+        )
+        cnf.FAKE_ENGINE_OUTPUT_TOKENS = _env_int(
+            "FAKE_ENGINE_OUTPUT_TOKENS", cls.FAKE_ENGINE_OUTPUT_TOKENS
+        )
+        cnf.SM_TEMPERATURE = _env_float("SM_TEMPERATURE", cls.SM_TEMPERATURE)
+        cnf.SM_MAX_TOKENS = _env_int("SM_MAX_TOKENS", cls.SM_MAX_TOKENS)
+        cnf.CM_TEMPERATURE = _env_float("CM_TEMPERATURE", cls.CM_TEMPERATURE)
+        cnf.CM_MAX_TOKENS = _env_int("CM_MAX_TOKENS", cls.CM_MAX_TOKENS)
+        cnf.DEADLINE_MIN_TOKENS = _env_int("DEADLINE_MIN_TOKENS", cls.DEADLINE_MIN_TOKENS)
+        cnf.RESPONSE_CACHE_MAX_ENTRIES = _env_int(
+            "RESPONSE_CACHE_MAX_ENTRIES", cls.RESPONSE_CACHE_MAX_ENTRIES
+        )
+        cnf.RESPONSE_CACHE_TTL_SEC = _env_float("RESPONSE_CACHE_TTL_SEC", cls.RESPONSE_CACHE_TTL_SEC)
+        cnf.RESPONSE_CACHE_ALLOW_SAMPLING = _env_bool(
+            "RESPONSE_CACHE_ALLOW_SAMPLING", cls.RESPONSE_CACHE_ALLOW_SAMPLING
+        )
 
         return cnf
 
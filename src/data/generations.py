@@ -0,0 +1,261 @@
+import asyncio
+import logging
+import time
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Tuple
+from src.config import config
+from src.services.metrics import TURNS_CANCELLED
+from src.services.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+Publish = Callable[[dict], None]
+
+
+class Generation:
+    """
+    Frames of one turn, numbered with sequence numbers that keep counting up
+    across the turns of a conversation.
+
+    The turn runs in its own task and publishes its frames here instead of sending
+    them on a socket, connections follow it from any sequence number. A connection
+    that drops does not cancel the turn: it is cancelled once nobody followed it
+    for `grace_sec`, so a client reconnecting in time gets the rest of the reply
+    without generating it again.
+    """
+
+    def __init__(self, first_seq: int = 0, grace_sec: float = 30.0):
+        self.first_seq = first_seq
+        self.grace_sec = grace_sec
+        self.frames: List[dict] = []
+        self.previous: Generation | None = None
+        self.cancelled: str | None = None
+        self.finished_at: float | None = None
+        self._task: asyncio.Task | None = None
+        self._followers = 0
+        self._changed = asyncio.Event()
+        self._deadline_handle: asyncio.TimerHandle | None = None
+        self._orphan_handle: asyncio.TimerHandle | None = None
+
+    @property
+    def next_seq(self) -> int:
+        return self.first_seq + len(self.frames)
+
+    @property
+    def finished(self) -> bool:
+        return self.finished_at is not None
+
+    def publish(self, frame: dict):
+        """Number a frame of the turn and hand it to the followers"""
+
+        frame["seq"] = self.next_seq
+        # Frames other than deltas carry the trace ID of the turn
+        if frame.get("type") != "delta":
+            trace_id = tracer.current_trace_id()
+            if trace_id is not None:
+                frame["trace_id"] = trace_id
+
+        self.frames.append(frame)
+        self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def start(self, turn: Awaitable, deadline_sec: float = 0.0):
+        """Run the turn, it is cancelled with reason "deadline" after `deadline_sec` if set"""
+
+        loop = asyncio.get_running_loop()
+        self._task = asyncio.ensure_future(turn)
+        self._task.add_done_callback(self._done)
+        if deadline_sec:
+            self._deadline_handle = loop.call_later(deadline_sec, self.cancel, "deadline")
+
+    def _done(self, task: asyncio.Task):
+        self.finished_at = time.monotonic()
+        for handle in (self._deadline_handle, self._orphan_handle):
+            if handle is not None:
+                handle.cancel()
+        self._notify()
+
+        if not task.cancelled() and task.exception() is not None and not self._followers:
+            # Followers re-raise it, see result()
+            logger.error("Turn failed without a connection: %s", task.exception())
+
+    def cancel(self, reason: str) -> bool:
+        """
+        Cancel the running turn. The reason reaches it as the CancelledError message.
+
+        Returns:
+            bool: False if the turn already finished or was cancelled
+        """
+        if self._task is None or self._task.done() or self.cancelled is not None:
+            return False
+
+        self.cancelled = reason
+        self._task.cancel(reason)
+        TURNS_CANCELLED.inc(reason=reason)
+        logger.info("Turn cancelled: %s", reason)
+
+        return True
+
+    async def wait(self):
+        """Wait for the turn to finish, whatever its outcome"""
+
+        if self._task is not None:
+            await asyncio.wait({self._task})
+
+    def result(self):
+        """Re-raise the error of a failed turn"""
+
+        if self._task is not None and self._task.done() and not self._task.cancelled():
+            self._task.result()
+
+    def _orphaned(self):
+        self._orphan_handle = None
+        if not self._followers:
+            self.cancel("disconnect")
+
+    def _detach(self):
+        self._followers -= 1
+        if self._followers or self.finished:
+            return
+
+        if self.grace_sec > 0:
+            self._orphan_handle = asyncio.get_running_loop().call_later(
+                self.grace_sec, self._orphaned
+            )
+        else:
+            self.cancel("disconnect")
+
+    async def follow(self, after_seq: int = -1) -> AsyncIterator[dict]:
+        """Frames with a sequence number above `after_seq`, until the turn finished"""
+
+        self._followers += 1
+        if self._orphan_handle is not None:
+            self._orphan_handle.cancel()
+            self._orphan_handle = None
+
+        try:
+            index = max(0, after_seq + 1 - self.first_seq)
+            while True:
+                changed = self._changed
+                while index < len(self.frames):
+                    yield self.frames[index]
+                    index += 1
+                if self.finished:
+                    return
+                await changed.wait()
+        finally:
+            self._detach()
+
+
+class Generations:
+    """
+    The running or last turn of every conversation, or comparison room, together
+    with the turn before it, so that a client reconnecting with the last sequence
+    number it saw gets every frame it missed.
+
+    Frames are kept in the worker process that generated them, with several workers
+    reconnects need sticky sessions to find them. Generations finished for longer
+    than `ttl_sec` are dropped.
+    """
+
+    def __init__(
+        self,
+        grace_sec: float = 30.0,
+        ttl_sec: float = 300.0,
+        deadline_sec: float = 0.0,
+        sweep_interval_sec: float = 60.0,
+    ):
+        self.grace_sec = grace_sec
+        self.ttl_sec = ttl_sec
+        self.deadline_sec = deadline_sec
+        self.sweep_interval_sec = sweep_interval_sec
+        self._latest: Dict[str, Generation] = {}
+        self._last_sweep = time.monotonic()
+
+    def __len__(self):
+        return len(self._latest)
+
+    def _maybe_sweep(self):
+        now = time.monotonic()
+        if now - self._last_sweep < self.sweep_interval_sec:
+            return
+
+        self._last_sweep = now
+        expired = [
+            key
+            for key, generation in self._latest.items()
+            if generation.finished and now - generation.finished_at > self.ttl_sec
+        ]
+        for key in expired:
+            del self._latest[key]
+
+    async def start(self, key: str, turn: Callable[[Publish], Awaitable]) -> Generation:
+        """
+        Start a turn, a turn of the same key still running is superseded first
+
+        Args:
+            key: conversation or room the turn belongs to
+            turn: called with the publish function of the turn, returns its coroutine
+
+        Returns:
+            Generation: the started turn
+        """
+        self._maybe_sweep()
+
+        while True:
+            latest = self._latest.get(key)
+            if latest is None or latest.finished:
+                break
+            latest.cancel("superseded")
+            await latest.wait()
+
+        generation = Generation(latest.next_seq if latest else 0, self.grace_sec)
+        if latest is not None:
+            latest.previous = None
+            generation.previous = latest
+        self._latest[key] = generation
+        generation.start(turn(generation.publish), self.deadline_sec)
+
+        return generation
+
+    def resume(self, key: str, last_seq: int) -> Tuple[List[dict], Generation] | None:
+        """
+        Frames after `last_seq` of the previous turn, and the latest turn to follow from `last_seq`
+
+        Returns:
+            None if some of the frames after `last_seq` are no longer kept
+        """
+        self._maybe_sweep()
+
+        latest = self._latest.get(key)
+        if latest is None or last_seq >= latest.next_seq:
+            return None
+
+        oldest = latest.previous or latest
+        if last_seq + 1 < oldest.first_seq:
+            return None
+
+        previous_frames = []
+        if latest.previous is not None:
+            previous_frames = [
+                frame for frame in latest.previous.frames if frame["seq"] > last_seq
+            ]
+
+        return previous_frames, latest
+
+    async def aclose(self):
+        """Cancel the running turns"""
+
+        running = [generation for generation in self._latest.values() if not generation.finished]
+        for generation in running:
+            generation.cancel("shutdown")
+        await asyncio.gather(*(generation.wait() for generation in running))
+
+
+generations = Generations(
+    grace_sec=config.RESUME_GRACE_SEC,
+    ttl_sec=config.RESUME_TTL_SEC,
+    deadline_sec=config.TURN_DEADLINE_SEC,
+)
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import os
+import uuid
+import weakref
+from contextlib import asynccontextmanager, suppress
+from typing import Iterable, List
+from src.config import config
+from src.data.storage import RoomStorage, storage
+from src.services.metrics import TURNS_CANCELLED
+
+logger = logging.getLogger(__name__)
+
+
+class RoomLocks:
+    """
+    Serializes turns on the same conversations so their messages never interleave.
+
+    Within a process an asyncio lock is taken per conversation. With shared state
+    the turn also holds a lease row in the storage, which locks the conversation
+    for every worker process. Leases are renewed while the turn runs and expire
+    on their own if the worker dies.
+
+    A comparison turn locks all conversations of its room, while the two-socket
+    comparison UI still runs the two models of a room concurrently.
+
+    A turn whose lease was taken over by another worker, e.g. after the storage was
+    unreachable for longer than the lease, is cancelled with reason LOCK_LOST.
+    """
+
+    LOCK_LOST = "lock_lost"
+
+    def __init__(
+        self,
+        room_storage: RoomStorage,
+        shared: bool = False,
+        lease_sec: float = 60.0,
+        poll_interval_sec: float = 0.05,
+    ):
+        self.storage = room_storage
+        self.shared = shared
+        self.lease_sec = lease_sec
+        self.poll_interval_sec = poll_interval_sec
+        # Locks disappear together with the last turn waiting for them
+        self._locks: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+        self._owner_prefix = f"{os.getpid()}:"
+
+    def _local_lock(self, key: str) -> asyncio.Lock:
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[key] = lock
+        return lock
+
+    async def _acquire_lease(self, name: str, owner: str):
+        delay = self.poll_interval_sec
+        while not await self.storage.acquire_lease(name, owner, self.lease_sec):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+    async def _renew_leases(self, names: List[str], owner: str, holder: asyncio.Task):
+        while True:
+            await asyncio.sleep(self.lease_sec / 3)
+            for name in names:
+                try:
+                    renewed = await self.storage.acquire_lease(name, owner, self.lease_sec)
+                except Exception as e:
+                    # The lease lasts for two more renewals, a later one tells if it was lost
+                    logger.warning("Could not renew room lock %s: %s", name, e)
+                    continue
+
+                if not renewed:
+                    logger.warning(
+                        "Lost room lock %s, another worker took it over, cancelling the turn",
+                        name,
+                    )
+                    TURNS_CANCELLED.inc(reason=self.LOCK_LOST)
+                    holder.cancel(self.LOCK_LOST)
+                    return
+
+    @asynccontextmanager
+    async def hold(self, conversation_ids: Iterable):
+        """
+        Lock the conversations for the duration of a turn, waits for running turns.
+        The task entering the block is cancelled if the lock is lost, see RoomLocks.
+        """
+
+        # Sorted so turns locking several conversations cannot deadlock each other
+        keys = sorted({str(conversation_id) for conversation_id in conversation_ids})
+        local_locks = [self._local_lock(key) for key in keys]
+        acquired: List[asyncio.Lock] = []
+        leases: List[str] = []
+        owner = self._owner_prefix + uuid.uuid4().hex
+        renew_task = None
+
+        try:
+            for lock in local_locks:
+                await lock.acquire()
+                acquired.append(lock)
+
+            if self.shared:
+                for key in keys:
+                    name = f"conversation:{key}"
+                    await self._acquire_lease(name, owner)
+                    leases.append(name)
+                renew_task = asyncio.create_task(
+                    self._renew_leases(leases, owner, asyncio.current_task())
+                )
+
+            yield
+        finally:
+            if renew_task is not None:
+                renew_task.cancel()
+                with suppress(asyncio.CancelledError):
+                    await renew_task
+            for name in leases:
+                self.storage.release_lease(name, owner)
+            for lock in reversed(acquired):
+                lock.release()
+
+
+room_locks = RoomLocks(
+    storage, shared=config.SHARED_STATE, lease_sec=config.ROOM_LOCK_LEASE_SEC
+)
@@ -1 +1,236 @@
-rooms = []
\ No newline at end of file
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, Tuple
+from src.config import config
+
+logger = logging.getLogger(__name__)
+
+
+def _to_uuid(value) -> uuid.UUID | None:
+    if isinstance(value, uuid.UUID):
+        return value
+    try:
+        return uuid.UUID(str(value))
+    except ValueError:
+        return None
+
+
+def message_size(message) -> int:
+    """Approximate heap cost of a message in bytes"""
+
+    if isinstance(message, dict):
+        role, content = message.get("role", ""), message.get("content", "")
+        return len(str(role)) + len(str(content).encode("utf-8"))
+
+    # Roles are interned, Message records keep the text and its cached JSON encoding
+    return 2 * len(str(message.content).encode("utf-8"))
+
+
+class RoomRegistry:
+    """
+    In-memory room storage keyed by UUID.
+
+    Rooms and conversations are looked up in O(1). Rooms are kept in LRU order,
+    rooms idle for longer than `idle_ttl_sec` are evicted, and least recently used
+    rooms are evicted once all message histories together exceed `max_message_bytes`.
+    It is not thread-safe, routes using it run on the event loop.
+    """
+
+    def __init__(
+        self,
+        idle_ttl_sec: float = 3600.0,
+        max_message_bytes: int = 256 * 1024 * 1024,
+        sweep_interval_sec: float = 60.0,
+    ):
+        self.idle_ttl_sec = idle_ttl_sec
+        self.max_message_bytes = max_message_bytes
+        self.sweep_interval_sec = sweep_interval_sec
+
+        # room id -> room, ordered from least to most recently accessed
+        self._rooms: OrderedDict = OrderedDict()
+        # conversation id -> (room id, conversation)
+        self._conversations: Dict[uuid.UUID, Tuple[uuid.UUID, object]] = {}
+        self._last_access: Dict[uuid.UUID, float] = {}
+        self._room_bytes: Dict[uuid.UUID, int] = {}
+        self._last_sweep = time.monotonic()
+
+        self.total_bytes = 0
+        self.ttl_evictions = 0
+        self.memory_evictions = 0
+
+    def __len__(self):
+        return len(self._rooms)
+
+    def __iter__(self):
+        return iter(list(self._rooms.values()))
+
+    def _touch(self, room_id: uuid.UUID):
+        self._rooms.move_to_end(room_id)
+        self._last_access[room_id] = time.monotonic()
+
+    def add(self, room):
+        """Register a new room and its conversations"""
+
+        self._maybe_sweep()
+
+        size = sum(
+            message_size(message)
+            for conversation in room.conversations
+            for message in conversation.messages
+        )
+
+        self._rooms[room.id] = room
+        self._room_bytes[room.id] = size
+        self.total_bytes += size
+        for conversation in room.conversations:
+            self._conversations[conversation.id] = (room.id, conversation)
+        self._touch(room.id)
+
+        self._enforce_memory_cap()
+
+        return room
+
+    def get(self, room_id):
+        """Return room by id or None"""
+
+        self._maybe_sweep()
+
+        key = _to_uuid(room_id)
+        room = self._rooms.get(key) if key else None
+
+        if room is not None:
+            self._touch(key)
+
+        return room
+
+    def get_conversation(self, room_id, conversation_id):
+        """Return conversation by id or None if it does not belong to the room"""
+
+        room_key = _to_uuid(room_id)
+        conversation_key = _to_uuid(conversation_id)
+        entry = self._conversations.get(conversation_key) if conversation_key else None
+
+        if entry is None or entry[0] != room_key:
+            return None
+
+        self._touch(room_key)
+
+        return entry[1]
+
+    def record_message(self, conversation_id, message):
+        """Account for a message appended to a conversation history"""
+
+        entry = self._conversations.get(_to_uuid(conversation_id))
+        if entry is None:
+            return
+
+        room_id = entry[0]
+        size = message_size(message)
+        self._room_bytes[room_id] = self._room_bytes.get(room_id, 0) + size
+        self.total_bytes += size
+        self._touch(room_id)
+
+        self._enforce_memory_cap()
+
+    def forget_message(self, conversation_id, message):
+        """Account for a message removed from the end of a conversation history"""
+
+        entry = self._conversations.get(_to_uuid(conversation_id))
+        if entry is None:
+            return
+
+        room_id = entry[0]
+        size = message_size(message)
+        self._room_bytes[room_id] = max(0, self._room_bytes.get(room_id, 0) - size)
+        self.total_bytes = max(0, self.total_bytes - size)
+
+    def replace_messages(self, conversation_id, messages: list):
+        """Swap the history of a conversation, e.g. for a newer copy from shared storage"""
+
+        entry = self._conversations.get(_to_uuid(conversation_id))
+        if entry is None:
+            return
+
+        room_id, conversation = entry
+        delta = sum(message_size(message) for message in messages) - sum(
+            message_size(message) for message in conversation.messages
+        )
+        conversation.messages[:] = messages
+        self._room_bytes[room_id] = self._room_bytes.get(room_id, 0) + delta
+        self.total_bytes += delta
+        self._touch(room_id)
+
+        self._enforce_memory_cap()
+
+    def remove(self, room_id) -> bool:
+        """Remove room and its conversations, return False if it was not registered"""
+
+        key = _to_uuid(room_id)
+        room = self._rooms.pop(key, None) if key else None
+
+        if room is None:
+            return False
+
+        for conversation in room.conversations:
+            self._conversations.pop(conversation.id, None)
+        self._last_access.pop(key, None)
+        self.total_bytes -= self._room_bytes.pop(key, 0)
+
+        return True
+
+    def evict_expired(self) -> int:
+        """Evict rooms idle for longer than the TTL, return number of evicted rooms"""
+
+        self._last_sweep = time.monotonic()
+        if self.idle_ttl_sec <= 0:
+            return 0
+
+        cutoff = time.monotonic() - self.idle_ttl_sec
+        evicted = 0
+
+        # Rooms are in access order, so stop at the first room that is still fresh
+        while self._rooms:
+            room_id = next(iter(self._rooms))
+            if self._last_access.get(room_id, 0) > cutoff:
+                break
+            self.remove(room_id)
+            evicted += 1
+
+        if evicted:
+            self.ttl_evictions += evicted
+            logger.info("Evicted %d idle rooms", evicted)
+
+        return evicted
+
+    def _maybe_sweep(self):
+        if time.monotonic() - self._last_sweep >= self.sweep_interval_sec:
+            self.evict_expired()
+
+    def _enforce_memory_cap(self):
+        if self.max_message_bytes <= 0:
+            return
+
+        # Never evict the most recently used room, it is the one being served
+        while self.total_bytes > self.max_message_bytes and len(self._rooms) > 1:
+            room_id = next(iter(self._rooms))
+            self.remove(room_id)
+            self.memory_evictions += 1
+            logger.info("Evicted room %s to stay under the message memory cap", room_id)
+
+    def stats(self) -> dict:
+        return {
+            "rooms": len(self._rooms),
+            "conversations": len(self._conversations),
+            "message_bytes": self.total_bytes,
+            "ttl_evictions": self.ttl_evictions,
+            "memory_evictions": self.memory_evictions,
+        }
+
+
+rooms = RoomRegistry(
+    idle_ttl_sec=config.ROOM_IDLE_TTL_SEC,
+    max_message_bytes=config.ROOM_MAX_MESSAGE_BYTES,
+    sweep_interval_sec=config.ROOM_SWEEP_INTERVAL_SEC,
+)
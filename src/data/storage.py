@@ -0,0 +1,406 @@
+import asyncio
+import logging
+import sqlite3
+import time
+import uuid
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Callable
+from src.config import config
+from src.services import json_codec
+from src.services.metrics import registry
+from src.room.models import Conversation, GenerationSettings, Message, Room
+
+logger = logging.getLogger(__name__)
+
+STORAGE_WRITE_FAILURES = registry.counter(
+    "storage_write_failures_total", "Storage writes that failed, their data was not stored"
+)
+
+
+class RoomStorage(ABC):
+    """
+    Persistent storage behind RoomService.
+    The room registry keeps hot rooms on the heap, storage keeps every room and
+    lets cold rooms be loaded back on demand.
+
+    Writes return at once and reads are awaited, so that backends doing I/O can run
+    both off the event loop. A read sees every write made before it. Saving a room
+    is awaited like a read, so that other processes can load it once it is created.
+    """
+
+    # Error of the latest write if it failed, cleared by the next successful one
+    write_error: str | None = None
+
+    @abstractmethod
+    async def save_room(self, room):
+        """Persist a newly created room with its (empty) conversations, committed on return"""
+
+    @abstractmethod
+    async def load_room(self, room_id):
+        """Return the room with full message histories or None if it does not exist"""
+
+    @abstractmethod
+    def append_message(self, conversation_id, role: str, content: str):
+        """Append a single message to a conversation history"""
+
+    @abstractmethod
+    def remove_last_message(self, conversation_id):
+        """Remove the latest message of a conversation, used to drop a cancelled prompt"""
+
+    async def message_count(self, conversation_id) -> int | None:
+        """Number of stored messages of a conversation, None if the backend cannot tell"""
+        return None
+
+    async def load_messages(self, conversation_id) -> list:
+        """Full message history of a conversation"""
+        return []
+
+    def save_settings(self, room_id, settings: GenerationSettings):
+        """Replace the generation settings of a room"""
+
+    async def load_settings(self, room_id) -> GenerationSettings | None:
+        """Generation settings of a room, None if the backend does not keep them"""
+        return None
+
+    def append_turn_metrics(self, conversation_id, record: dict):
+        """Append the metrics record of one generation of a conversation"""
+
+    async def load_turn_metrics(self, conversation_id) -> list | None:
+        """Metrics records of a conversation, None if the backend does not keep them"""
+        return None
+
+    async def acquire_lease(self, name: str, owner: str, ttl_sec: float) -> bool:
+        """
+        Take or renew a named lease shared by all processes using the storage.
+        Backends that are not shared between processes always grant it.
+        """
+        return True
+
+    def release_lease(self, name: str, owner: str):
+        """Release a lease taken with acquire_lease"""
+
+    def close(self):
+        """Finish pending writes and release storage resources"""
+
+
+class MemoryStorage(RoomStorage):
+    """Default backend, rooms only live in the in-memory registry"""
+
+    async def save_room(self, room):
+        pass
+
+    async def load_room(self, room_id):
+        return None
+
+    def append_message(self, conversation_id, role: str, content: str):
+        pass
+
+    def remove_last_message(self, conversation_id):
+        pass
+
+
+class SQLiteStorage(RoomStorage):
+    """
+    SQLite backend in WAL mode.
+    Messages are stored in an append-only table, one row per message,
+    so a turn costs two small inserts regardless of the history length.
+
+    Every statement runs on one storage thread in the order of the calls, like the
+    span exporter: sqlite3 blocks while another worker process holds the write lock,
+    which must not stall the event loop. Writes are queued, a failed write is logged,
+    counted and reported by /readyz. Rooms are inserted before the create request returns.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS rooms (
+            id TEXT PRIMARY KEY,
+            created_at TEXT NOT NULL,
+            settings TEXT
+        );
+        CREATE TABLE IF NOT EXISTS conversations (
+            id TEXT PRIMARY KEY,
+            room_id TEXT NOT NULL REFERENCES rooms(id),
+            position INTEGER NOT NULL,
+            model TEXT,
+            created_at TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS conversations_room_id ON conversations(room_id);
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id TEXT NOT NULL REFERENCES conversations(id),
+            role TEXT NOT NULL,
+            content TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS messages_conversation_id ON messages(conversation_id, id);
+        CREATE TABLE IF NOT EXISTS turn_metrics (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id TEXT NOT NULL REFERENCES conversations(id),
+            record TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS turn_metrics_conversation_id
+            ON turn_metrics(conversation_id, id);
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path: str, busy_timeout_sec: float = 2.0):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        # Several worker processes may write at once, wait a little for their locks
+        self._conn = sqlite3.connect(
+            path, timeout=busy_timeout_sec, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # WAL + NORMAL only fsyncs on checkpoints, a crash can lose the last commits but never corrupts
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        self._migrate()
+        self._thread_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+    def _migrate(self):
+        """Add columns introduced after a database was created"""
+
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(rooms)")}
+        if "settings" not in columns:
+            try:
+                self._conn.execute("ALTER TABLE rooms ADD COLUMN settings TEXT")
+            except sqlite3.OperationalError:
+                # Another worker migrated the database in the meantime
+                pass
+
+    def _write(self, fn: Callable, *args) -> Future:
+        """Queue a write on the storage thread, its future can be awaited to wait for the commit"""
+
+        future = self._thread_pool.submit(fn, *args)
+        future.add_done_callback(self._write_done)
+        return future
+
+    def _write_done(self, future: Future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is None:
+            self.write_error = None
+            return
+        STORAGE_WRITE_FAILURES.inc()
+        self.write_error = str(error)
+        logger.error("Storage write failed: %s", error)
+
+    def _execute(self, sql: str, parameters: tuple = ()) -> sqlite3.Cursor:
+        return self._conn.execute(sql, parameters)
+
+    async def _run(self, fn: Callable, *args):
+        """Run a statement on the storage thread, after the writes queued before it"""
+
+        return await asyncio.wrap_future(self._thread_pool.submit(fn, *args))
+
+    async def save_room(self, room):
+        conversations = [
+            (
+                str(conversation.id),
+                str(room.id),
+                position,
+                conversation.model,
+                conversation.createdAt.isoformat(),
+            )
+            for position, conversation in enumerate(room.conversations)
+        ]
+        write = self._write(
+            self._save_room,
+            str(room.id),
+            room.settings.model_dump_json(exclude_none=True),
+            conversations,
+        )
+        # A failure fails the create request, the room is not registered
+        await asyncio.wrap_future(write)
+
+    def _save_room(self, room_id: str, settings: str, conversations: list):
+        self._conn.execute("BEGIN")
+        try:
+            self._conn.execute(
+                "INSERT INTO rooms (id, created_at, settings) VALUES (?, ?, ?)",
+                (room_id, datetime.now().isoformat(), settings),
+            )
+            self._conn.executemany(
+                "INSERT INTO conversations (id, room_id, position, model, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                conversations,
+            )
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    async def load_room(self, room_id):
+        rows = await self._run(self._load_room_rows, str(room_id))
+        if rows is None:
+            return None
+
+        room_row, conversation_rows, message_rows = rows
+        try:
+            conversations = [
+                Conversation(
+                    id=uuid.UUID(conversation_id),
+                    model=model,
+                    createdAt=datetime.fromisoformat(created_at),
+                )
+                for conversation_id, model, created_at in conversation_rows
+            ]
+        except ValueError as e:
+            logger.error("Could not restore room %s: %s", room_id, e)
+            return None
+
+        by_id = {str(conversation.id): conversation for conversation in conversations}
+        for conversation_id, role, content in message_rows:
+            by_id[conversation_id].messages.append(Message(role, content))
+
+        return Room(
+            id=uuid.UUID(room_row[0]),
+            conversations=conversations,
+            settings=self._settings(room_row[1]),
+        )
+
+    def _load_room_rows(self, room_id: str):
+        room_row = self._conn.execute(
+            "SELECT id, settings FROM rooms WHERE id = ?", (room_id,)
+        ).fetchone()
+        if room_row is None:
+            return None
+
+        conversation_rows = self._conn.execute(
+            "SELECT id, model, created_at FROM conversations "
+            "WHERE room_id = ? ORDER BY position",
+            (room_row[0],),
+        ).fetchall()
+        message_rows = self._conn.execute(
+            "SELECT m.conversation_id, m.role, m.content FROM messages m "
+            "JOIN conversations c ON c.id = m.conversation_id "
+            "WHERE c.room_id = ? ORDER BY m.id",
+            (room_row[0],),
+        ).fetchall()
+
+        return room_row, conversation_rows, message_rows
+
+    def _settings(self, value: str | None) -> GenerationSettings:
+        if not value:
+            return GenerationSettings()
+        try:
+            return GenerationSettings.model_validate_json(value)
+        except ValueError as e:
+            logger.error("Ignoring invalid room settings %r: %s", value, e)
+            return GenerationSettings()
+
+    def save_settings(self, room_id, settings: GenerationSettings):
+        self._write(
+            self._execute,
+            "UPDATE rooms SET settings = ? WHERE id = ?",
+            (settings.model_dump_json(exclude_none=True), str(room_id)),
+        )
+
+    async def load_settings(self, room_id) -> GenerationSettings | None:
+        row = await self._run(
+            lambda: self._execute(
+                "SELECT settings FROM rooms WHERE id = ?", (str(room_id),)
+            ).fetchone()
+        )
+
+        return None if row is None else self._settings(row[0])
+
+    def append_message(self, conversation_id, role: str, content: str):
+        self._write(
+            self._execute,
+            "INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)",
+            (str(conversation_id), role, content),
+        )
+
+    def remove_last_message(self, conversation_id):
+        self._write(
+            self._execute,
+            "DELETE FROM messages WHERE id = "
+            "(SELECT MAX(id) FROM messages WHERE conversation_id = ?)",
+            (str(conversation_id),),
+        )
+
+    async def message_count(self, conversation_id) -> int | None:
+        row = await self._run(
+            lambda: self._execute(
+                "SELECT COUNT(*) FROM messages WHERE conversation_id = ?",
+                (str(conversation_id),),
+            ).fetchone()
+        )
+
+        return row[0]
+
+    async def load_messages(self, conversation_id) -> list:
+        rows = await self._run(
+            lambda: self._execute(
+                "SELECT role, content FROM messages WHERE conversation_id = ? ORDER BY id",
+                (str(conversation_id),),
+            ).fetchall()
+        )
+
+        return [Message(role, content) for role, content in rows]
+
+    def append_turn_metrics(self, conversation_id, record: dict):
+        self._write(
+            self._execute,
+            "INSERT INTO turn_metrics (conversation_id, record) VALUES (?, ?)",
+            (str(conversation_id), json_codec.dumps_text(record)),
+        )
+
+    async def load_turn_metrics(self, conversation_id) -> list | None:
+        rows = await self._run(
+            lambda: self._execute(
+                "SELECT record FROM turn_metrics WHERE conversation_id = ? ORDER BY id",
+                (str(conversation_id),),
+            ).fetchall()
+        )
+
+        return [json_codec.loads(row[0]) for row in rows]
+
+    async def acquire_lease(self, name: str, owner: str, ttl_sec: float) -> bool:
+        return await self._run(self._acquire_lease, name, owner, ttl_sec)
+
+    def _acquire_lease(self, name: str, owner: str, ttl_sec: float) -> bool:
+        now = time.time()
+        # Taken if free, expired (its holder died) or already ours (renewal)
+        cursor = self._conn.execute(
+            "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, "
+            "expires_at = excluded.expires_at "
+            "WHERE leases.expires_at < ? OR leases.owner = excluded.owner",
+            (name, owner, now + ttl_sec, now),
+        )
+
+        return cursor.rowcount > 0
+
+    def release_lease(self, name: str, owner: str):
+        self._write(
+            self._execute, "DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner)
+        )
+
+    def close(self):
+        # Queued writes go first
+        self._thread_pool.submit(self._conn.close)
+        self._thread_pool.shutdown(wait=True)
+
+
+def create_storage(backend: str, path: str) -> RoomStorage:
+    if config.SHARED_STATE and backend != "sqlite":
+        logger.warning("SHARED_STATE needs a store shared between processes, using SQLite")
+        backend = "sqlite"
+    if backend == "sqlite":
+        logger.info("Using SQLite room storage at %s", path)
+        return SQLiteStorage(path, busy_timeout_sec=config.STORAGE_BUSY_TIMEOUT_SEC)
+    if backend != "memory":
+        logger.warning("Unknown STORAGE_BACKEND '%s', using memory", backend)
+
+    return MemoryStorage()
+
+
+storage = create_storage(config.STORAGE_BACKEND, config.STORAGE_PATH)
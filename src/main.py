@@ -1,46 +1,132 @@
+import asyncio
 import os
+from contextlib import asynccontextmanager
 from pathlib import Path
-from fastapi import FastAPI
-from fastapi.staticfiles import StaticFiles
-from slowapi import _rate_limit_exceeded_handler
-from slowapi.errors import RateLimitExceeded
-from slowapi.middleware import SlowAPIMiddleware
-from src.app_logging import setup_logging
-from src.services.wandb_service import init_wandb
-from src.services.vllm_service import llm
-from src.rate_limiting import limiter
-from src.room import controller as room_controller
+from src.startup import startup_report
+
+with startup_report.phase("import:app"):
+    from fastapi import FastAPI
+    from fastapi.responses import JSONResponse, PlainTextResponse
+    from fastapi.staticfiles import StaticFiles
+    from slowapi import _rate_limit_exceeded_handler
+    from slowapi.errors import RateLimitExceeded
+    from slowapi.middleware import SlowAPIMiddleware
+    from src.app_logging import setup_logging
+    from src.config import config
+    from src.data.generations import generations
+    from src.data.rooms import rooms
+    from src.data.storage import storage
+    from src.services.endpoint_pool import endpoint_pools
+    from src.services.http_client import http_clients
+    from src.services.loop_monitor import loop_monitor
+    from src.services.metrics import LIVE_ROOMS, registry as metrics_registry
+    from src.services.tracing import tracer
+    from src.services.wandb_service import init_wandb, metrics_sink
+    from src.services.vllm_service import (
+        SM_MODEL,
+        engine_factory,
+        engine_registry,
+        inference_executor,
+    )
+    from src.rate_limiting import limiter
+    from src.room import controller as room_controller
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
 setup_logging()
 
-model_name_from_vllm = "unknown_model"
-
-try:
-    if hasattr(llm, "llm_engine") and hasattr(llm.llm_engine, "model_config"):
-        model_name_from_vllm = llm.llm_engine.model_config.model
-    elif hasattr(
-        llm, "model_config"
-    ):  # Fallback for simpler vLLM wrappers or future changes
-        model_name_from_vllm = llm.model_config.model
-except AttributeError:
-    print("Could not retrieve model name from vLLM object for W&B config.")
-
 wandb_config = {
-    "model_name": model_name_from_vllm,
+    "model_name": SM_MODEL,
 }
-init_wandb(project_name="mm-chat-comparison", config=wandb_config)
 
 project_root = Path(__file__).resolve().parent.parent
 static_files_dir = project_root / "interface"
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    if config.LOOP_MONITOR:
+        loop_monitor.start()
+    http_clients.start(endpoint_pools.urls)
+    endpoint_pools.start()
+    # Slow initialization runs in the background, /readyz reports when it is done
+    background_tasks = [
+        asyncio.create_task(
+            asyncio.to_thread(
+                init_wandb, project_name="mm-chat-comparison", config=wandb_config
+            )
+        )
+    ]
+    if config.SM_ENABLED:
+        background_tasks.append(asyncio.create_task(engine_registry.warmup()))
+    startup_report.mark_ready()
+
+    yield
+
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await generations.aclose()
+    await inference_executor.aclose()
+    await endpoint_pools.aclose()
+    await http_clients.aclose()
+    storage.close()
+    metrics_sink.close()
+    tracer.exporter.close()
+    await loop_monitor.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 app.add_middleware(SlowAPIMiddleware)
 
 app.include_router(room_controller.router)
 
+LIVE_ROOMS.set_function(lambda: len(rooms))
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+@limiter.exempt
+def metrics():
+    return PlainTextResponse(
+        metrics_registry.render(), media_type="text/plain; version=0.0.4"
+    )
+
+
+@app.get("/healthz")
+@limiter.exempt
+def healthz():
+    """Liveness: the process is up and serving requests"""
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+@limiter.exempt
+def readyz():
+    """Readiness: every enabled component finished loading and storage writes succeed"""
+    components = {
+        "sm_engine": engine_factory.status,
+        "storage": "failing" if storage.write_error else "ok",
+    }
+    # An engine evicted to make room for another model was ready and loads again on demand
+    ready = storage.write_error is None and engine_factory.status in (
+        engine_factory.READY,
+        engine_factory.DISABLED,
+        engine_factory.EVICTED,
+    )
+
+    return JSONResponse(
+        {
+            "status": "ready" if ready else "not_ready",
+            "components": components,
+            "error": engine_factory.error,
+            "storage_error": storage.write_error,
+            "sm_engines": engine_registry.stats(),
+            "startup": startup_report.as_dict(),
+        },
+        status_code=200 if ready else 503,
+    )
+
+
 app.mount("/", StaticFiles(directory=static_files_dir, html=True), name="static")
@@ -1,4 +1,145 @@
+import math
+import time
+from collections import OrderedDict
+from typing import Dict, Tuple
 from slowapi import Limiter
 from slowapi.util import get_remote_address
+from src.config import config
+from src.services.metrics import registry
 
-limiter = Limiter(key_func=get_remote_address, default_limits=["10/minute"])
+limiter = Limiter(key_func=get_remote_address, default_limits=[config.RATE_LIMIT])
+
+WS_RATE_LIMITED = registry.counter(
+    "ws_rate_limited_total", "WebSocket turns rejected by the token rate limiter", ("scope",)
+)
+
+
+class TokenBucket:
+    """Holds up to `capacity` tokens, refilled continuously at `rate` tokens per second"""
+
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def retry_after(self, cost: float) -> float:
+        """Seconds until `cost` tokens are available, 0 if they are available now"""
+
+        missing = min(cost, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate)
+
+    def consume(self, cost: float):
+        # Going into debt delays the next turn instead of cutting a running generation short
+        self.tokens = max(-self.capacity, self.tokens - cost)
+
+
+class TokenRateLimiter:
+    """
+    Token buckets for WebSocket turns, one per (scope, key) pair, e.g. per client IP
+    and per room. A turn is admitted when every bucket can pay for its prompt tokens,
+    the generated tokens are charged once the reply is known.
+
+    Args:
+        tokens_per_minute: refill rate per scope, a scope with 0 is not limited
+        max_buckets: bucket limit. When it is reached, idle (full) buckets are dropped,
+            then the least recently used ones until 10% of the limit is free again
+    """
+
+    # Share of max_buckets left after pruning, so that pruning runs once per many new keys
+    _PRUNE_TO = 0.9
+
+    def __init__(self, tokens_per_minute: Dict[str, int], max_buckets: int = 10000):
+        self.tokens_per_minute = {
+            scope: rate for scope, rate in tokens_per_minute.items() if rate > 0
+        }
+        self.max_buckets = max_buckets
+        # Least recently used first
+        self._buckets: OrderedDict[Tuple[str, str], TokenBucket] = OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _bucket(self, scope: str, key: str, now: float) -> TokenBucket:
+        bucket = self._buckets.get((scope, key))
+        if bucket is None:
+            if len(self._buckets) >= self.max_buckets:
+                self._prune(now)
+            rate = self.tokens_per_minute[scope]
+            bucket = self._buckets[(scope, key)] = TokenBucket(rate, rate / 60)
+        else:
+            self._buckets.move_to_end((scope, key))
+        bucket.refill(now)
+
+        return bucket
+
+    def _prune(self, now: float):
+        for bucket_key, bucket in list(self._buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self._buckets[bucket_key]
+
+        # Under steady traffic from many keys few buckets are full, forget the idlest ones
+        while self._buckets and len(self._buckets) > self.max_buckets * self._PRUNE_TO:
+            self._buckets.popitem(last=False)
+
+    def acquire(self, keys: Dict[str, str], cost: int) -> Tuple[str, float] | None:
+        """
+        Charge `cost` tokens to the bucket of every scope in `keys`.
+
+        Returns:
+            None if the turn is admitted, otherwise the exhausted scope and the
+            seconds to wait before retrying. Nothing is charged on rejection.
+        """
+        now = time.monotonic()
+        buckets = {
+            scope: self._bucket(scope, key, now)
+            for scope, key in keys.items()
+            if scope in self.tokens_per_minute
+        }
+
+        waits = {scope: bucket.retry_after(cost) for scope, bucket in buckets.items()}
+        scope, wait = max(waits.items(), key=lambda item: item[1], default=(None, 0.0))
+        if wait > 0:
+            WS_RATE_LIMITED.inc(scope=scope)
+            return scope, wait
+
+        for bucket in buckets.values():
+            bucket.consume(cost)
+
+        return None
+
+    def charge(self, keys: Dict[str, str], tokens: int):
+        """Charge tokens spent after admission, e.g. the generated reply"""
+
+        now = time.monotonic()
+        for scope, key in keys.items():
+            if scope in self.tokens_per_minute:
+                self._bucket(scope, key, now).consume(tokens)
+
+
+def rate_limited_frame(scope: str, retry_after_sec: float, **extra) -> dict:
+    """WebSocket frame sent instead of a reply when a turn is over the token budget"""
+
+    retry_after = math.ceil(retry_after_sec)
+    return {
+        "type": "rate_limited",
+        "scope": scope,
+        "retry_after_sec": retry_after,
+        "response": f"Token rate limit exceeded, please retry in {retry_after}s.",
+        **extra,
+    }
+
+
+ws_limiter = TokenRateLimiter(
+    {
+        "ip": config.WS_TOKENS_PER_MINUTE_PER_IP,
+        "room": config.WS_TOKENS_PER_MINUTE_PER_ROOM,
+    }
+)
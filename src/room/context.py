@@ -0,0 +1,207 @@
+import logging
+import math
+from enum import Enum
+from typing import Callable, Dict, List
+from src.config import config
+from .models import Conversation, Message, Role
+
+logger = logging.getLogger(__name__)
+
+# Chat templates add a few tokens of framing around every message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+class ContextPolicy(Enum):
+    """
+    How the request payload is assembled when the history exceeds the token budget:
+        sliding_window - most recent messages that fit the budget
+        system_recent - system messages are always kept, then the most recent messages
+        summary - like system_recent, dropped turns are replaced with a short summary message
+    """
+
+    SLIDING_WINDOW = "sliding_window"
+    SYSTEM_RECENT = "system_recent"
+    SUMMARY = "summary"
+
+
+def _field(message, name: str) -> str:
+    if isinstance(message, dict):
+        return message.get(name, "")
+    return getattr(message, name, "")
+
+
+def extractive_summary(
+    messages: List[dict], max_chars: int = 200, max_total_chars: int = 2000
+) -> str:
+    """Cheap summary of dropped turns: the beginning of the latest dropped messages"""
+
+    lines = []
+    total = 0
+    for message in reversed(messages):
+        content = " ".join(str(_field(message, "content")).split())
+        if len(content) > max_chars:
+            content = content[:max_chars].rstrip() + "..."
+        line = f"{_field(message, 'role')}: {content}"
+        total += len(line)
+        if total > max_total_chars:
+            break
+        lines.append(line)
+
+    return "Summary of the earlier conversation:\n" + "\n".join(reversed(lines))
+
+
+class ContextManager:
+    """
+    Assembles the messages sent to a model so the prompt stays within a token budget.
+    The full history is left untouched in the conversation and storage, only the
+    request payload is trimmed. Token counts are cached per message, so every turn
+    only counts the newly appended messages.
+    """
+
+    def __init__(
+        self,
+        default_budget: int,
+        model_budgets: Dict[str, int] | None = None,
+        policy: ContextPolicy = ContextPolicy.SYSTEM_RECENT,
+        chars_per_token: float = 4.0,
+        tokenizer_name: str | None = None,
+        summarizer: Callable[[List[dict]], str] = extractive_summary,
+    ):
+        self.default_budget = default_budget
+        self.model_budgets = {k: v for k, v in (model_budgets or {}).items() if k and v}
+        self.policy = policy
+        self.chars_per_token = chars_per_token
+        self.summarizer = summarizer
+        self._tokenizer_name = tokenizer_name
+        self._tokenizer = None
+
+    def _get_tokenizer(self):
+        if self._tokenizer is None and self._tokenizer_name:
+            try:
+                from transformers import AutoTokenizer  # pylint: disable=import-outside-toplevel
+
+                self._tokenizer = AutoTokenizer.from_pretrained(self._tokenizer_name)
+            except Exception as e:
+                logger.warning(
+                    "Could not load tokenizer %s, estimating tokens from characters: %s",
+                    self._tokenizer_name,
+                    e,
+                )
+                self._tokenizer_name = None
+
+        return self._tokenizer
+
+    def count_tokens(self, text: str) -> int:
+        tokenizer = self._get_tokenizer()
+        if tokenizer is not None:
+            return len(tokenizer.encode(text, add_special_tokens=False))
+
+        return math.ceil(len(text) / self.chars_per_token)
+
+    def message_tokens(self, message) -> int:
+        return self.count_tokens(str(_field(message, "content"))) + MESSAGE_OVERHEAD_TOKENS
+
+    def budget_for(self, model: str) -> int:
+        return self.model_budgets.get(model, self.default_budget)
+
+    def token_counts(self, conversation: Conversation) -> List[int]:
+        """Return cached token counts, counting only messages appended since the last call"""
+
+        # Cached on the conversation itself so it is freed together with the room
+        counts = conversation._token_counts  # pylint: disable=protected-access
+        messages = conversation.messages
+
+        if len(counts) > len(messages):
+            counts.clear()
+        for message in messages[len(counts):]:
+            counts.append(self.message_tokens(message))
+
+        return counts
+
+    def _summary_message(self, conversation: Conversation, dropped: List[Message]) -> Message:
+        # pylint: disable=protected-access
+        cached = conversation._summary
+        if cached is not None and cached[0] == len(dropped):
+            return cached[1]
+
+        message = Message("system", self.summarizer(dropped))
+        conversation._summary = (len(dropped), message)
+
+        return message
+
+    def build(self, conversation: Conversation, budget: int | None = None) -> List[Message]:
+        """
+        Return the messages to send to the model for the conversation.
+
+        Args:
+            conversation: Conversation with the full message history
+            budget: prompt token budget, defaults to the budget configured for the conversation model
+
+        Returns:
+            List of messages, the latest message is always included
+        """
+        messages = conversation.messages
+        counts = self.token_counts(conversation)
+        budget = self.budget_for(conversation.model) if budget is None else budget
+
+        if budget <= 0 or sum(counts) <= budget or not messages:
+            return list(messages)
+
+        keep_system = self.policy != ContextPolicy.SLIDING_WINDOW
+        pinned = {
+            i for i, message in enumerate(messages[:-1])
+            if keep_system and _field(message, "role") == "system"
+        }
+        remaining = budget - sum(counts[i] for i in pinned)
+
+        # Walk back from the latest message and keep as many recent messages as fit
+        recent_start = len(messages) - 1
+        remaining -= counts[recent_start]
+        while recent_start > 0:
+            i = recent_start - 1
+            if i not in pinned and counts[i] > remaining:
+                break
+            if i not in pinned:
+                remaining -= counts[i]
+            recent_start = i
+
+        # A turn should not start with an orphaned assistant reply
+        while (
+            recent_start < len(messages) - 1
+            and _field(messages[recent_start], "role") == Role.ASSISTANT.value
+        ):
+            recent_start += 1
+
+        payload = [messages[i] for i in sorted(pinned) if i < recent_start]
+
+        if self.policy == ContextPolicy.SUMMARY:
+            dropped = [
+                messages[i] for i in range(recent_start) if i not in pinned
+            ]
+            if dropped:
+                summary = self._summary_message(conversation, dropped)
+                if self.message_tokens(summary) <= remaining:
+                    payload.append(summary)
+
+        payload.extend(messages[recent_start:])
+
+        return payload
+
+
+def _parse_policy(value: str) -> ContextPolicy:
+    try:
+        return ContextPolicy(value)
+    except ValueError:
+        logger.warning("Unknown CONTEXT_POLICY '%s', using system_recent", value)
+        return ContextPolicy.SYSTEM_RECENT
+
+
+context_manager = ContextManager(
+    default_budget=config.CONTEXT_TOKEN_BUDGET,
+    model_budgets={
+        config.MODEL1: config.MODEL1_CONTEXT_TOKEN_BUDGET,
+        config.MODEL2: config.MODEL2_CONTEXT_TOKEN_BUDGET,
+    },
+    policy=_parse_policy(config.CONTEXT_POLICY),
+    tokenizer_name=config.CONTEXT_TOKENIZER,
+)
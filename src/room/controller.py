@@ -1,5 +1,10 @@
+import asyncio
+import functools
 import logging
+import uuid
+from contextlib import AsyncExitStack, aclosing, asynccontextmanager
 from pathlib import Path
+from typing import AsyncIterator, List, Tuple
 from fastapi import (
     APIRouter,
     Depends,
@@ -9,7 +14,17 @@ from fastapi import (
     status,
 )
 from fastapi.responses import HTMLResponse, FileResponse
-from src.room.models import Room, ChatMode
+from pydantic import ValidationError
+from src.config import config
+from src.data.generations import Generation, Publish, generations
+from src.data.room_locks import room_locks
+from src.rate_limiting import rate_limited_frame, ws_limiter
+from src.services import json_codec
+from src.services.circuit_breaker import ModelUnavailableError
+from src.services.metrics import ACTIVE_WEBSOCKETS, WS_RESUMES
+from src.services.tracing import tracer
+from src.room.exceptions import ErrorMessages, NotFoundError
+from src.room.models import Conversation, GenerationSettings, Room, ChatMode
 from src.room.room_service import RoomService
 
 logger = logging.getLogger(__name__)
@@ -25,17 +40,313 @@ def get_room():
     return Room()
 
 
+async def send_frame(websocket: WebSocket, frame: dict):
+    """Send a JSON text frame, encoded with the fast JSON codec instead of json.dumps"""
+
+    if frame.get("type") == "delta":
+        await websocket.send_text(json_codec.dumps_text(frame))
+        return
+
+    with tracer.span("ws.send", frame=frame.get("type")):
+        await websocket.send_text(json_codec.dumps_text(frame))
+
+
+def parse_turn(data: str) -> Tuple[str, GenerationSettings | None]:
+    """
+    A turn message is either the plain prompt or a JSON object carrying generation
+    settings for this turn only: {"prompt": "...", "settings": {"latency_budget_ms": 2000}}
+
+    Raises:
+        pydantic.ValidationError: if the settings are invalid
+    """
+    if not data.startswith("{"):
+        return data, None
+
+    try:
+        payload = json_codec.loads(data)
+    except ValueError:
+        return data, None
+
+    # Any other JSON is a prompt like every other text
+    if not isinstance(payload, dict) or not isinstance(payload.get("prompt"), str):
+        return data, None
+
+    settings = payload.get("settings")
+    if settings is None:
+        return payload["prompt"], None
+
+    return payload["prompt"], GenerationSettings.model_validate(settings)
+
+
+def invalid_settings_frame(error: ValidationError, **extra) -> dict:
+    """Frame sent instead of a reply when the settings of a turn do not validate"""
+
+    return {
+        "type": "error",
+        "response": ErrorMessages.INVALID_SETTINGS.value,
+        "errors": error.errors(include_url=False, include_context=False, include_input=False),
+        **extra,
+    }
+
+
+def ws_limit_keys(websocket: WebSocket, room_id: str) -> dict:
+    """Token rate limiter buckets charged for turns on this connection"""
+
+    client_ip = websocket.client.host if websocket.client else "unknown"
+    return {"ip": client_ip, "room": room_id}
+
+
+async def forward_frames(websocket: WebSocket, frames: AsyncIterator[dict]):
+    async with aclosing(frames):
+        async for frame in frames:
+            await send_frame(websocket, frame)
+
+
+async def follow_turn(
+    websocket: WebSocket,
+    generation: Generation,
+    next_message: asyncio.Task,
+    last_seq: int = -1,
+) -> str | None:
+    """
+    Send the frames of a turn after `last_seq` until it finishes, the client sends the
+    next prompt or disconnects. A new prompt cancels the turn, which closes the upstream
+    HTTP request or aborts the engine request, and its last frames are still sent.
+    After a disconnect the turn goes on for the client to resume it, see Generation.
+
+    Args:
+        generation: the running or finished turn
+        next_message: pending receive of the next client message
+        last_seq: sequence number of the last frame the client already has
+
+    Returns:
+        None if the turn finished, otherwise the cancellation reason:
+        "disconnect", "superseded" or "deadline". A turn cancelled by a lost room lock
+        ends with its cancelled frames
+    """
+    forwarding = asyncio.ensure_future(
+        forward_frames(websocket, generation.follow(last_seq))
+    )
+
+    try:
+        done, _ = await asyncio.wait(
+            {forwarding, next_message}, return_when=asyncio.FIRST_COMPLETED
+        )
+    except asyncio.CancelledError:
+        forwarding.cancel()
+        raise
+
+    if forwarding in done:
+        forwarding.result()
+        # Re-raise errors of the turn in the handler
+        generation.result()
+        return generation.cancelled
+
+    if next_message.exception() is not None:
+        forwarding.cancel()
+        await asyncio.gather(forwarding, return_exceptions=True)
+        return "disconnect"
+
+    generation.cancel("superseded")
+    await forwarding
+    return generation.cancelled
+
+
+async def resume_turn(
+    websocket: WebSocket, key: str, last_seq: int, **extra
+) -> asyncio.Task | None:
+    """
+    Send the frames a reconnecting client missed, then follow the turn if it still runs.
+    A client whose missed frames are no longer kept gets a "resume_unavailable" frame.
+
+    Returns:
+        The pending receive of the next client message, if a turn was followed
+    """
+    resumed = generations.resume(key, last_seq)
+    if resumed is None:
+        WS_RESUMES.inc(outcome="unavailable")
+        await send_frame(
+            websocket, {"type": "resume_unavailable", "last_seq": last_seq, **extra}
+        )
+        return None
+
+    WS_RESUMES.inc(outcome="resumed")
+    previous_frames, generation = resumed
+    for frame in previous_frames:
+        await send_frame(websocket, frame)
+
+    next_message = asyncio.create_task(websocket.receive_text())
+    await follow_turn(websocket, generation, next_message, last_seq)
+
+    return next_message
+
+
+def cancelled_frame(conversation: Conversation, reason: str, **extra) -> dict:
+    """Final frame of a turn cancelled by a superseding prompt, the deadline or a lost room lock"""
+
+    if reason == "superseded":
+        response = ErrorMessages.TURN_SUPERSEDED.value
+    elif reason == room_locks.LOCK_LOST:
+        response = ErrorMessages.TURN_LOCK_LOST.value
+    else:
+        response = ErrorMessages.TURN_DEADLINE_EXCEEDED.value
+
+    return {
+        "conversation_id": str(conversation.id),
+        "type": "done",
+        "response": response,
+        "error": True,
+        "cancelled": reason,
+        **extra,
+    }
+
+
+@asynccontextmanager
+async def locked_turn(
+    publish: Publish,
+    conversation_service: RoomService,
+    conversations: List[Conversation],
+):
+    """
+    Hold the room lock for a turn. A cancelled turn drops its unanswered prompts
+    and tells the client why before the lock is released, so no other turn
+    can slip in between.
+    """
+    async with AsyncExitStack() as stack:
+        with tracer.span("room.lock"):
+            await stack.enter_async_context(
+                room_locks.hold(conversation.id for conversation in conversations)
+            )
+        await conversation_service.refresh_conversations(conversations)
+        try:
+            yield
+        except asyncio.CancelledError as e:
+            reason = e.args[0] if e.args else "disconnect"
+            if reason == room_locks.LOCK_LOST:
+                # Another worker writes the conversations now, their history is reloaded
+                # by the next turn, see refresh_conversations
+                for conversation in conversations:
+                    publish(cancelled_frame(conversation, reason, model=conversation.model))
+                raise
+            discarded = conversation_service.discard_unanswered_prompts(conversations)
+            if reason in ("superseded", "deadline"):
+                for conversation in discarded:
+                    publish(cancelled_frame(conversation, reason, model=conversation.model))
+            raise
+
+
+async def conversation_turn(
+    publish: Publish,
+    conversation_service: RoomService,
+    mode: ChatMode,
+    conversation: Conversation,
+    prompt: str,
+    settings: GenerationSettings,
+    limit_keys: dict,
+):
+    """Generate the reply of one conversation and publish its frames"""
+
+    async with locked_turn(publish, conversation_service, [conversation]):
+        await _conversation_reply(
+            publish, conversation_service, mode, conversation, prompt, settings, limit_keys
+        )
+
+
+async def _conversation_reply(
+    publish: Publish,
+    conversation_service: RoomService,
+    mode: ChatMode,
+    conversation: Conversation,
+    prompt: str,
+    settings: GenerationSettings,
+    limit_keys: dict,
+):
+    # Streaming: forward delta frames as they arrive, then a final "done" frame
+    if config.STREAMING:
+        if mode == ChatMode.SINGLE_MODE:
+            frames = conversation_service.stream_response_sm(
+                conversation=conversation, prompt=prompt, settings=settings
+            )
+        else:
+            frames = conversation_service.stream_response_cm(
+                conversation=conversation, prompt=prompt, settings=settings
+            )
+
+        # aclosing: a cancelled turn closes the generator and its upstream stream right away
+        async with aclosing(frames):
+            async for frame in frames:
+                publish(frame)
+        ws_limiter.charge(limit_keys, conversation_service.reply_tokens([conversation]))
+        return
+
+    if mode == ChatMode.SINGLE_MODE:
+        llm_response = await conversation_service.get_response_sm(
+            conversation=conversation, prompt=prompt, settings=settings
+        )
+    else:
+        try:
+            llm_response = await conversation_service.get_response_cm(
+                conversation=conversation, prompt=prompt, settings=settings
+            )
+        except ModelUnavailableError as e:
+            # Fail fast, the client can retry once the breaker lets probes through
+            publish(conversation_service.unavailable_frame(conversation, e))
+            return
+    ws_limiter.charge(limit_keys, conversation_service.reply_tokens([conversation]))
+
+    response_data = {
+        "conversation_id": str(conversation.id),
+        "response": llm_response,
+        "metrics": conversation_service.last_turn_metrics(conversation),
+    }
+    publish(response_data)
+
+
+async def comparison_turn(
+    publish: Publish,
+    conversation_service: RoomService,
+    room: Room,
+    prompt: str,
+    settings: GenerationSettings,
+    limit_keys: dict,
+):
+    """Generate the replies of both models of a comparison room and send their frames"""
+
+    conversations = room.conversations
+
+    async with locked_turn(publish, conversation_service, conversations):
+        frames = conversation_service.compare(room, prompt, settings)
+        async with aclosing(frames):
+            async for frame in frames:
+                publish(frame)
+    ws_limiter.charge(limit_keys, conversation_service.reply_tokens(conversations))
+
+
 router = APIRouter(prefix="/room")
 
 
+# Async so that the room registry is only ever touched from the event loop
 @router.post("/{mode}", response_model=Room, status_code=status.HTTP_201_CREATED)
-def create_new_room(
+async def create_new_room(
     mode: ChatMode,
+    settings: GenerationSettings | None = None,
+    model: str | None = None,
     conversation_service: RoomService = Depends(get_conversation_service),
     room: Room = Depends(get_room),
 ):
+    """`model` picks the in-process model of a single mode room, one of SM_MODELS"""
+    if model is not None and mode != ChatMode.SINGLE_MODE:
+        raise HTTPException(
+            status_code=400,
+            detail={"error": "model can only be chosen in single mode", "status": "error"},
+        )
+
     try:
-        room = conversation_service.create_room(mode, room)
+        room = await conversation_service.create_room(mode, room, settings, model)
+    except NotFoundError as e:
+        raise HTTPException(
+            status_code=404, detail={"error": str(e), "status": "error"}
+        ) from e
     except Exception as e:
         raise HTTPException(
             status_code=500, detail={"error": str(e), "status": "error"}
@@ -44,6 +355,36 @@ def create_new_room(
     return room
 
 
+@router.put("/{room_id}/settings", response_model=GenerationSettings)
+async def update_room_settings(
+    room_id: uuid.UUID,
+    settings: GenerationSettings,
+    conversation_service: RoomService = Depends(get_conversation_service),
+):
+    """Replace the generation settings of a room, turns can still override them"""
+    try:
+        return await conversation_service.update_settings(room_id, settings)
+    except NotFoundError as e:
+        raise HTTPException(
+            status_code=404, detail={"error": str(e), "status": "error"}
+        ) from e
+
+
+# Declared before the room page, whose path would match it too
+@router.get("/{room_id}/stats")
+async def get_room_stats(
+    room_id: uuid.UUID,
+    conversation_service: RoomService = Depends(get_conversation_service),
+):
+    """Generation metrics of a room over its lifetime, per model"""
+    try:
+        return await conversation_service.room_stats(room_id)
+    except NotFoundError as e:
+        raise HTTPException(
+            status_code=404, detail={"error": str(e), "status": "error"}
+        ) from e
+
+
 @router.get("/{mode}/{room_id}", response_model=None)
 def get_room_page() -> FileResponse | HTMLResponse:
     if Path.exists(index_html_path):
@@ -56,44 +397,158 @@ def get_room_page() -> FileResponse | HTMLResponse:
 
 
 # This endpoint is used for both - single and comparison mode
-# In comparison mode 2 separate connections are opened
+# In comparison mode 2 separate connections are opened,
+# compare_conversations below serves both models over one connection
+# While a turn runs the next message is already awaited: a new prompt cancels the running
+# turn, after a disconnect it goes on and a reconnect with ?last_seq= gets the missed frames
 @router.websocket("/ws/{mode}/{room_id}/{conversation_id}")
 async def update_conversation(
     websocket: WebSocket,
     mode: ChatMode,
     room_id: str,
     conversation_id: str,
+    last_seq: int | None = None,
     conversation_service: RoomService = Depends(get_conversation_service),
 ):
     """Update conversation based on mode (single or comparison)"""
     await websocket.accept()
+    ACTIVE_WEBSOCKETS.inc()
+    limit_keys = ws_limit_keys(websocket, room_id)
+    next_message: asyncio.Task | None = None
 
     try:
-        while True:
-            data = await websocket.receive_text()
-            active_room = conversation_service.get_active_room(room_id=room_id)
-            conversation = conversation_service.get_conversation(
-                active_room.conversations, conversation_id
+        if last_seq is not None:
+            # Turns are kept by conversation, replay only the conversations of this room
+            with tracer.span("room.lookup"):
+                await conversation_service.get_conversation(room_id, conversation_id)
+            next_message = await resume_turn(
+                websocket, conversation_id, last_seq, conversation_id=conversation_id
             )
-            llm_response = None
 
-            if mode == ChatMode.SINGLE_MODE:
-                llm_response = conversation_service.get_response_sm(
-                    conversation=conversation, prompt=data
-                )
-            else:
-                llm_response = await conversation_service.get_response_cm(
-                    conversation=conversation, prompt=data
+        while True:
+            data = await (next_message or websocket.receive_text())
+            next_message = None
+            with tracer.trace("ws.turn", mode=mode.value, room_id=room_id):
+                try:
+                    prompt, turn_settings = parse_turn(data)
+                except ValidationError as e:
+                    await send_frame(
+                        websocket, invalid_settings_frame(e, conversation_id=conversation_id)
+                    )
+                    continue
+
+                with tracer.span("room.lookup"):
+                    conversation = await conversation_service.get_conversation(
+                        room_id, conversation_id
+                    )
+                    settings = await conversation_service.generation_settings(
+                        await conversation_service.get_active_room(room_id), turn_settings
+                    )
+
+                with tracer.span("rate_limit"):
+                    cost = conversation_service.prompt_tokens([conversation], prompt)
+                    rejected = ws_limiter.acquire(limit_keys, cost)
+                if rejected:
+                    await send_frame(
+                        websocket,
+                        rate_limited_frame(*rejected, conversation_id=conversation_id),
+                    )
+                    continue
+
+                generation = await generations.start(
+                    conversation_id,
+                    functools.partial(
+                        conversation_turn,
+                        conversation_service=conversation_service,
+                        mode=mode,
+                        conversation=conversation,
+                        prompt=prompt,
+                        settings=settings,
+                        limit_keys=limit_keys,
+                    ),
                 )
+                next_message = asyncio.create_task(websocket.receive_text())
+                reason = await follow_turn(websocket, generation, next_message)
+                if reason:
+                    tracer.current_span().set(cancelled=reason)
+
+    except WebSocketDisconnect:
+        logger.error("Client disconnected")
+    except Exception as e:
+        logger.error("Error: %s", e)
+        await websocket.close(code=1011)
+    finally:
+        if next_message is not None:
+            next_message.cancel()
+        ACTIVE_WEBSOCKETS.dec()
 
-            response_data = {
-                "conversation_id": conversation_id,
-                "response": llm_response,
-            }
-            await websocket.send_json(response_data)
+
+# Comparison mode over a single connection: one prompt per turn is sent to both models
+# concurrently and their frames are multiplexed, tagged with "model" and "conversation_id"
+@router.websocket("/ws/cm/{room_id}")
+async def compare_conversations(
+    websocket: WebSocket,
+    room_id: str,
+    last_seq: int | None = None,
+    conversation_service: RoomService = Depends(get_conversation_service),
+):
+    """Run a comparison turn against both models of the room"""
+    await websocket.accept()
+    ACTIVE_WEBSOCKETS.inc()
+    limit_keys = ws_limit_keys(websocket, room_id)
+    next_message: asyncio.Task | None = None
+    key = f"cm:{room_id}"
+
+    try:
+        if last_seq is not None:
+            next_message = await resume_turn(websocket, key, last_seq)
+
+        while True:
+            data = await (next_message or websocket.receive_text())
+            next_message = None
+            with tracer.trace("ws.turn", mode="cm", room_id=room_id):
+                try:
+                    prompt, turn_settings = parse_turn(data)
+                except ValidationError as e:
+                    await send_frame(websocket, invalid_settings_frame(e))
+                    continue
+
+                with tracer.span("room.lookup"):
+                    active_room = await conversation_service.get_active_room(room_id=room_id)
+                    settings = await conversation_service.generation_settings(
+                        active_room, turn_settings
+                    )
+
+                conversations: List[Conversation] = active_room.conversations
+                with tracer.span("rate_limit"):
+                    cost = conversation_service.prompt_tokens(conversations, prompt)
+                    rejected = ws_limiter.acquire(limit_keys, cost)
+                if rejected:
+                    await send_frame(websocket, rate_limited_frame(*rejected))
+                    continue
+
+                generation = await generations.start(
+                    key,
+                    functools.partial(
+                        comparison_turn,
+                        conversation_service=conversation_service,
+                        room=active_room,
+                        prompt=prompt,
+                        settings=settings,
+                        limit_keys=limit_keys,
+                    ),
+                )
+                next_message = asyncio.create_task(websocket.receive_text())
+                reason = await follow_turn(websocket, generation, next_message)
+                if reason:
+                    tracer.current_span().set(cancelled=reason)
 
     except WebSocketDisconnect:
         logger.error("Client disconnected")
     except Exception as e:
         logger.error("Error: %s", e)
         await websocket.close(code=1011)
+    finally:
+        if next_message is not None:
+            next_message.cancel()
+        ACTIVE_WEBSOCKETS.dec()
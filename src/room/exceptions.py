@@ -3,8 +3,14 @@ from enum import Enum
 
 class ErrorMessages(Enum):
     SM_MODE_CONFIG_ERROR = "Model is not configured"
+    SM_MODE_DISABLED_ERROR = "Single mode is disabled on this server"
     CM_MODE_CONFIG_ERROR = "One of the models is not configured"
     LLM_ERROR_RESPONSE = "Sorry, I couldn't generate a response at the moment."
+    TURN_SUPERSEDED = "Cancelled, a newer prompt replaced this one."
+    TURN_DEADLINE_EXCEEDED = "Sorry, the response took too long and was cancelled."
+    TURN_LOCK_LOST = "Cancelled, another session took over this conversation."
+    MODEL_UNAVAILABLE = "The model is temporarily unavailable, please try again shortly."
+    INVALID_SETTINGS = "Invalid generation settings, the prompt was not sent."
 
 
 class NotFoundError(Exception):
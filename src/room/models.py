@@ -1,24 +1,113 @@
+import sys
 import uuid
 from enum import Enum
-from typing import List, Literal
+from typing import List, Literal, Tuple
 from datetime import datetime
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
+from pydantic_core import core_schema
 from src.config import config
+from src.services import json_codec
 
 
-class Message(BaseModel):
-    """Represents a message in the conversation with LLM."""
+class Message:
+    """
+    Represents a message in the conversation with LLM.
+
+    A slotted record rather than a dict or pydantic model, long histories hold many
+    of them. Roles are interned so all messages share a handful of role strings.
+    The JSON encoding is computed once and reused by every request of the conversation.
+    """
+
+    __slots__ = ("role", "content", "_encoded")
+
+    def __init__(self, role: str, content: str):
+        self.role = sys.intern(str(role))
+        self.content = content
+        self._encoded = None
+
+    @property
+    def encoded(self) -> bytes:
+        if self._encoded is None:
+            self._encoded = json_codec.dumps({"role": self.role, "content": self.content})
+        return self._encoded
+
+    def to_dict(self) -> dict:
+        return {"role": self.role, "content": self.content}
+
+    def __eq__(self, other):
+        if not isinstance(other, Message):
+            return NotImplemented
+        return self.role == other.role and self.content == other.content
+
+    def __repr__(self):
+        return f"Message(role={self.role!r}, content={self.content!r})"
+
+    @classmethod
+    def _validate(cls, value):
+        if isinstance(value, cls):
+            return value
+        if isinstance(value, dict):
+            return cls(value["role"], value["content"])
+        raise ValueError("message must be a Message or a dict with role and content")
+
+    @classmethod
+    def __get_pydantic_core_schema__(cls, _source, _handler):
+        return core_schema.no_info_plain_validator_function(
+            cls._validate,
+            serialization=core_schema.plain_serializer_function_ser_schema(cls.to_dict),
+        )
 
-    role: str
-    content: str
-    # timestamp: datetime # Example if you add timestamp
+    @classmethod
+    def __get_pydantic_json_schema__(cls, _core_schema, _handler):
+        return {
+            "type": "object",
+            "properties": {"role": {"type": "string"}, "content": {"type": "string"}},
+            "required": ["role", "content"],
+        }
+
+
+class GenerationSettings(BaseModel):
+    """
+    Sampling settings of a room or of a single turn. Unset fields fall back to the
+    room settings and then to the defaults of the chat mode.
+
+    latency_budget_ms turns on deadline mode: max_tokens is derived from the measured
+    prefill and decode rates of the model so that the reply fits the budget,
+    max_tokens then only caps it.
+    """
+
+    temperature: float | None = Field(default=None, ge=0, le=2)
+    top_p: float | None = Field(default=None, gt=0, le=1)
+    max_tokens: int | None = Field(default=None, ge=1)
+    latency_budget_ms: float | None = Field(default=None, gt=0)
+
+    def merged(self, override: "GenerationSettings | None") -> "GenerationSettings":
+        """Return a copy with the fields set in `override` replacing ours"""
+
+        if override is None:
+            return self
+        return self.model_copy(update=override.model_dump(exclude_none=True))
 
 
 class Conversation(BaseModel):
     id: uuid.UUID = Field(default_factory=uuid.uuid4)
-    model: Literal[config.MODEL1, config.MODEL2] = Field(default=config.MODEL1)
+    # Comparison mode models, or the in-process model of a single mode room
+    model: Literal[(config.MODEL1, config.MODEL2, *config.SM_MODELS)] = Field(
+        default=config.MODEL1
+    )
     messages: List[Message] = Field(default_factory=list)
     createdAt: datetime = Field(default_factory=datetime.now)
+    # Context manager caches, never serialized
+    _token_counts: List[int] = PrivateAttr(default_factory=list)
+    _summary: Tuple[int, Message] | None = PrivateAttr(default=None)
+    # Metrics records of the generations of this worker, see src/services/turn_metrics.py
+    _turn_metrics: List[dict] = PrivateAttr(default_factory=list)
+
+    def clear_caches(self):
+        """Drop derived per-message caches, call after the history is replaced"""
+
+        self._token_counts.clear()
+        self._summary = None
 
 
 class ChatMode(Enum):
@@ -47,3 +136,4 @@ class Room(BaseModel):
 
     id: uuid.UUID = Field(default_factory=uuid.uuid4)
     conversations: List[Conversation] = Field(default_factory=list)
+    settings: GenerationSettings = Field(default_factory=GenerationSettings)
@@ -1,60 +1,219 @@
+import asyncio
+import math
+import time
 import uuid
 import logging
-from typing import List
+from contextlib import aclosing
+from typing import AsyncIterator, List, Tuple
 import httpx
 from src.config import config
 from src.data.rooms import rooms
-from src.services.vllm_service import VLLMService
+from src.data.storage import storage
+from src.services.circuit_breaker import REQUEST_RETRIES, ModelUnavailableError, backoff_sec
+from src.services.endpoint_pool import endpoint_pools
+from src.services import json_codec
+from src.services.http_client import http_clients
+from src.services.metrics import (
+    REQUEST_ERRORS,
+    REQUEST_TIMEOUTS,
+    REQUESTS_CANCELLED,
+    REQUESTS_IN_FLIGHT,
+    observe_generation,
+)
+from src.services.response_cache import response_cache
+from src.services.throughput import throughput
+from src.services.tracing import traced, tracer
+from src.services.turn_metrics import (
+    TIMING_FIELDS,
+    TokenTimer,
+    aggregate,
+    comparison_summary,
+    request_output_timing,
+    turn_metrics,
+)
+from src.services.vllm_service import SM_MODEL, VLLMService, engine_registry
 from src.services.wandb_service import log_vllm_request_output_metrics
-from .models import Conversation, Message, Role, Room, ChatMode
+from .context import context_manager
+from .models import Conversation, GenerationSettings, Message, Role, Room, ChatMode
 from .exceptions import NotFoundError, ErrorMessages
 
 
 logger = logging.getLogger(__name__)
 vllm_service = VLLMService()
 
+JSON_HEADERS = {"Content-Type": "application/json"}
+# The server or a proxy in front of it is down or overloaded, nothing was generated
+RETRYABLE_STATUS_CODES = {502, 503, 504}
+
+
+def sm_model(conversation: Conversation) -> str:
+    """In-process model of a single mode conversation, SM_MODEL for rooms created without one"""
+
+    if conversation.model in engine_registry.models:
+        return conversation.model
+    return SM_MODEL
+
 
 class RoomService:
 
-    def create_room(self, mode: ChatMode, room=Room):
-        """Create new room object"""
+    async def create_room(
+        self,
+        mode: ChatMode,
+        room=Room,
+        settings: GenerationSettings | None = None,
+        model: str | None = None,
+    ):
+        """
+        Create new room object, optionally with its generation settings
+
+        Args:
+            mode: Chat mode of the room
+            room: Room object to fill
+            settings: Generation settings of the room
+            model: Model of a single mode room, one of SM_MODELS, SM_MODEL by default
+
+        Returns:
+            Room: the created room
+
+        Raises:
+            NotFoundError: if the model is not one of SM_MODELS
+        """
 
         if ChatMode.SINGLE_MODE and not config.MODEL1:
             raise ValueError(ErrorMessages.SM_MODE_CONFIG_ERROR)
 
+        if mode == ChatMode.SINGLE_MODE and not config.SM_ENABLED:
+            raise ValueError(ErrorMessages.SM_MODE_DISABLED_ERROR.value)
+
         if ChatMode.COMPARISON_MODE and not (config.MODEL1 or config.MODEL2):
             raise ValueError(ErrorMessages.CM_MODE_CONFIG_ERROR)
 
+        if model is not None and model not in engine_registry.models:
+            raise NotFoundError("Model", "name", model)
+
         if mode == ChatMode.SINGLE_MODE:
-            room.conversations = [Conversation(model=config.MODEL1)]
+            room.conversations = [Conversation(model=model or SM_MODEL)]
         else:
             room.conversations = [
                 Conversation(model=config.MODEL1),
                 Conversation(model=config.MODEL2),
             ]
 
-        rooms.append(room)
+        if settings is not None:
+            room.settings = settings
+
+        # Committed before the room is returned, so any worker can open it right away
+        await storage.save_room(room)
+        rooms.add(room)
 
         return room
 
-    def get_active_room(self, room_id: uuid.UUID) -> Room:
+    async def load_room(self, room_id: uuid.UUID) -> Room | None:
+        """Return room from the in-memory registry, loading it from storage on a miss"""
+
+        room_obj = rooms.get(room_id)
+
+        if room_obj is None:
+            loaded = await storage.load_room(room_id)
+            # Another turn may have loaded it in the meantime, its conversations are in use
+            room_obj = rooms.get(room_id)
+            if room_obj is None and loaded is not None:
+                room_obj = rooms.add(loaded)
+
+        return room_obj
+
+    async def get_active_room(self, room_id: uuid.UUID) -> Room:
         """Return current active room"""
 
-        room_obj = next((room for room in rooms if str(room.id) == room_id), None)
+        room_obj = await self.load_room(room_id)
 
         if room_obj is None:
             raise NotFoundError("Room", "id", room_id)
 
         return room_obj
 
-    def get_conversation(
-        self, conversations, conversation_id: uuid.UUID
-    ) -> List[List[Message]]:
+    async def update_settings(
+        self, room_id: uuid.UUID, settings: GenerationSettings
+    ) -> GenerationSettings:
+        """Replace the generation settings of a room, they apply from the next turn on"""
+
+        room_obj = await self.get_active_room(room_id)
+        room_obj.settings = settings
+        storage.save_settings(room_obj.id, settings)
+
+        return room_obj.settings
+
+    async def generation_settings(
+        self, room: Room, override: GenerationSettings | None = None
+    ) -> GenerationSettings:
+        """
+        Settings of the next turn in a room
+
+        Args:
+            room: Room the turn runs in
+            override: Settings sent with the turn, they take precedence over the room settings
+
+        Returns:
+            GenerationSettings: room settings with the turn override applied
+        """
+        if config.SHARED_STATE:
+            # Another worker may have updated them
+            stored = await storage.load_settings(room.id)
+            if stored is not None:
+                room.settings = stored
+
+        return room.settings.merged(override)
+
+    async def room_stats(self, room_id: uuid.UUID) -> dict:
+        """
+        Generation metrics of a room aggregated over its lifetime
+
+        Args:
+            room_id: ID of the room
+
+        Returns:
+            dict: per conversation its model, turns, errors, token counts and
+            mean / p50 / p95 of every timing field, and which conversation did
+            better on the medians. Keyed by conversation, both may run the same model
+
+        Raises:
+            NotFoundError: If the room does not exist
+        """
+        room_obj = await self.get_active_room(room_id)
+
+        conversations = {}
+        for conversation in room_obj.conversations:
+            # With SQLite every worker's records are stored, otherwise only this worker's
+            stored = await storage.load_turn_metrics(conversation.id)
+            records = (
+                stored if stored is not None
+                else conversation._turn_metrics  # pylint: disable=protected-access
+            )
+            conversations[str(conversation.id)] = {
+                "model": conversation.model,
+                **aggregate(records),
+            }
+
+        return {
+            "room_id": str(room_obj.id),
+            "conversations": conversations,
+            "comparison": comparison_summary(
+                {
+                    side: {field: stats[field]["p50"] for field in TIMING_FIELDS}
+                    for side, stats in conversations.items()
+                }
+            ),
+        }
+
+    async def get_conversation(
+        self, room_id: uuid.UUID, conversation_id: uuid.UUID
+    ) -> Conversation:
         """Return current active conversation"""
 
-        conversation = next(
-            (conv for conv in conversations if str(conv.id) == conversation_id), None
-        )
+        conversation = rooms.get_conversation(room_id, conversation_id)
+
+        if conversation is None and await self.load_room(room_id) is not None:
+            conversation = rooms.get_conversation(room_id, conversation_id)
 
         if conversation is None:
             raise NotFoundError("Conversation", "id", conversation_id)
@@ -64,7 +223,7 @@ class RoomService:
     def message_constructor(self, role: Role, content: str) -> Message:
         """Return appropriate Message object for conversation format"""
 
-        return {"role": role, "content": content}
+        return Message(role, content)
 
     def update_conversation(
         self,
@@ -74,36 +233,224 @@ class RoomService:
     ) -> List[Message]:
         """Update conversation object with new messages from user and LLM outputs"""
 
-        message = self.message_constructor(role, content)
-        conversation.messages.append(message)
+        with tracer.span("history.append", role=role):
+            message = self.message_constructor(role, content)
+            conversation.messages.append(message)
+            rooms.record_message(conversation.id, message)
+            storage.append_message(conversation.id, role, content)
 
         return conversation.messages
 
-    def get_response_sm(self, conversation: Conversation, prompt: str) -> str:
+    def record_turn(
+        self,
+        conversation: Conversation,
+        timing: dict,
+        usage: dict | None = None,
+        error: bool = False,
+        cached: bool = False,
+        model: str | None = None,
+    ) -> dict:
+        """
+        Keep the metrics record of the generation that finished a turn of the conversation
+
+        Args:
+            conversation: Conversation the turn belongs to
+            timing: timing fields measured for the generation
+            usage: prompt and completion token counts
+            error: whether the turn ended with an error message instead of a reply
+            cached: whether the reply came from the response cache
+            model: model that generated the reply, the conversation model by default
+
+        Returns:
+            dict: the record, see src/services/turn_metrics.py
+        """
+        usage = usage or {}
+        record = turn_metrics(
+            model or conversation.model,
+            timing,
+            prompt_tokens=usage.get("prompt_tokens"),
+            completion_tokens=usage.get("completion_tokens"),
+            error=error,
+            cached=cached,
+        )
+        conversation._turn_metrics.append(record)  # pylint: disable=protected-access
+        storage.append_turn_metrics(conversation.id, record)
+
+        return record
+
+    def last_turn_metrics(self, conversation: Conversation) -> dict | None:
+        """Metrics record of the latest turn, turns are serialized by the room lock"""
+
+        records = conversation._turn_metrics  # pylint: disable=protected-access
+        return records[-1] if records else None
+
+    async def refresh_conversations(self, conversations: List[Conversation]):
+        """
+        With shared state another worker may have added turns since the room was cached,
+        reload the histories that are out of date. Call while holding the room lock.
+        """
+        if not config.SHARED_STATE:
+            return
+
+        for conversation in conversations:
+            if await storage.message_count(conversation.id) == len(conversation.messages):
+                continue
+
+            rooms.replace_messages(conversation.id, await storage.load_messages(conversation.id))
+            conversation.clear_caches()
+
+    def discard_unanswered_prompts(
+        self, conversations: List[Conversation]
+    ) -> List[Conversation]:
+        """
+        Remove the prompt of a cancelled turn, so the history keeps alternating
+        between user and assistant messages as chat templates expect
+
+        Returns:
+            List of conversations whose prompt was still unanswered
+        """
+        discarded = []
+        for conversation in conversations:
+            messages = conversation.messages
+            if not messages or messages[-1].role != Role.USER.value:
+                continue
+
+            message = messages.pop()
+            rooms.forget_message(conversation.id, message)
+            storage.remove_last_message(conversation.id)
+            discarded.append(conversation)
+
+        return discarded
+
+    def prompt_tokens(self, conversations: List[Conversation], prompt: str) -> int:
+        """Estimate the prompt tokens a turn sends to the models of the conversations"""
+
+        prompt_tokens = context_manager.message_tokens({"content": prompt})
+
+        return sum(
+            self.history_tokens(conversation, prompt_tokens)
+            for conversation in conversations
+        )
+
+    def history_tokens(self, conversation: Conversation, extra_tokens: int = 0) -> int:
+        """Estimate the tokens of the conversation history sent to its model"""
+
+        history = sum(context_manager.token_counts(conversation)) + extra_tokens
+        budget = context_manager.budget_for(conversation.model)
+
+        return min(history, budget) if budget > 0 else history
+
+    def resolve_sampling(
+        self,
+        mode: ChatMode,
+        conversation: Conversation,
+        settings: GenerationSettings | None = None,
+    ) -> dict:
+        """
+        Sampling parameters of a turn: the mode defaults overridden by the turn settings.
+        In deadline mode max_tokens is what the model is expected to generate within
+        the latency budget, given its measured throughput and the prompt length.
+        Call once the prompt was added to the conversation.
+
+        Args:
+            mode: Chat mode, selects the defaults and the model generating the reply
+            conversation: Conversation the reply is generated for
+            settings: Room settings merged with the turn settings, see generation_settings
+
+        Returns:
+            dict: temperature, max_tokens and, if set, top_p
+        """
+        if mode == ChatMode.SINGLE_MODE:
+            model = sm_model(conversation)
+            temperature, max_tokens = config.SM_TEMPERATURE, config.SM_MAX_TOKENS
+        else:
+            model = conversation.model
+            temperature, max_tokens = config.CM_TEMPERATURE, config.CM_MAX_TOKENS
+
+        settings = settings or GenerationSettings()
+        sampling = {
+            "temperature": temperature if settings.temperature is None else settings.temperature,
+            "max_tokens": settings.max_tokens or max_tokens,
+        }
+        if settings.top_p is not None:
+            sampling["top_p"] = settings.top_p
+
+        if settings.latency_budget_ms:
+            budget_tokens = throughput.max_tokens_within(
+                model,
+                settings.latency_budget_ms / 1000,
+                prompt_tokens=self.history_tokens(conversation),
+            )
+            # Until the model has served a request only the max_tokens cap applies
+            if budget_tokens is not None:
+                sampling["max_tokens"] = min(
+                    sampling["max_tokens"], max(config.DEADLINE_MIN_TOKENS, budget_tokens)
+                )
+
+        return sampling
+
+    def reply_tokens(self, conversations: List[Conversation]) -> int:
+        """Estimate the tokens generated in the last turn of the conversations"""
+
+        return sum(
+            context_manager.token_counts(conversation)[-1]
+            for conversation in conversations
+            if conversation.messages
+            and conversation.messages[-1].role == Role.ASSISTANT.value
+        )
+
+    @traced("room.get_response_sm")
+    async def get_response_sm(
+        self,
+        conversation: Conversation,
+        prompt: str,
+        settings: GenerationSettings | None = None,
+    ) -> str:
         """
         Update conversation object with new messages from user and LLM outputs in a single mode
         Single mode generate LLM responses directly using LLM class (from vllm lib)
         Using LLM class directly allows avoid network overhead, simpler setup.
         Good for small models
+        Generation runs on the inference thread, concurrent turns are batched together
 
         Args:
             conversation: Conversation object containing information about a particular conversation
             prompt: User prompt to the model
+            settings: Generation settings of the turn
 
         Returns:
             str: string that contains the LLM response or error message
         """
 
         # Add user message to the conversation
-        messages = self.update_conversation(
+        self.update_conversation(
             conversation=conversation, role=Role.USER.value, content=prompt
         )
+        # Only the part of the history that fits the model token budget is sent
+        with tracer.span("context.build"):
+            messages = context_manager.build(conversation)
+        sampling = self.resolve_sampling(ChatMode.SINGLE_MODE, conversation, settings)
+        start_time = time.monotonic()
 
-        request_outputs, manual_duration_sec = vllm_service.generate_response(messages)
+        try:
+            request_outputs, manual_duration_sec, cached = (
+                await vllm_service.generate_response_async(
+                    messages, sampling, model=sm_model(conversation)
+                )
+            )
+        except Exception as e:
+            logger.error("Error generating single mode response: %s", e)
+            request_outputs, manual_duration_sec, cached = None, None, False
 
         if not request_outputs or not request_outputs[0].outputs:
             logger.error("LLM did not return a valid response or response was empty.")
-            llm_error_response = ErrorMessages.LLM_ERROR_RESPONSE
+            llm_error_response = ErrorMessages.LLM_ERROR_RESPONSE.value
+            self.record_turn(
+                conversation,
+                {"total_ms": (time.monotonic() - start_time) * 1000},
+                error=True,
+                model=sm_model(conversation),
+            )
 
             # Add error response to the conversation
             self.update_conversation(
@@ -120,6 +467,21 @@ class RoomService:
         log_vllm_request_output_metrics(
             first_result, manual_duration_sec=manual_duration_sec
         )
+        # The engine timing of a cached or coalesced output belongs to another turn
+        self.record_turn(
+            conversation,
+            (
+                {"total_ms": manual_duration_sec * 1000}
+                if cached
+                else request_output_timing(first_result, manual_duration_sec)
+            ),
+            usage={
+                "prompt_tokens": len(first_result.prompt_token_ids or []),
+                "completion_tokens": len(first_result.outputs[0].token_ids),
+            },
+            cached=cached,
+            model=sm_model(conversation),
+        )
 
         # Add assistant response to the conversation
         self.update_conversation(
@@ -130,55 +492,256 @@ class RoomService:
 
         return llm_generated_text
 
-    async def make_model_request(self, messages: List[Message], model: str):
+    def affinity_key(self, conversation: Conversation) -> str | None:
+        """Return the key that pins a conversation to one model replica"""
+
+        return str(conversation.id) if config.ROUTING_AFFINITY else None
+
+    @traced("model.request")
+    async def make_model_request(
+        self,
+        messages: List[Message],
+        model: str,
+        affinity_key: str | None = None,
+        sampling: dict | None = None,
+    ):
         """
         Make an asynchronous HTTP request to a language model endpoint.
+        The replica is chosen by the model endpoint pool (least outstanding requests).
 
         Args:
             messages: List of Message objects containing the conversation history
             model: String identifier of the model to use (must match config.MODEL1 or config.MODEL2)
+            affinity_key: Optional key routing repeated requests to the same replica
+            sampling: Sampling parameters, the comparison mode defaults if not given
 
         Returns:
-            dict: The JSON response from the model endpoint, or None if the request failed
+            dict: The JSON response from the model endpoint, or None if the request failed.
+            It carries the "timing" of the generation, replies served from the response
+            cache are marked "cached"
 
         Raises:
-            httpx.ConnectError: If connection to the endpoint fails
-            httpx.ReadTimeout: If the request times out
-            httpx.HTTPStatusError: If the server returns an error status code
+            ModelUnavailableError: If the circuit breakers of all model replicas are open
         """
-        endpoint = None
+        sampling = sampling or self.sampling_cm()
 
-        if model == config.MODEL1:
-            endpoint = config.MODEL1_ENDPOINT
-        elif model == config.MODEL2:
-            endpoint = config.MODEL2_ENDPOINT
+        async def generate():
+            return await self._post_model_request(messages, model, affinity_key, sampling)
 
-        try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    endpoint,
-                    json={"messages": messages, "temperature": 0.8, "max_tokens": 500},
+        response, source = await response_cache.get_or_generate(
+            model, messages, sampling, generate
+        )
+        if response is not None and source != response_cache.GENERATED:
+            # The timing belongs to the request that generated the reply
+            return {**response, "cached": True}
+
+        return response
+
+    def sampling_cm(self) -> dict:
+        """Default sampling parameters sent to the comparison mode endpoints"""
+
+        return {"temperature": config.CM_TEMPERATURE, "max_tokens": config.CM_MAX_TOKENS}
+
+    async def _post_model_request(
+        self,
+        messages: List[Message],
+        model: str,
+        affinity_key: str | None = None,
+        sampling: dict | None = None,
+    ):
+        """
+        Send one chat completion request to a replica of the model, see make_model_request.
+        Failures that never reached a model are retried with jittered backoff,
+        on another replica if there is one.
+        With CM_UPSTREAM_STREAMING the reply is read as a stream and put together,
+        so that its time to first token and inter-token latency are known.
+
+        Raises:
+            ModelUnavailableError: if the circuit breakers of all replicas are open
+        """
+        pool = endpoint_pools.get(model)
+
+        if pool is None:
+            logger.error("No endpoint configured for model %s", model)
+            REQUEST_ERRORS.inc(model=model, reason="config")
+            return None
+
+        sampling = sampling or self.sampling_cm()
+        if config.CM_UPSTREAM_STREAMING:
+            sampling = {**sampling, "stream": True, "stream_options": {"include_usage": True}}
+
+        with tracer.span("payload.encode", messages=len(messages)) as span:
+            content = json_codec.encode_chat_request(messages, sampling)
+            span.set(bytes=len(content))
+
+        for attempt in range(config.REQUEST_RETRIES + 1):
+            if attempt:
+                REQUEST_RETRIES.inc(model=model)
+                await asyncio.sleep(
+                    backoff_sec(
+                        attempt, config.RETRY_BACKOFF_BASE_SEC, config.RETRY_BACKOFF_MAX_SEC
+                    )
                 )
 
-                if response.status_code != 200:
-                    logger.error("Error response: %s", response.text)
-                    return None
+            response_json, retryable = await self._post_once(
+                pool, model, content, affinity_key
+            )
+            if not retryable:
+                break
+
+        return response_json
+
+    async def _post_once(
+        self, pool, model: str, content: bytes, affinity_key: str | None
+    ) -> Tuple[dict | None, bool]:
+        """
+        Returns:
+            The JSON response or None, and whether the failure may be retried
+        """
+        replica = pool.acquire(affinity_key)
+
+        if replica is None:
+            logger.error("No endpoint configured for model %s", model)
+            REQUEST_ERRORS.inc(model=model, reason="config")
+            return None, False
+
+        endpoint = replica.url
+        replica_ok = False
+        # Time to first token, or to the response headers of a reply that is not streamed
+        ttft_sec = None
+        timer = TokenTimer()
+        REQUESTS_IN_FLIGHT.inc(model=model)
 
-                return response.json()
+        try:
+            client = http_clients.get(endpoint)
+            # Connection setup, upstream prefill and decode
+            with tracer.span("http.post", model=model, endpoint=endpoint) as span:
+                async with client.stream(
+                    "POST", endpoint, content=content, headers=JSON_HEADERS
+                ) as response:
+                    span.set(status=response.status_code)
+                    headers_sec = time.monotonic() - timer.start
+                    streamed = response.headers.get("content-type", "").startswith(
+                        "text/event-stream"
+                    )
+                    if response.status_code == 200 and streamed:
+                        response_json = await self._collect_stream(response, timer)
+                    else:
+                        await response.aread()
+            latency_sec = time.monotonic() - timer.start
+            # The breaker judges the replica by its time to first token, a long reply is not slow
+            if timer.first_token is not None:
+                ttft_sec = timer.first_token - timer.start
+            else:
+                ttft_sec = headers_sec
+            # Client errors (e.g. prompt too long) say nothing about the replica health
+            replica_ok = response.status_code < 500
+
+            if response.status_code != 200:
+                logger.error("Error response: %s", response.text)
+                REQUEST_ERRORS.inc(model=model, reason="status")
+                return None, response.status_code in RETRYABLE_STATUS_CODES
+
+            if not streamed:
+                with tracer.span("response.parse", bytes=len(response.content)):
+                    response_json = json_codec.loads(response.content)
+            usage = response_json.get("usage") or {}
+            timing = timer.timing(usage.get("completion_tokens"))
+            response_json["timing"] = timing
+            first_token_sec = timing["ttft_ms"] / 1000 if timing["ttft_ms"] is not None else None
+            observe_generation(
+                model,
+                latency_sec,
+                ttft_sec=first_token_sec,
+                output_tokens=usage.get("completion_tokens"),
+                itl_sec=timing["itl_ms"] / 1000 if timing["itl_ms"] is not None else None,
+            )
+            throughput.observe(
+                model,
+                latency_sec,
+                ttft_sec=first_token_sec,
+                prompt_tokens=usage.get("prompt_tokens"),
+                output_tokens=usage.get("completion_tokens"),
+            )
+
+            return response_json, False
+        except asyncio.CancelledError:
+            # Closing the connection makes vLLM abort the request
+            REQUESTS_CANCELLED.inc(model=model)
+            replica_ok = None
+            raise
         except httpx.ConnectError as e:
             logger.error("Connection error: %s - Could not connect to %s", e, endpoint)
-            return None
+            REQUEST_ERRORS.inc(model=model, reason="connect")
+            return None, True
         except httpx.ReadTimeout as e:
+            # The model may still be generating, retrying would only add load
             logger.error("Timeout error: %s - Request to %s timed out", e, endpoint)
-            return None
+            REQUEST_TIMEOUTS.inc(model=model)
+            return None, False
+        except httpx.PoolTimeout as e:
+            logger.error("Pool timeout: %s - No free connection to %s", e, endpoint)
+            REQUEST_TIMEOUTS.inc(model=model)
+            return None, True
         except httpx.HTTPStatusError as e:
             logger.error("HTTP error: %s", e)
-            return None
+            REQUEST_ERRORS.inc(model=model, reason="status")
+            return None, False
         except Exception as e:
             logger.error("Error making model request: %s: %s", type(e).__name__, e)
-            return None
+            REQUEST_ERRORS.inc(model=model, reason="other")
+            return None, False
+        finally:
+            REQUESTS_IN_FLIGHT.dec(model=model)
+            pool.release(replica, replica_ok, ttft_sec)
+
+    async def _sse_chunks(self, response: httpx.Response) -> AsyncIterator[dict]:
+        """Parsed `chat.completion.chunk` objects of a server-sent events response"""
+
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                return
+            yield json_codec.loads(data)
+
+    async def _collect_stream(self, response: httpx.Response, timer: TokenTimer) -> dict:
+        """Put a streamed reply together into the shape of a `chat.completion` response"""
 
-    async def get_response_cm(self, conversation: Conversation, prompt: str) -> str:
+        content = []
+        finish_reason = None
+        usage = None
+        async for chunk in self._sse_chunks(response):
+            if chunk.get("usage"):
+                usage = chunk["usage"]
+            for choice in chunk.get("choices") or []:
+                finish_reason = choice.get("finish_reason") or finish_reason
+                delta = (choice.get("delta") or {}).get("content")
+                if delta:
+                    timer.token()
+                    content.append(delta)
+
+        return {
+            "object": "chat.completion",
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": Role.ASSISTANT.value, "content": "".join(content)},
+                    "finish_reason": finish_reason,
+                }
+            ],
+            "usage": usage
+            or {"prompt_tokens": None, "completion_tokens": len(content)},
+        }
+
+    @traced("room.get_response_cm")
+    async def get_response_cm(
+        self,
+        conversation: Conversation,
+        prompt: str,
+        settings: GenerationSettings | None = None,
+    ) -> str:
         """
         Update conversation object with new messages from user and LLM outputs in a comparison mode
         Comparison mode generate LLM responses by making requests to separate vllm servers with different models
@@ -187,20 +750,48 @@ class RoomService:
         Args:
             conversation: Conversation object containing information about a particular conversation
             prompt: User prompt to the model
+            settings: Generation settings of the turn
 
         Returns:
             str: string that contains the LLM response or error message
+
+        Raises:
+            ModelUnavailableError: If the model fails fast, the error message is recorded
+            in the conversation before it is raised, see unavailable_frame
         """
         model = conversation.model
-        messages = self.update_conversation(
+        self.update_conversation(
             conversation=conversation, role=Role.USER.value, content=prompt
         )
+        with tracer.span("context.build"):
+            messages = context_manager.build(conversation)
         response = None
+        start_time = time.monotonic()
+
+        try:
+            response = await self.make_model_request(
+                messages=messages,
+                model=model,
+                affinity_key=self.affinity_key(conversation),
+                sampling=self.resolve_sampling(ChatMode.COMPARISON_MODE, conversation, settings),
+            )
+        except ModelUnavailableError:
+            self.record_turn(
+                conversation, {"total_ms": (time.monotonic() - start_time) * 1000}, error=True
+            )
+            self.update_conversation(
+                conversation=conversation,
+                role=Role.ASSISTANT.value,
+                content=ErrorMessages.MODEL_UNAVAILABLE.value,
+            )
+            raise
 
-        response = await self.make_model_request(messages=messages, model=model)
+        # Retries and backoff count towards the latency of the turn
+        total_ms = (time.monotonic() - start_time) * 1000
 
         if not response:
-            llm_error_response = ErrorMessages.LLM_ERROR_RESPONSE
+            llm_error_response = ErrorMessages.LLM_ERROR_RESPONSE.value
+            self.record_turn(conversation, {"total_ms": total_ms}, error=True)
             self.update_conversation(
                 conversation=conversation,
                 role=Role.ASSISTANT.value,
@@ -208,6 +799,15 @@ class RoomService:
             )
             return llm_error_response
 
+        cached = response.get("cached", False)
+        self.record_turn(
+            conversation,
+            {"total_ms": total_ms}
+            if cached
+            else {**(response.get("timing") or {}), "total_ms": total_ms},
+            usage=response.get("usage"),
+            cached=cached,
+        )
         self.update_conversation(
             conversation=conversation,
             role=Role.ASSISTANT.value,
@@ -215,3 +815,440 @@ class RoomService:
         )
 
         return response["choices"][0]["message"]["content"]
+
+    def unavailable_frame(
+        self, conversation: Conversation, error: ModelUnavailableError
+    ) -> dict:
+        """Final frame of a turn that failed fast because the model is unavailable"""
+
+        return {
+            "conversation_id": str(conversation.id),
+            "type": "done",
+            "response": ErrorMessages.MODEL_UNAVAILABLE.value,
+            "error": True,
+            "model_unavailable": True,
+            "retry_after_sec": math.ceil(error.retry_after_sec),
+            "metrics": self.last_turn_metrics(conversation),
+        }
+
+    def build_timing(
+        self, timer: TokenTimer, completion_tokens: int, model: str | None = None
+    ) -> dict:
+        """
+        Return timing of a streamed generation, measured on the app side.
+        The stages are recorded as spans of the current trace: time to the first
+        token (connection setup, queueing and prefill) and decode.
+        """
+        end_time = time.monotonic()
+
+        if timer.first_token is not None:
+            tracer.add_span("upstream.prefill", timer.start, timer.first_token, model=model)
+            tracer.add_span(
+                "upstream.decode", timer.first_token, end_time, model=model, tokens=completion_tokens
+            )
+
+        return timer.timing(completion_tokens, end_time)
+
+    async def stream_response_sm(
+        self,
+        conversation: Conversation,
+        prompt: str,
+        settings: GenerationSettings | None = None,
+    ) -> AsyncIterator[dict]:
+        """
+        Stream LLM response in a single mode using the async vLLM engine
+
+        Args:
+            conversation: Conversation object containing information about a particular conversation
+            prompt: User prompt to the model
+            settings: Generation settings of the turn
+
+        Yields:
+            dict: delta frames with newly generated text followed by one final frame
+            with the full response, its metrics record and the sampling parameters used
+        """
+        conversation_id = str(conversation.id)
+        self.update_conversation(
+            conversation=conversation, role=Role.USER.value, content=prompt
+        )
+        with tracer.span("context.build"):
+            messages = context_manager.build(conversation)
+        sampling = self.resolve_sampling(ChatMode.SINGLE_MODE, conversation, settings)
+        model = sm_model(conversation)
+
+        timer = TokenTimer()
+        last_output = None
+
+        try:
+            stream = vllm_service.stream_response(messages, sampling, model=model)
+            async with aclosing(stream) as outputs:
+                async for delta, request_output in outputs:
+                    last_output = request_output
+                    if not delta:
+                        continue
+                    timer.token()
+                    yield {"conversation_id": conversation_id, "type": "delta", "delta": delta}
+        except Exception as e:
+            logger.error("Error streaming single mode response: %s", e)
+            last_output = None
+
+        if last_output is None or not last_output.outputs:
+            logger.error("LLM did not return a valid response or response was empty.")
+            llm_error_response = ErrorMessages.LLM_ERROR_RESPONSE.value
+            record = self.record_turn(
+                conversation, timer.timing(None), error=True, model=model
+            )
+            self.update_conversation(
+                conversation=conversation,
+                role=Role.ASSISTANT.value,
+                content=llm_error_response,
+            )
+            yield {
+                "conversation_id": conversation_id,
+                "type": "done",
+                "response": llm_error_response,
+                "error": True,
+                "metrics": record,
+            }
+            return
+
+        llm_generated_text = last_output.outputs[0].text
+        usage = {
+            "prompt_tokens": len(last_output.prompt_token_ids or []),
+            "completion_tokens": len(last_output.outputs[0].token_ids),
+        }
+        timing = self.build_timing(timer, usage["completion_tokens"], model)
+
+        log_vllm_request_output_metrics(
+            last_output, manual_duration_sec=timing["total_ms"] / 1000
+        )
+        record = self.record_turn(conversation, timing, usage=usage, model=model)
+
+        self.update_conversation(
+            conversation=conversation,
+            role=Role.ASSISTANT.value,
+            content=llm_generated_text,
+        )
+
+        yield {
+            "conversation_id": conversation_id,
+            "type": "done",
+            "response": llm_generated_text,
+            "metrics": record,
+            "sampling": sampling,
+        }
+
+    async def stream_model_request(
+        self,
+        messages: List[Message],
+        model: str,
+        affinity_key: str | None = None,
+        sampling: dict | None = None,
+    ) -> AsyncIterator[dict]:
+        """
+        Make a streaming request to an OpenAI-compatible vLLM endpoint and yield parsed SSE chunks.
+
+        Args:
+            messages: List of Message objects containing the conversation history
+            model: String identifier of the model to use (must match config.MODEL1 or config.MODEL2)
+            affinity_key: Optional key routing repeated requests to the same replica
+            sampling: Sampling parameters, the comparison mode defaults if not given
+
+        Yields:
+            dict: Parsed `chat.completion.chunk` objects, the last one carries `usage`
+
+        Raises:
+            httpx.HTTPError: If the request fails or the server returns an error status code
+            ModelUnavailableError: If the circuit breakers of all model replicas are open
+        """
+        pool = endpoint_pools.get(model)
+
+        if pool is None:
+            raise httpx.InvalidURL(f"No endpoint configured for model {model}")
+
+        payload = json_codec.encode_chat_request(
+            messages,
+            {
+                **(sampling or self.sampling_cm()),
+                "stream": True,
+                "stream_options": {"include_usage": True},
+            },
+        )
+
+        # Only failures before the first chunk are retried, nothing was generated yet
+        for attempt in range(config.REQUEST_RETRIES + 1):
+            if attempt:
+                REQUEST_RETRIES.inc(model=model)
+                await asyncio.sleep(
+                    backoff_sec(
+                        attempt, config.RETRY_BACKOFF_BASE_SEC, config.RETRY_BACKOFF_MAX_SEC
+                    )
+                )
+
+            replica = pool.acquire(affinity_key)
+            if replica is None:
+                raise httpx.InvalidURL(f"No endpoint configured for model {model}")
+
+            endpoint = replica.url
+            replica_ok = False
+            # Time to the first chunk, vLLM sends it with the first token, see _post_once
+            ttft_sec = None
+            start_time = time.monotonic()
+            retry = attempt < config.REQUEST_RETRIES
+
+            try:
+                client = http_clients.get(endpoint)
+                async with client.stream(
+                    "POST", endpoint, content=payload, headers=JSON_HEADERS
+                ) as response:
+                    ttft_sec = time.monotonic() - start_time
+                    replica_ok = response.status_code < 500
+                    if retry and response.status_code in RETRYABLE_STATUS_CODES:
+                        logger.warning("%s returned %s, retrying", endpoint, response.status_code)
+                        continue
+                    response.raise_for_status()
+
+                    first_chunk = True
+                    async with aclosing(self._sse_chunks(response)) as chunks:
+                        async for chunk in chunks:
+                            if first_chunk:
+                                first_chunk = False
+                                ttft_sec = time.monotonic() - start_time
+                            yield chunk
+                return
+            except (asyncio.CancelledError, GeneratorExit):
+                # Leaving the stream context closes the connection and vLLM aborts the request
+                REQUESTS_CANCELLED.inc(model=model)
+                replica_ok = None
+                raise
+            except (httpx.ConnectError, httpx.PoolTimeout) as e:
+                replica_ok = False
+                if not retry:
+                    raise
+                logger.warning("Could not stream from %s, retrying: %s", endpoint, e)
+            except httpx.TransportError:
+                replica_ok = False
+                raise
+            finally:
+                pool.release(replica, replica_ok, ttft_sec)
+
+    async def stream_response_cm(
+        self,
+        conversation: Conversation,
+        prompt: str,
+        settings: GenerationSettings | None = None,
+    ) -> AsyncIterator[dict]:
+        """
+        Stream LLM response in a comparison mode from a dedicated vllm server
+
+        Args:
+            conversation: Conversation object containing information about a particular conversation
+            prompt: User prompt to the model
+            settings: Generation settings of the turn
+
+        Yields:
+            dict: delta frames with newly generated text followed by one final frame
+            with the full response, its metrics record and the sampling parameters used
+        """
+        conversation_id = str(conversation.id)
+        self.update_conversation(
+            conversation=conversation, role=Role.USER.value, content=prompt
+        )
+        with tracer.span("context.build"):
+            messages = context_manager.build(conversation)
+        sampling = self.resolve_sampling(ChatMode.COMPARISON_MODE, conversation, settings)
+
+        timer = TokenTimer()
+        chunks = []
+        usage = None
+        unavailable = None
+        REQUESTS_IN_FLIGHT.inc(model=conversation.model)
+
+        try:
+            stream = self.stream_model_request(
+                messages=messages,
+                model=conversation.model,
+                affinity_key=self.affinity_key(conversation),
+                sampling=sampling,
+            )
+            async with aclosing(stream) as chunks_stream:
+                async for chunk in chunks_stream:
+                    if chunk.get("usage"):
+                        usage = chunk["usage"]
+                    for choice in chunk.get("choices") or []:
+                        delta = (choice.get("delta") or {}).get("content")
+                        if not delta:
+                            continue
+                        timer.token()
+                        chunks.append(delta)
+                        yield {
+                            "conversation_id": conversation_id,
+                            "type": "delta",
+                            "delta": delta,
+                        }
+        except ModelUnavailableError as e:
+            logger.warning("%s", e)
+            unavailable = e
+        except httpx.TimeoutException as e:
+            logger.error("Timeout streaming from %s: %s", conversation.model, e)
+            REQUEST_TIMEOUTS.inc(model=conversation.model)
+            chunks = []
+        except httpx.HTTPError as e:
+            logger.error("HTTP error streaming from %s: %s", conversation.model, e)
+            REQUEST_ERRORS.inc(model=conversation.model, reason="http")
+            chunks = []
+        except Exception as e:
+            logger.error("Error streaming model response: %s: %s", type(e).__name__, e)
+            REQUEST_ERRORS.inc(model=conversation.model, reason="other")
+            chunks = []
+        finally:
+            REQUESTS_IN_FLIGHT.dec(model=conversation.model)
+
+        if unavailable is not None:
+            self.record_turn(conversation, timer.timing(None), error=True)
+            self.update_conversation(
+                conversation=conversation,
+                role=Role.ASSISTANT.value,
+                content=ErrorMessages.MODEL_UNAVAILABLE.value,
+            )
+            yield self.unavailable_frame(conversation, unavailable)
+            return
+
+        if not chunks:
+            llm_error_response = ErrorMessages.LLM_ERROR_RESPONSE.value
+            record = self.record_turn(conversation, timer.timing(None), error=True)
+            self.update_conversation(
+                conversation=conversation,
+                role=Role.ASSISTANT.value,
+                content=llm_error_response,
+            )
+            yield {
+                "conversation_id": conversation_id,
+                "type": "done",
+                "response": llm_error_response,
+                "error": True,
+                "metrics": record,
+            }
+            return
+
+        llm_generated_text = "".join(chunks)
+        usage = {
+            "prompt_tokens": (usage or {}).get("prompt_tokens"),
+            "completion_tokens": (usage or {}).get("completion_tokens", len(chunks)),
+        }
+        timing = self.build_timing(timer, usage["completion_tokens"], conversation.model)
+        ttft_sec = timing["ttft_ms"] / 1000 if timing["ttft_ms"] is not None else None
+        observe_generation(
+            conversation.model,
+            timing["total_ms"] / 1000,
+            ttft_sec=ttft_sec,
+            output_tokens=usage["completion_tokens"],
+            itl_sec=timing["itl_ms"] / 1000 if timing["itl_ms"] is not None else None,
+        )
+        throughput.observe(
+            conversation.model,
+            timing["total_ms"] / 1000,
+            ttft_sec=ttft_sec,
+            prompt_tokens=usage["prompt_tokens"],
+            output_tokens=usage["completion_tokens"],
+        )
+        record = self.record_turn(conversation, timing, usage=usage)
+
+        self.update_conversation(
+            conversation=conversation,
+            role=Role.ASSISTANT.value,
+            content=llm_generated_text,
+        )
+
+        yield {
+            "conversation_id": conversation_id,
+            "type": "done",
+            "response": llm_generated_text,
+            "metrics": record,
+            "sampling": sampling,
+        }
+
+    async def _comparison_frames(
+        self,
+        conversation: Conversation,
+        prompt: str,
+        settings: GenerationSettings | None = None,
+    ) -> AsyncIterator[dict]:
+        """Frames of one model in a comparison turn, streamed or as a single done frame"""
+
+        if config.STREAMING:
+            async for frame in self.stream_response_cm(conversation, prompt, settings):
+                yield frame
+            return
+
+        try:
+            llm_response = await self.get_response_cm(conversation, prompt, settings)
+        except ModelUnavailableError as e:
+            yield self.unavailable_frame(conversation, e)
+            return
+
+        yield {
+            "conversation_id": str(conversation.id),
+            "type": "done",
+            "response": llm_response,
+            "error": llm_response == ErrorMessages.LLM_ERROR_RESPONSE.value,
+            "metrics": self.last_turn_metrics(conversation),
+        }
+
+    async def compare(
+        self, room: Room, prompt: str, settings: GenerationSettings | None = None
+    ) -> AsyncIterator[dict]:
+        """
+        Send one prompt to every conversation of a comparison room concurrently
+        and multiplex their frames onto a single stream
+
+        Args:
+            room: Room in comparison mode
+            prompt: User prompt sent to both models
+            settings: Generation settings of the turn, applied to both models
+
+        Yields:
+            dict: model-tagged frames in arrival order, followed by one "comparison"
+            frame with the metrics of each conversation and which one did better on each
+            timing field. Keyed by conversation ID, both may run the same model
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+        done = object()
+
+        async def pump(conversation: Conversation):
+            try:
+                async for frame in self._comparison_frames(conversation, prompt, settings):
+                    frame["model"] = conversation.model
+                    await queue.put(frame)
+            finally:
+                await queue.put(done)
+
+        tasks = [
+            asyncio.create_task(pump(conversation)) for conversation in room.conversations
+        ]
+        conversations = {}
+        pending = len(tasks)
+
+        try:
+            while pending:
+                frame = await queue.get()
+                if frame is done:
+                    pending -= 1
+                    continue
+                if frame.get("type") == "done":
+                    conversations[frame["conversation_id"]] = {
+                        **(frame.get("metrics") or {"error": frame.get("error", False)}),
+                        "model": frame["model"],
+                    }
+                yield frame
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        yield {
+            "room_id": str(room.id),
+            "type": "comparison",
+            "conversations": conversations,
+            "summary": comparison_summary(conversations),
+        }
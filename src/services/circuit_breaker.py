@@ -0,0 +1,157 @@
+import logging
+import random
+import time
+from collections import deque
+from typing import Deque, Tuple
+from src.services.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+BREAKER_STATE = registry.gauge(
+    "llm_circuit_breaker_state",
+    "Circuit breaker of a model replica: 0 closed, 1 half-open, 2 open",
+    ("model", "endpoint"),
+)
+BREAKER_TRANSITIONS = registry.counter(
+    "llm_circuit_breaker_transitions_total",
+    "Circuit breaker state changes per model replica",
+    ("model", "endpoint", "state"),
+)
+REQUESTS_REJECTED = registry.counter(
+    "llm_requests_rejected_total",
+    "Requests failed fast because the circuit breakers of every replica were open",
+    ("model",),
+)
+REQUEST_RETRIES = registry.counter(
+    "llm_request_retries_total", "Requests retried after an idempotent failure", ("model",)
+)
+
+
+class ModelUnavailableError(Exception):
+    """Raised instead of sending a request while every replica of the model is open"""
+
+    def __init__(self, model: str, retry_after_sec: float):
+        self.model = model
+        self.retry_after_sec = retry_after_sec
+        super().__init__(f"Model {model} is unavailable, retry in {retry_after_sec:.1f}s")
+
+
+class CircuitBreaker:
+    """
+    Per-replica breaker over a rolling window of the last `window` request outcomes.
+
+    closed: requests pass. The breaker opens once the window holds at least
+        `min_requests` outcomes and the failure rate reaches `failure_rate`, or the
+        share of calls whose first token took longer than `slow_call_sec` reaches
+        `slow_call_rate`. Total latency is left out: a long reply is not a slow replica.
+    open: requests fail fast for `open_sec`.
+    half-open: up to `half_open_probes` requests pass, closing the breaker if
+        they succeed and reopening it on the first failure.
+    """
+
+    CLOSED = "closed"
+    HALF_OPEN = "half_open"
+    OPEN = "open"
+    _STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(
+        self,
+        model: str,
+        endpoint: str,
+        window: int = 20,
+        min_requests: int = 5,
+        failure_rate: float = 0.5,
+        slow_call_sec: float = 30.0,
+        slow_call_rate: float = 0.8,
+        open_sec: float = 15.0,
+        half_open_probes: int = 1,
+    ):
+        self.model = model
+        self.endpoint = endpoint
+        self.min_requests = min_requests
+        self.failure_rate = failure_rate
+        self.slow_call_sec = slow_call_sec
+        self.slow_call_rate = slow_call_rate
+        self.open_sec = open_sec
+        self.half_open_probes = max(1, half_open_probes)
+        # (failed, slow) per finished request
+        self._outcomes: Deque[Tuple[bool, bool]] = deque(maxlen=max(1, window))
+        self._opened_at = 0.0
+        self._probes = 0
+        self.state = self.CLOSED
+        BREAKER_STATE.set(0, model=model, endpoint=endpoint)
+
+    def _transition(self, state: str):
+        if state == self.state:
+            return
+
+        logger.warning(
+            "Circuit breaker of %s (%s) %s -> %s", self.endpoint, self.model, self.state, state
+        )
+        self.state = state
+        self._probes = 0
+        if state == self.OPEN:
+            self._opened_at = time.monotonic()
+        if state == self.CLOSED:
+            self._outcomes.clear()
+        BREAKER_STATE.set(self._STATE_VALUES[state], model=self.model, endpoint=self.endpoint)
+        BREAKER_TRANSITIONS.inc(model=self.model, endpoint=self.endpoint, state=state)
+
+    def retry_after(self) -> float:
+        """Seconds until an open breaker lets a probe through"""
+
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self._opened_at + self.open_sec - time.monotonic())
+
+    def available(self) -> bool:
+        """Whether a request may be sent now, does not change the state"""
+
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return self.retry_after() <= 0
+        return self._probes < self.half_open_probes
+
+    def on_acquire(self):
+        """A request was sent, in half-open state it takes a probe slot"""
+
+        if self.state == self.OPEN and self.retry_after() <= 0:
+            self._transition(self.HALF_OPEN)
+        if self.state == self.HALF_OPEN:
+            self._probes += 1
+
+    def record(self, success: bool | None, latency_sec: float | None = None):
+        """
+        Record the outcome of a request, None for requests that ended without one
+        (e.g. cancelled by the client), which only free their probe slot.
+        `latency_sec` is the time to first token, or to the response of a non-streamed reply.
+        """
+        if success is None:
+            if self.state == self.HALF_OPEN:
+                self._probes = max(0, self._probes - 1)
+            return
+
+        slow = latency_sec is not None and latency_sec > self.slow_call_sec
+
+        if self.state == self.HALF_OPEN:
+            self._transition(self.OPEN if not success or slow else self.CLOSED)
+            return
+        if self.state == self.OPEN:
+            # A request sent before the breaker opened
+            return
+
+        self._outcomes.append((not success, slow))
+        if len(self._outcomes) < self.min_requests:
+            return
+
+        failures = sum(failed for failed, _ in self._outcomes) / len(self._outcomes)
+        slow_calls = sum(slow for _, slow in self._outcomes) / len(self._outcomes)
+        if failures >= self.failure_rate or slow_calls >= self.slow_call_rate:
+            self._transition(self.OPEN)
+
+
+def backoff_sec(attempt: int, base_sec: float, max_sec: float) -> float:
+    """Exponential backoff with full jitter before retry number `attempt` (from 1)"""
+
+    return random.uniform(0, min(max_sec, base_sec * 2 ** (attempt - 1)))
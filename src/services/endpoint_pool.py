@@ -0,0 +1,219 @@
+import asyncio
+import hashlib
+import logging
+import random
+from typing import Dict, List
+import httpx
+from src.config import config
+from src.services.circuit_breaker import (
+    REQUESTS_REJECTED,
+    CircuitBreaker,
+    ModelUnavailableError,
+)
+from src.services.http_client import http_clients
+from src.services.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+REPLICA_IN_FLIGHT = registry.gauge(
+    "llm_replica_requests_in_flight",
+    "Requests in flight per model replica",
+    ("model", "endpoint"),
+)
+REPLICA_HEALTHY = registry.gauge(
+    "llm_replica_healthy", "1 if the model replica passes health checks", ("model", "endpoint")
+)
+
+
+class Replica:
+    """One vLLM server behind a model"""
+
+    def __init__(self, model: str, url: str):
+        self.model = model
+        self.url = url
+        url_obj = httpx.URL(url)
+        self.health_url = str(url_obj.copy_with(path=config.HEALTH_CHECK_PATH, query=None))
+        self.in_flight = 0
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.breaker = CircuitBreaker(
+            model,
+            url,
+            window=config.CIRCUIT_WINDOW,
+            min_requests=config.CIRCUIT_MIN_REQUESTS,
+            failure_rate=config.CIRCUIT_FAILURE_RATE,
+            slow_call_sec=config.CIRCUIT_SLOW_CALL_SEC,
+            slow_call_rate=config.CIRCUIT_SLOW_CALL_RATE,
+            open_sec=config.CIRCUIT_OPEN_SEC,
+            half_open_probes=config.CIRCUIT_HALF_OPEN_PROBES,
+        )
+        REPLICA_HEALTHY.set(1, model=model, endpoint=url)
+
+    def set_healthy(self, healthy: bool):
+        if healthy != self.healthy:
+            logger.warning(
+                "Replica %s of %s is now %s",
+                self.url,
+                self.model,
+                "healthy" if healthy else "unhealthy",
+            )
+        self.healthy = healthy
+        REPLICA_HEALTHY.set(1 if healthy else 0, model=self.model, endpoint=self.url)
+
+
+class EndpointPool:
+    """
+    Replicas of one model with least-outstanding-requests load balancing.
+
+    With an affinity key (the conversation id) the replica is picked by rendezvous
+    hashing, so repeated turns of a room hit the same server and reuse its prefix
+    cache, unless that replica is unhealthy or has `affinity_slack` more requests
+    in flight than the least loaded one.
+
+    Replicas whose circuit breaker is open are skipped, when every breaker is open
+    requests fail fast with ModelUnavailableError instead of waiting for timeouts.
+    """
+
+    def __init__(self, model: str, urls: List[str], affinity_slack: int = 2):
+        self.model = model
+        self.replicas = [Replica(model, url) for url in urls]
+        self.affinity_slack = affinity_slack
+
+    @staticmethod
+    def _score(key: str, replica: Replica) -> int:
+        digest = hashlib.blake2b(f"{key}|{replica.url}".encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "big")
+
+    def _candidates(self) -> List[Replica]:
+        available = [replica for replica in self.replicas if replica.breaker.available()]
+        healthy = [replica for replica in available if replica.healthy]
+        # When every replica fails health checks, still try them rather than failing outright
+        return healthy or available
+
+    def retry_after(self) -> float:
+        """Seconds until the first open breaker lets a probe through"""
+
+        return min((replica.breaker.retry_after() for replica in self.replicas), default=0.0)
+
+    def acquire(self, affinity_key: str | None = None) -> Replica | None:
+        """
+        Pick a replica for a request and count it as in flight
+
+        Raises:
+            ModelUnavailableError: if the circuit breakers of all replicas are open
+        """
+        if not self.replicas:
+            return None
+
+        candidates = self._candidates()
+        if not candidates:
+            REQUESTS_REJECTED.inc(model=self.model)
+            raise ModelUnavailableError(self.model, self.retry_after())
+
+        least = min(replica.in_flight for replica in candidates)
+        replica = None
+
+        if affinity_key is not None:
+            preferred = max(candidates, key=lambda r: self._score(affinity_key, r))
+            if preferred.in_flight <= least + self.affinity_slack:
+                replica = preferred
+
+        if replica is None:
+            replica = random.choice([r for r in candidates if r.in_flight == least])
+
+        replica.in_flight += 1
+        replica.breaker.on_acquire()
+        REPLICA_IN_FLIGHT.set(replica.in_flight, model=self.model, endpoint=replica.url)
+
+        return replica
+
+    def release(
+        self, replica: Replica, success: bool | None, latency_sec: float | None = None
+    ):
+        """
+        Finish a request, replicas failing repeatedly are taken out of rotation.
+        `success` is None for requests that ended without an outcome, e.g. cancelled ones.
+        `latency_sec` is the time to first token, see CircuitBreaker.record.
+        """
+        replica.in_flight -= 1
+        REPLICA_IN_FLIGHT.set(replica.in_flight, model=self.model, endpoint=replica.url)
+        replica.breaker.record(success, latency_sec)
+
+        if success is None:
+            return
+        if success:
+            replica.consecutive_failures = 0
+            return
+
+        replica.consecutive_failures += 1
+        if replica.consecutive_failures >= config.REPLICA_MAX_FAILURES:
+            replica.set_healthy(False)
+
+    async def check_health(self):
+        """Probe every replica once"""
+
+        async def probe(replica: Replica):
+            try:
+                client = http_clients.get(replica.health_url)
+                response = await client.get(
+                    replica.health_url, timeout=config.HEALTH_CHECK_TIMEOUT
+                )
+                healthy = response.status_code == 200
+            except httpx.HTTPError:
+                healthy = False
+
+            if healthy:
+                replica.consecutive_failures = 0
+            replica.set_healthy(healthy)
+
+        await asyncio.gather(*(probe(replica) for replica in self.replicas))
+
+
+class EndpointPools:
+    """Endpoint pools of all configured models and their health check loop"""
+
+    def __init__(self, endpoints: Dict[str, List[str]]):
+        self._pools = {
+            model: EndpointPool(model, urls, config.AFFINITY_SLACK)
+            for model, urls in endpoints.items()
+            if model and urls
+        }
+        self._health_task: asyncio.Task | None = None
+
+    def get(self, model: str) -> EndpointPool | None:
+        return self._pools.get(model)
+
+    @property
+    def urls(self) -> List[str]:
+        return [replica.url for pool in self._pools.values() for replica in pool.replicas]
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.gather(
+                *(pool.check_health() for pool in self._pools.values()),
+                return_exceptions=True,
+            )
+            await asyncio.sleep(config.HEALTH_CHECK_INTERVAL_SEC)
+
+    def start(self):
+        """Start active health checks, must be called from the running event loop"""
+
+        if config.HEALTH_CHECK_INTERVAL_SEC > 0 and self._health_task is None:
+            self._health_task = asyncio.get_running_loop().create_task(self._health_loop())
+
+    async def aclose(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except asyncio.CancelledError:
+                pass
+            self._health_task = None
+
+
+endpoint_pools = EndpointPools(
+    {
+        config.MODEL1: config.MODEL1_ENDPOINTS,
+        config.MODEL2: config.MODEL2_ENDPOINTS,
+    }
+)
@@ -0,0 +1,167 @@
+"""
+Fake in-process engines with the parts of the vLLM API the app uses.
+Selected with SM_ENGINE=fake to benchmark single mode on machines without a GPU.
+"""
+
+import asyncio
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import List
+
+WORDS = ("lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit")
+
+
+@dataclass
+class FakeSamplingParams:
+    temperature: float = 1.0
+    top_p: float = 1.0
+    max_tokens: int | None = 16
+
+
+@dataclass
+class FakeCompletionOutput:
+    text: str = ""
+    token_ids: List[int] = field(default_factory=list)
+    finish_reason: str | None = None
+
+
+@dataclass
+class FakeRequestMetrics:
+    arrival_time: float
+    first_scheduled_time: float | None = None
+    first_token_time: float | None = None
+    last_token_time: float | None = None
+    finished_time: float | None = None
+    time_in_queue: float | None = None
+
+
+@dataclass
+class FakeRequestOutput:
+    request_id: str
+    prompt_token_ids: List[int]
+    outputs: List[FakeCompletionOutput]
+    finished: bool
+    metrics: FakeRequestMetrics | None = None
+
+
+def _prompt_token_ids(messages) -> List[int]:
+    n_tokens = sum(len(str(message["content"])) // 4 + 4 for message in messages)
+    return list(range(n_tokens))
+
+
+def _text(n_tokens: int) -> str:
+    return " ".join(WORDS[i % len(WORDS)] for i in range(n_tokens))
+
+
+class FakeTokenizer:
+
+    def apply_chat_template(self, messages, tokenize=False, add_generation_prompt=True):
+        prompt = "".join(f"<{m['role']}>{m['content']}</{m['role']}>" for m in messages)
+        return prompt + "<assistant>" if add_generation_prompt else prompt
+
+
+class FakeLLM:
+    """
+    Stand-in for vllm.LLM. A chat call sleeps for one prefill plus the decode time
+    of the longest output, like a batched GPU step would. Like vLLM it takes one
+    sampling params for the whole batch or a list with one per conversation.
+    """
+
+    def __init__(
+        self,
+        model: str = "fake-model",
+        prefill_ms: float = 100.0,
+        tokens_per_sec: float = 50.0,
+        output_tokens: int = 64,
+    ):
+        self.model = model
+        self.prefill_ms = prefill_ms
+        self.tokens_per_sec = tokens_per_sec
+        self.output_tokens = output_tokens
+
+    def _n_tokens(self, sampling_params) -> int:
+        max_tokens = getattr(sampling_params, "max_tokens", None) or self.output_tokens
+        return max(1, min(self.output_tokens, max_tokens))
+
+    def chat(self, messages, sampling_params=None, **_kwargs) -> List[FakeRequestOutput]:
+        # A single conversation is a list of messages, a batch is a list of conversations
+        conversations = messages if messages and isinstance(messages[0], list) else [messages]
+        if not isinstance(sampling_params, list):
+            sampling_params = [sampling_params] * len(conversations)
+        n_tokens = [self._n_tokens(params) for params in sampling_params]
+        arrival_time = time.time()
+
+        time.sleep(self.prefill_ms / 1000)
+        first_token_time = time.time()
+        if self.tokens_per_sec > 0:
+            time.sleep((max(n_tokens) - 1) / self.tokens_per_sec)
+        finished_time = time.time()
+
+        return [
+            FakeRequestOutput(
+                request_id=str(uuid.uuid4()),
+                prompt_token_ids=_prompt_token_ids(conversation),
+                outputs=[
+                    FakeCompletionOutput(
+                        text=_text(conversation_tokens),
+                        token_ids=list(range(conversation_tokens)),
+                        finish_reason="length",
+                    )
+                ],
+                finished=True,
+                metrics=FakeRequestMetrics(
+                    arrival_time=arrival_time,
+                    first_scheduled_time=arrival_time,
+                    first_token_time=first_token_time,
+                    last_token_time=finished_time,
+                    finished_time=finished_time,
+                    time_in_queue=0.0,
+                ),
+            )
+            for conversation, conversation_tokens in zip(conversations, n_tokens)
+        ]
+
+
+class FakeAsyncEngine(FakeLLM):
+    """Stand-in for vllm.AsyncLLMEngine, yields cumulative outputs token by token"""
+
+    async def get_tokenizer(self):
+        return FakeTokenizer()
+
+    async def abort(self, request_id):
+        """Generation stops when its generator is closed, nothing else to free"""
+
+    async def generate(self, prompt, sampling_params=None, request_id=None):
+        n_tokens = self._n_tokens(sampling_params)
+        prompt_token_ids = list(range(len(prompt) // 4))
+        arrival_time = time.time()
+
+        await asyncio.sleep(self.prefill_ms / 1000)
+        first_token_time = time.time()
+
+        for i in range(1, n_tokens + 1):
+            if i > 1 and self.tokens_per_sec > 0:
+                await asyncio.sleep(1 / self.tokens_per_sec)
+            finished = i == n_tokens
+            now = time.time()
+            yield FakeRequestOutput(
+                request_id=request_id or str(uuid.uuid4()),
+                prompt_token_ids=prompt_token_ids,
+                outputs=[
+                    FakeCompletionOutput(
+                        text=_text(i),
+                        token_ids=list(range(i)),
+                        finish_reason="length" if finished else None,
+                    )
+                ],
+                finished=finished,
+                metrics=FakeRequestMetrics(
+                    arrival_time=arrival_time,
+                    first_scheduled_time=arrival_time,
+                    first_token_time=first_token_time,
+                    last_token_time=now,
+                    finished_time=now if finished else None,
+                    time_in_queue=0.0,
+                ),
+            )
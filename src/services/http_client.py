@@ -0,0 +1,86 @@
+import logging
+from typing import Dict
+import httpx
+from src.config import config
+
+logger = logging.getLogger(__name__)
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401 pylint: disable=import-outside-toplevel,unused-import
+    except ImportError:
+        return False
+    return True
+
+
+class HTTPClientPool:
+    """
+    Keeps one long-lived httpx.AsyncClient per model endpoint so connections
+    to vLLM servers are reused across turns instead of re-handshaking every request.
+    Clients are created in the FastAPI lifespan hook and closed on shutdown.
+    """
+
+    def __init__(self):
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+
+    def _build_client(self) -> httpx.AsyncClient:
+        http2 = config.HTTP2
+        if http2 and not _http2_available():
+            logger.warning("HTTP2 is enabled but 'h2' is not installed, using HTTP/1.1")
+            http2 = False
+
+        return httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=config.HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=config.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=config.HTTP_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(
+                connect=config.HTTP_CONNECT_TIMEOUT,
+                read=config.HTTP_READ_TIMEOUT,
+                write=config.HTTP_WRITE_TIMEOUT,
+                pool=config.HTTP_POOL_TIMEOUT,
+            ),
+        )
+
+    @staticmethod
+    def _origin(endpoint: str) -> str:
+        url = httpx.URL(endpoint)
+        return f"{url.scheme}://{url.netloc.decode()}"
+
+    def start(self, endpoints):
+        """Create clients for the configured endpoints"""
+
+        for endpoint in endpoints:
+            if endpoint:
+                self.get(endpoint)
+
+    def get(self, endpoint: str) -> httpx.AsyncClient:
+        """Return the shared client for an endpoint, creating it on first use"""
+
+        origin = self._origin(endpoint)
+        client = self._clients.get(origin)
+
+        if client is None or client.is_closed:
+            client = self._build_client()
+            self._clients[origin] = client
+            logger.info("Created HTTP client for %s", origin)
+
+        return client
+
+    async def aclose(self):
+        """Close all clients and their pooled connections"""
+
+        clients = list(self._clients.values())
+        self._clients.clear()
+
+        for client in clients:
+            try:
+                await client.aclose()
+            except Exception as e:
+                logger.error("Error closing HTTP client: %s", e)
+
+
+http_clients = HTTPClientPool()
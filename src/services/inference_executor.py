@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List
+
+logger = logging.getLogger(__name__)
+
+
+class BatchingExecutor:
+    """
+    Runs a blocking batch function on a dedicated worker thread so it never blocks
+    the event loop. Items submitted within `window_ms` of each other (up to
+    `max_batch_size`) are collected and passed to `batch_fn` in one call, and each
+    result is routed back to the coroutine that submitted it.
+
+    `batch_fn` receives a list of items and must return a list of results in the same order.
+    An exception in place of a result is raised to the submitter of that item only.
+    """
+
+    def __init__(
+        self,
+        batch_fn: Callable[[List[Any]], List[Any]],
+        window_ms: float = 10.0,
+        max_batch_size: int = 32,
+        name: str = "inference",
+    ):
+        self._batch_fn = batch_fn
+        self._window_sec = window_ms / 1000
+        self._max_batch_size = max(1, max_batch_size)
+        self._name = name
+        self._queue: asyncio.Queue | None = None
+        self._worker: asyncio.Task | None = None
+        # A single thread: the engine is not thread-safe and batching happens here anyway
+        self._thread_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+
+    def _ensure_started(self):
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, item: Any) -> Any:
+        """Queue an item for the next batch and wait for its result"""
+
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+
+        return await future
+
+    async def run(self, fn: Callable, *args) -> Any:
+        """Run a one-off call on the worker thread, outside of batching"""
+
+        return await asyncio.get_running_loop().run_in_executor(
+            self._thread_pool, fn, *args
+        )
+
+    async def _collect_batch(self) -> list:
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self._window_sec
+
+        while len(batch) < self._max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = await self._collect_batch()
+            # Skip items whose submitters went away while waiting in the queue
+            batch = [(item, future) for item, future in batch if not future.done()]
+            if not batch:
+                continue
+
+            items = [item for item, _ in batch]
+            logger.debug("%s: running batch of %d", self._name, len(items))
+
+            try:
+                results = await loop.run_in_executor(
+                    self._thread_pool, self._batch_fn, items
+                )
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    async def aclose(self):
+        """Stop collecting batches and release the worker thread"""
+
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+        self._thread_pool.shutdown(wait=False)
@@ -0,0 +1,66 @@
+"""
+JSON encoding of the hot paths: model request bodies, model responses and WebSocket frames.
+Uses orjson when it is installed and the standard library otherwise.
+"""
+
+import json
+from typing import Any, Iterable
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+
+def dumps(obj: Any, sort_keys: bool = False) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+
+    return json.dumps(
+        obj, ensure_ascii=False, separators=(",", ":"), sort_keys=sort_keys
+    ).encode("utf-8")
+
+
+def dumps_text(obj: Any) -> str:
+    """Encode for text frames, e.g. WebSocket messages read with JSON.parse"""
+
+    return dumps(obj).decode("utf-8")
+
+
+def loads(data: bytes | str) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+
+    return json.loads(data)
+
+
+def message_json(message) -> bytes:
+    """JSON object of a chat message, cached on Message records"""
+
+    encoded = getattr(message, "encoded", None)
+    if encoded is not None:
+        return encoded
+
+    return dumps({"role": message["role"], "content": message["content"]})
+
+
+def encode_chat_request(messages: Iterable, params: dict) -> bytes:
+    """
+    Body of a chat completion request. Messages are not re-serialized: their cached
+    encodings are joined into the body with a single copy.
+    """
+    parts = [b'{"messages":[']
+    for i, message in enumerate(messages):
+        if i:
+            parts.append(b",")
+        parts.append(message_json(message))
+    parts.append(b"]")
+
+    if params:
+        # '{"temperature":...}' -> ',"temperature":...}'
+        parts.append(b",")
+        parts.append(dumps(params)[1:])
+    else:
+        parts.append(b"}")
+
+    return b"".join(parts)
@@ -0,0 +1,163 @@
+"""
+Opt-in runtime monitor of the asyncio event loop, enabled with LOOP_MONITOR=true.
+
+A probe task sleeps for `interval_sec` and records how late it wakes up: the scheduling
+lag every coroutine on the loop sees, from load or from blocking calls. Wake-ups later
+than `block_threshold_sec` are counted as blocked loop stalls.
+
+The stack of a blocking call is only visible while it blocks, so a watchdog thread
+checks the probe's heartbeat and logs the stack of the loop thread as soon as the
+loop stalls for longer than the threshold. Code that blocks without releasing the
+GIL holds the watchdog back too: the stall is still measured, its stack is missed.
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from contextlib import suppress
+from typing import Dict
+from src.config import config
+from src.services.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+LOOP_LAG_SECONDS = registry.histogram(
+    "event_loop_lag_seconds",
+    "Delay between when a loop callback was due and when it ran",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+LOOP_BLOCKED_SECONDS = registry.histogram(
+    "event_loop_blocked_seconds",
+    "Event loop stalls longer than the blocking threshold",
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0),
+)
+LOOP_BLOCKED_STACKS = registry.counter(
+    "event_loop_blocked_stacks_total", "Stack traces captured from a blocked event loop"
+)
+
+
+class LoopMonitor:
+    """
+    Measures event loop lag and reports the stacks of calls blocking the loop,
+    see the module docstring. Start it from the loop to watch.
+    """
+
+    def __init__(
+        self,
+        interval_sec: float = 0.05,
+        block_threshold_sec: float = 0.1,
+        repeat_stack_sec: float = 60.0,
+    ):
+        self.interval_sec = interval_sec
+        self.block_threshold_sec = block_threshold_sec
+        # The full stack of a recurring block is logged once per this interval
+        self.repeat_stack_sec = repeat_stack_sec
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id: int | None = None
+        self._probe_task: asyncio.Task | None = None
+        self._watchdog: threading.Thread | None = None
+        self._stop = threading.Event()
+        self._stack_logged_at: Dict[str, float] = {}
+
+    def start(self):
+        if self._probe_task is not None:
+            return
+
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stop.clear()
+        self._probe_task = asyncio.get_running_loop().create_task(self._probe())
+        self._watchdog = threading.Thread(
+            target=self._watch, name="loop-watchdog", daemon=True
+        )
+        self._watchdog.start()
+        logger.info(
+            "Event loop monitor started, blocking threshold %.0f ms",
+            self.block_threshold_sec * 1000,
+        )
+
+    async def stop(self):
+        self._stop.set()
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._probe_task
+            self._probe_task = None
+        if self._watchdog is not None:
+            self._watchdog.join(timeout=1.0)
+            self._watchdog = None
+
+    async def _probe(self):
+        while True:
+            due = time.monotonic() + self.interval_sec
+            await asyncio.sleep(self.interval_sec)
+            now = time.monotonic()
+            self._heartbeat = now
+
+            lag = max(0.0, now - due)
+            LOOP_LAG_SECONDS.observe(lag)
+            if lag >= self.block_threshold_sec:
+                LOOP_BLOCKED_SECONDS.observe(lag)
+                logger.warning("Event loop was blocked for %.0f ms", lag * 1000)
+
+    def _watch(self):
+        # Stall of the heartbeat whose stack was taken, one per stall
+        reported = None
+
+        while not self._stop.wait(self.block_threshold_sec / 2):
+            heartbeat = self._heartbeat
+            stalled = time.monotonic() - heartbeat - self.interval_sec
+            if stalled < self.block_threshold_sec or heartbeat == reported:
+                continue
+
+            reported = heartbeat
+            frame = sys._current_frames().get(self._loop_thread_id)  # pylint: disable=protected-access
+            if frame is None:
+                continue
+            self._report(stalled, self._callback_frames(traceback.extract_stack(frame)))
+
+    @staticmethod
+    def _callback_frames(frames: traceback.StackSummary) -> traceback.StackSummary:
+        """Drop the loop machinery above the running callback, the same for every block"""
+
+        for i in range(len(frames) - 1, -1, -1):
+            if frames[i].name == "_run" and frames[i].filename.endswith(
+                os.path.join("asyncio", "events.py")
+            ):
+                return traceback.StackSummary.from_list(frames[i + 1:])
+
+        return frames
+
+    def _report(self, stalled_sec: float, frames: traceback.StackSummary):
+        LOOP_BLOCKED_STACKS.inc()
+        stack = "".join(frames.format())
+        now = time.monotonic()
+        logged_at = self._stack_logged_at.get(stack)
+        if logged_at is not None and now - logged_at < self.repeat_stack_sec:
+            # The innermost frame is enough to recognize a block logged recently
+            where = f"{frames[-1].filename}:{frames[-1].lineno} in {frames[-1].name}"
+            logger.warning(
+                "Event loop blocked for %.0f ms so far, same stack as before at %s",
+                stalled_sec * 1000,
+                where,
+            )
+            return
+
+        if len(self._stack_logged_at) > 1000:
+            self._stack_logged_at.clear()
+        self._stack_logged_at[stack] = now
+        logger.warning(
+            "Event loop blocked for %.0f ms so far, loop thread stack:\n%s",
+            stalled_sec * 1000,
+            stack,
+        )
+
+
+loop_monitor = LoopMonitor(
+    interval_sec=config.LOOP_MONITOR_INTERVAL_MS / 1000,
+    block_threshold_sec=config.LOOP_BLOCK_THRESHOLD_MS / 1000,
+)
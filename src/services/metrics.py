@@ -0,0 +1,276 @@
+import bisect
+import math
+import threading
+from typing import Callable, Dict, Iterable, List, Tuple
+
+# Latency buckets in seconds, from fast cached replies to long generations
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+TOKENS_PER_SEC_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500)
+ITL_BUCKETS = (0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 1.0)
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if math.isnan(value):
+        return "NaN"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    TYPE = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> Tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}"
+            )
+        return tuple(labels[name] for name in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.TYPE}",
+        ]
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    TYPE = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def render(self):
+        with self._lock:
+            items = list(self._values.items())
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in items
+        ]
+
+
+class Gauge(_Metric):
+    TYPE = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple, float] = {}
+        self._function: Callable[[], float] | None = None
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], float]):
+        """Read the value from a callback at scrape time, for unlabelled gauges"""
+
+        self._function = function
+
+    def value(self, **labels) -> float:
+        if self._function is not None:
+            return self._function()
+        return self._values.get(self._key(labels), 0.0)
+
+    def render(self):
+        if self._function is not None:
+            return self.header() + [f"{self.name} {_format_value(self._function())}"]
+
+        with self._lock:
+            items = list(self._values.items())
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in items
+        ]
+
+
+class Histogram(_Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [bucket counts..., +Inf count], sum
+        self._counts: Dict[Tuple, List[int]] = {}
+        self._sums: Dict[Tuple, float] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.get(key)
+            if counts is None:
+                counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+                self._sums[key] = 0.0
+            counts[index] += 1
+            self._sums[key] += value
+
+    def count(self, **labels) -> int:
+        return sum(self._counts.get(self._key(labels), ()))
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            items = [(key, list(counts), self._sums[key]) for key, counts in self._counts.items()]
+
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}"
+                )
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+
+        return lines
+
+
+class MetricsRegistry:
+    """In-process metrics registry rendered in the Prometheus text exposition format"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(
+        self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS
+    ) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+TTFT_SECONDS = registry.histogram(
+    "llm_time_to_first_token_seconds", "Time to first generated token", ("model",)
+)
+REQUEST_LATENCY_SECONDS = registry.histogram(
+    "llm_request_latency_seconds", "End-to-end generation latency", ("model",)
+)
+OUTPUT_TOKENS_PER_SECOND = registry.histogram(
+    "llm_output_tokens_per_second",
+    "Generated tokens per second of a request",
+    ("model",),
+    buckets=TOKENS_PER_SEC_BUCKETS,
+)
+INTER_TOKEN_LATENCY_SECONDS = registry.histogram(
+    "llm_inter_token_latency_seconds",
+    "Mean time between generated tokens of a request",
+    ("model",),
+    buckets=ITL_BUCKETS,
+)
+REQUEST_ERRORS = registry.counter(
+    "llm_request_errors_total", "Failed generation requests", ("model", "reason")
+)
+REQUEST_TIMEOUTS = registry.counter(
+    "llm_request_timeouts_total", "Generation requests that timed out", ("model",)
+)
+REQUESTS_CANCELLED = registry.counter(
+    "llm_requests_cancelled_total",
+    "Generation requests aborted before completion",
+    ("model",),
+)
+TURNS_CANCELLED = registry.counter(
+    "chat_turns_cancelled_total",
+    "Chat turns cancelled by disconnect, a superseding prompt, the turn deadline or a lost room lock",
+    ("reason",),
+)
+REQUESTS_IN_FLIGHT = registry.gauge(
+    "llm_requests_in_flight", "Generation requests currently running", ("model",)
+)
+WS_RESUMES = registry.counter(
+    "websocket_resumes_total",
+    "Reconnects asking for missed frames, by whether they could all be replayed",
+    ("outcome",),
+)
+ACTIVE_WEBSOCKETS = registry.gauge(
+    "websocket_connections_active", "Open room WebSocket connections"
+)
+LIVE_ROOMS = registry.gauge("rooms_live", "Rooms held in the in-memory registry")
+
+
+def observe_generation(
+    model: str,
+    latency_sec: float,
+    ttft_sec: float | None = None,
+    output_tokens: int | None = None,
+    itl_sec: float | None = None,
+):
+    """
+    Record latency, time to first token, inter-token latency and decode throughput
+    of one finished request
+    """
+    REQUEST_LATENCY_SECONDS.observe(latency_sec, model=model)
+
+    if ttft_sec is not None:
+        TTFT_SECONDS.observe(ttft_sec, model=model)
+
+    if itl_sec is not None:
+        INTER_TOKEN_LATENCY_SECONDS.observe(itl_sec, model=model)
+
+    if output_tokens:
+        decode_sec = latency_sec - (ttft_sec or 0.0)
+        if decode_sec > 0:
+            OUTPUT_TOKENS_PER_SECOND.observe(output_tokens / decode_sec, model=model)
@@ -0,0 +1,157 @@
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+from src.config import config
+from src.services import json_codec
+from src.services.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+CACHE_HITS = registry.counter("response_cache_hits_total", "Response cache hits", ("model",))
+CACHE_MISSES = registry.counter(
+    "response_cache_misses_total", "Response cache misses", ("model",)
+)
+CACHE_COALESCED = registry.counter(
+    "response_cache_coalesced_total",
+    "Requests that waited for an identical in-flight generation",
+    ("model",),
+)
+CACHE_EVICTIONS = registry.counter(
+    "response_cache_evictions_total", "Response cache evictions", ("reason",)
+)
+
+
+def cache_key(model: str, messages: List, sampling: Dict[str, Any]) -> str:
+    """Hash of the model, the message history and the sampling parameters"""
+
+    digest = hashlib.sha256(json_codec.dumps([model, sampling], sort_keys=True))
+    # Hashes the cached message encodings, the history is not serialized again
+    for message in messages:
+        digest.update(b"\n")
+        digest.update(json_codec.message_json(message))
+
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """
+    Bounded LRU cache of model responses with TTL expiry and singleflight coalescing:
+    concurrent identical requests share one upstream generation.
+
+    Only deterministic requests (temperature 0) are cached unless `allow_sampling` is set,
+    a sampled reply is a single draw and should not be replayed to other users.
+    """
+
+    # Where the response of get_or_generate came from
+    GENERATED = "generated"
+    HIT = "hit"
+    COALESCED = "coalesced"
+
+    def __init__(self, max_entries: int = 1024, ttl_sec: float = 600.0, allow_sampling=False):
+        self.max_entries = max_entries
+        self.ttl_sec = ttl_sec
+        self.allow_sampling = allow_sampling
+        # key -> (expires at, value), least recently used first
+        self._entries: OrderedDict = OrderedDict()
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def is_cacheable(self, sampling: Dict[str, Any]) -> bool:
+        if self.max_entries <= 0:
+            return False
+        return self.allow_sampling or not sampling.get("temperature")
+
+    def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            CACHE_EVICTIONS.inc(reason="ttl")
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: str, value):
+        self._entries[key] = (time.monotonic() + self.ttl_sec, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            CACHE_EVICTIONS.inc(reason="size")
+
+    async def get_or_generate(
+        self,
+        model: str,
+        messages: List,
+        sampling: Dict[str, Any],
+        generate: Callable[[], Awaitable[Any]],
+    ) -> Tuple[Any, str]:
+        """
+        Return a cached response or run `generate` once for all identical concurrent callers.
+        A None result means the generation failed and is never cached.
+
+        Returns:
+            The response, and GENERATED if `generate` ran for this caller, HIT if it was
+            cached or COALESCED if it came from an identical concurrent generation
+        """
+        if not self.is_cacheable(sampling):
+            return await generate(), self.GENERATED
+
+        key = cache_key(model, messages, sampling)
+
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            CACHE_HITS.inc(model=model)
+            return value, self.HIT
+
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            CACHE_COALESCED.inc(model=model)
+            # asyncio.wait: a waiter going away must not cancel the shared generation
+            await asyncio.wait({in_flight})
+            if not in_flight.cancelled():
+                return in_flight.result(), self.COALESCED
+            # The caller that owned the generation was cancelled, generate for this one
+            return await self.get_or_generate(model, messages, sampling, generate)
+
+        self.misses += 1
+        CACHE_MISSES.inc(model=model)
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+
+        try:
+            value = await generate()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark retrieved, waiters are optional
+            future.exception()
+            raise
+        else:
+            if value is not None:
+                self.put(key, value)
+            future.set_result(value)
+            return value, self.GENERATED
+        finally:
+            self._in_flight.pop(key, None)
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+response_cache = ResponseCache(
+    max_entries=config.RESPONSE_CACHE_MAX_ENTRIES,
+    ttl_sec=config.RESPONSE_CACHE_TTL_SEC,
+    allow_sampling=config.RESPONSE_CACHE_ALLOW_SAMPLING,
+)
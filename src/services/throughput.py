@@ -0,0 +1,129 @@
+import logging
+import threading
+from typing import Dict, List, Tuple
+from src.services.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+PREFILL_RATE = registry.gauge(
+    "llm_prefill_tokens_per_second_estimate",
+    "Rolling estimate of prompt tokens processed per second until the first token",
+    ("model",),
+)
+DECODE_RATE = registry.gauge(
+    "llm_decode_tokens_per_second_estimate",
+    "Rolling estimate of generated tokens per second after the first token",
+    ("model",),
+)
+
+
+class ThroughputTracker:
+    """
+    Rolling (exponentially weighted) prefill and decode rates per model, fed by every
+    finished generation. Deadline mode uses them to size max_tokens so that a reply
+    fits a latency budget.
+
+    Time to first token is modelled as a fixed overhead plus a per prompt token cost,
+    fitted by least squares over weighted running means. A plain tokens / ttft rate
+    would mistake the overhead of short prompts for slow prefill.
+    """
+
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        # Running means of prompt tokens x and ttft y: [x, y, x*x, x*y]
+        self._prefill: Dict[str, List[float]] = {}
+        self._decode: Dict[str, float] = {}
+        # Observations come from the event loop and the inference thread
+        self._lock = threading.Lock()
+
+    def _update(self, rates: Dict[str, float], model: str, value: float) -> float:
+        previous = rates.get(model)
+        rate = value if previous is None else previous + self.alpha * (value - previous)
+        rates[model] = rate
+        return rate
+
+    def _fit_prefill(self, model: str, prompt_tokens: int, ttft_sec: float):
+        sample = (prompt_tokens, ttft_sec, prompt_tokens * prompt_tokens, prompt_tokens * ttft_sec)
+        means = self._prefill.get(model)
+        if means is None:
+            self._prefill[model] = list(sample)
+        else:
+            for i, value in enumerate(sample):
+                means[i] += self.alpha * (value - means[i])
+
+    @staticmethod
+    def _prefill_cost(means: List[float]) -> Tuple[float, float]:
+        """Overhead in seconds and seconds per prompt token"""
+
+        x, y, xx, xy = means
+        variance = xx - x * x
+        # Slope only once prompts of clearly different lengths were seen
+        if variance > (0.1 * x) ** 2:
+            slope = (xy - x * y) / variance
+            if slope > 0:
+                return max(0.0, y - slope * x), slope
+
+        return 0.0, y / x if x else 0.0
+
+    def _prefill_sec(self, model: str, prompt_tokens: int) -> float | None:
+        means = self._prefill.get(model)
+        if means is None:
+            return None
+        overhead, per_token = self._prefill_cost(means)
+        return overhead + per_token * prompt_tokens
+
+    def observe(
+        self,
+        model: str,
+        latency_sec: float,
+        ttft_sec: float | None = None,
+        prompt_tokens: int | None = None,
+        output_tokens: int | None = None,
+    ):
+        """Record one finished generation"""
+
+        with self._lock:
+            if ttft_sec is None and prompt_tokens:
+                # Non-streaming responses have no first token time, split by the prefill estimate
+                ttft_sec = self._prefill_sec(model, prompt_tokens)
+            elif ttft_sec and prompt_tokens:
+                self._fit_prefill(model, prompt_tokens, ttft_sec)
+                _, per_token = self._prefill_cost(self._prefill[model])
+                if per_token > 0:
+                    PREFILL_RATE.set(1 / per_token, model=model)
+
+            # Without any prefill estimate the whole latency counts as decode time,
+            # which underestimates the rate and keeps deadline mode on the safe side
+            decode_sec = latency_sec - (ttft_sec or 0.0)
+            if output_tokens and output_tokens > 1 and decode_sec > 0:
+                rate = self._update(self._decode, model, output_tokens / decode_sec)
+                DECODE_RATE.set(rate, model=model)
+
+    def max_tokens_within(
+        self, model: str, budget_sec: float, prompt_tokens: int = 0
+    ) -> int | None:
+        """
+        Tokens the model is expected to generate within `budget_sec` after prefilling
+        `prompt_tokens`, None while there are no observations for the model
+        """
+        with self._lock:
+            decode_rate = self._decode.get(model)
+            prefill_sec = self._prefill_sec(model, prompt_tokens)
+
+        if decode_rate is None:
+            return None
+
+        return max(0, int((budget_sec - (prefill_sec or 0.0)) * decode_rate))
+
+    def rates(self, model: str) -> dict:
+        with self._lock:
+            means = self._prefill.get(model)
+            prefill = self._prefill_cost(means) if means else None
+            return {
+                "prefill_overhead_sec": prefill[0] if prefill else None,
+                "prefill_tokens_per_sec": 1 / prefill[1] if prefill and prefill[1] else None,
+                "decode_tokens_per_sec": self._decode.get(model),
+            }
+
+
+throughput = ThroughputTracker()
@@ -0,0 +1,307 @@
+"""
+Lightweight per-turn tracing of the request hot path.
+
+Every WebSocket turn starts a trace whose ID is returned in its final frames.
+Sampled traces record nested spans (room lookup, history append, serialization,
+model requests, ...) that are written to rotating JSONL files by a background
+thread, see src/trace_report.py for the per-stage latency report.
+"""
+
+import asyncio
+import contextvars
+import functools
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List
+from src.config import config
+from src.services import json_codec
+
+logger = logging.getLogger(__name__)
+
+
+class Span:
+    """One timed stage of a trace, use set() to attach attributes"""
+
+    __slots__ = (
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "name",
+        "sampled",
+        "attributes",
+        "error",
+        "_start_time",
+        "_start",
+    )
+
+    def __init__(self, trace_id: str, parent_id: str | None, name: str, sampled: bool):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.sampled = sampled
+        self.attributes: Dict = {}
+        self.error: str | None = None
+        self._start_time = time.time()
+        self._start = time.monotonic()
+
+    def set(self, **attributes):
+        if self.sampled:
+            self.attributes.update(attributes)
+
+    def to_dict(self, duration_sec: float) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self._start_time,
+            "duration_ms": duration_sec * 1000,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class _NoopSpan:
+    """Stands in for spans of unsampled traces, or outside of any trace"""
+
+    trace_id = None
+    sampled = False
+
+    def set(self, **attributes):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+_current_span: contextvars.ContextVar[Span | None] = contextvars.ContextVar(
+    "current_span", default=None
+)
+
+
+class SpanExporter:
+    """
+    Writes finished spans to a JSONL file from a background thread, so tracing never
+    blocks a turn on disk I/O. The file is rotated once it grows over `max_bytes`,
+    keeping `backup_count` older files. Like the W&B metrics sink, spans are dropped
+    and counted when the bounded queue is full.
+
+    Each process writes its own file, uvicorn workers never rotate each other's files.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int = 50_000_000,
+        backup_count: int = 5,
+        max_queue_size: int = 10000,
+        flush_interval_sec: float = 1.0,
+    ):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval_sec = flush_interval_sec
+        self.dropped = 0
+        self.exported = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+        self._file = None
+
+    @property
+    def path(self) -> Path:
+        return self.directory / f"spans-{os.getpid()}.jsonl"
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(
+                    target=self._run, name="span-exporter", daemon=True
+                )
+                self._thread.start()
+
+    def submit(self, record: dict) -> bool:
+        """Queue a finished span without blocking, return False if it was dropped"""
+
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+        if self._thread is None:
+            self.start()
+
+        return True
+
+    def _drain(self) -> List[dict]:
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                return batch
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        path = self.path
+        for i in range(self.backup_count - 1, 0, -1):
+            older = path.with_name(f"{path.name}.{i}")
+            if older.exists():
+                older.replace(path.with_name(f"{path.name}.{i + 1}"))
+        if self.backup_count > 0:
+            path.replace(path.with_name(f"{path.name}.1"))
+        else:
+            path.unlink()
+
+    def _write(self, batch: List[dict]):
+        if not batch:
+            return
+
+        try:
+            if self._file is None:
+                self.directory.mkdir(parents=True, exist_ok=True)
+                self._file = open(self.path, "ab")  # pylint: disable=consider-using-with
+            self._file.write(b"".join(json_codec.dumps(record) + b"\n" for record in batch))
+            self._file.flush()
+            self.exported += len(batch)
+            if self._file.tell() >= self.max_bytes:
+                self._rotate()
+        except OSError as e:
+            logger.error("Could not export %d spans: %s", len(batch), e)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval_sec)]
+            except queue.Empty:
+                continue
+            batch.extend(self._drain())
+            self._write(batch)
+
+    def close(self, timeout: float = 5.0):
+        """Stop the worker and write every queued span"""
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+            self._thread = None
+
+        self._write(self._drain())
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class Tracer:
+    """
+    Creates traces and their nested spans. The current span lives in a context
+    variable, so spans opened in tasks started by a traced coroutine are nested
+    under it. A trace is sampled with probability `sample_rate`: unsampled traces
+    still get an ID, but record and export nothing.
+
+    Spans must not stay open across a `yield` of an async generator, the generator
+    runs in the context of its consumer. Record those stages with add_span instead.
+    """
+
+    def __init__(self, exporter: SpanExporter, sample_rate: float = 0.0):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+
+    @contextmanager
+    def _activate(self, span: Span) -> Iterator[Span]:
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = type(e).__name__
+            raise
+        finally:
+            _current_span.reset(token)
+            if span.sampled:
+                self.exporter.submit(span.to_dict(time.monotonic() - span._start))
+
+    def trace(self, name: str, **attributes):
+        """Start a new trace with its root span"""
+
+        sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        span = Span(os.urandom(16).hex(), None, name, sampled)
+        span.set(**attributes)
+
+        return self._activate(span)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Open a child span of the current one, a no-op outside of sampled traces"""
+
+        parent = _current_span.get()
+        if parent is None or not parent.sampled:
+            yield NOOP_SPAN
+            return
+
+        span = Span(parent.trace_id, parent.span_id, name, True)
+        span.set(**attributes)
+        with self._activate(span):
+            yield span
+
+    def add_span(self, name: str, start: float, end: float, **attributes):
+        """Record a finished stage measured with time.monotonic() as a child span"""
+
+        parent = _current_span.get()
+        if parent is None or not parent.sampled:
+            return
+
+        span = Span(parent.trace_id, parent.span_id, name, True)
+        span._start_time -= span._start - start
+        span.attributes.update(attributes)
+        self.exporter.submit(span.to_dict(end - start))
+
+    def current_span(self):
+        return _current_span.get() or NOOP_SPAN
+
+    def current_trace_id(self) -> str | None:
+        span = _current_span.get()
+        return span.trace_id if span is not None else None
+
+
+def traced(name: str):
+    """Decorator running every call of a function, sync or async, in a span"""
+
+    def decorator(fn):
+        if asyncio.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with tracer.span(name):
+                    return await fn(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+tracer = Tracer(
+    SpanExporter(
+        config.TRACE_DIR,
+        max_bytes=config.TRACE_MAX_BYTES,
+        backup_count=config.TRACE_BACKUP_COUNT,
+        max_queue_size=config.TRACE_QUEUE_SIZE,
+    ),
+    sample_rate=config.TRACE_SAMPLE_RATE,
+)
@@ -0,0 +1,163 @@
+"""
+One metrics schema for every generation of a turn, whatever the mode and transport.
+
+Timing is measured on the app side, from the arrival of the response chunks:
+    ttft_ms             time to the first generated token
+    itl_ms              mean inter-token latency, decode time / (completion tokens - 1)
+    itl_p95_ms          95th percentile of the gaps between chunks, the stalls a reader sees
+    total_ms            whole generation
+    output_tok_per_sec  decode throughput after the first token
+
+Fields that cannot be measured for a generation (e.g. ttft_ms of a cached reply) are None.
+"""
+
+import time
+from typing import Dict, Iterable, List
+
+TIMING_FIELDS = ("ttft_ms", "itl_ms", "itl_p95_ms", "total_ms", "output_tok_per_sec")
+# Lower is better for every timing field except the throughput
+HIGHER_IS_BETTER = ("output_tok_per_sec",)
+
+
+def percentile(values: List[float], q: float) -> float | None:
+    """Nearest-rank percentile, q in [0, 100]"""
+
+    if not values:
+        return None
+
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))]
+
+
+class TokenTimer:
+    """Arrival times of the chunks of one generation, measured with time.monotonic()"""
+
+    __slots__ = ("start", "first_token", "last_token", "_gaps")
+
+    def __init__(self, start: float | None = None):
+        self.start = time.monotonic() if start is None else start
+        self.first_token: float | None = None
+        self.last_token: float | None = None
+        self._gaps: List[float] = []
+
+    def token(self):
+        """A chunk with generated text arrived"""
+
+        now = time.monotonic()
+        if self.first_token is None:
+            self.first_token = now
+        else:
+            self._gaps.append(now - self.last_token)
+        self.last_token = now
+
+    def timing(self, completion_tokens: int | None, end: float | None = None) -> dict:
+        end = time.monotonic() if end is None else end
+        timing = dict.fromkeys(TIMING_FIELDS)
+        timing["total_ms"] = (end - self.start) * 1000
+
+        if self.first_token is None:
+            return timing
+
+        timing["ttft_ms"] = (self.first_token - self.start) * 1000
+        decode_sec = self.last_token - self.first_token
+        if completion_tokens and completion_tokens > 1 and decode_sec > 0:
+            timing["itl_ms"] = decode_sec / (completion_tokens - 1) * 1000
+            timing["output_tok_per_sec"] = (completion_tokens - 1) / decode_sec
+        if self._gaps:
+            timing["itl_p95_ms"] = percentile(self._gaps, 95) * 1000
+
+        return timing
+
+
+def request_output_timing(request_output, total_sec: float) -> dict:
+    """Timing of a non-streamed vLLM RequestOutput, from the engine's request metrics"""
+
+    timing = dict.fromkeys(TIMING_FIELDS)
+    timing["total_ms"] = total_sec * 1000
+
+    metrics = getattr(request_output, "metrics", None)
+    if not metrics or not metrics.first_token_time or not metrics.arrival_time:
+        return timing
+
+    timing["ttft_ms"] = (metrics.first_token_time - metrics.arrival_time) * 1000
+    completion_tokens = len(request_output.outputs[0].token_ids) if request_output.outputs else 0
+    if metrics.last_token_time and completion_tokens > 1:
+        decode_sec = metrics.last_token_time - metrics.first_token_time
+        if decode_sec > 0:
+            timing["itl_ms"] = decode_sec / (completion_tokens - 1) * 1000
+            timing["output_tok_per_sec"] = (completion_tokens - 1) / decode_sec
+
+    return timing
+
+
+def turn_metrics(
+    model: str,
+    timing: dict,
+    prompt_tokens: int | None = None,
+    completion_tokens: int | None = None,
+    error: bool = False,
+    cached: bool = False,
+) -> dict:
+    """The metrics record of one generation, sent in done frames and kept for room stats"""
+
+    return {
+        "model": model,
+        "error": error,
+        "cached": cached,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        **{field: timing.get(field) for field in TIMING_FIELDS},
+        "finished_at": time.time(),
+    }
+
+
+def comparison_summary(metrics: Dict[str, dict]) -> dict:
+    """
+    Which side did better on each timing field and by how much, over {side: metrics record}.
+    Sides are conversations rather than models, both may run the same model with
+    different settings. Fields missing for a side are skipped.
+    """
+    summary = {}
+    for field in TIMING_FIELDS:
+        values = {
+            side: record[field]
+            for side, record in metrics.items()
+            if not record.get("error") and record.get(field) is not None
+        }
+        if len(values) < 2:
+            continue
+
+        ordered = sorted(values, key=values.get, reverse=field in HIGHER_IS_BETTER)
+        best, runner_up = values[ordered[0]], values[ordered[1]]
+        summary[field] = {
+            "best": ordered[0],
+            "difference": abs(best - runner_up),
+            "ratio": max(best, runner_up) / min(best, runner_up) if min(best, runner_up) else None,
+        }
+
+    return summary
+
+
+def aggregate(records: Iterable[dict]) -> dict:
+    """
+    Totals and mean / p50 / p95 of every timing field over the records of one side.
+    Failed and cached generations are counted but left out of the timing stats.
+    """
+    records = list(records)
+    measured = [r for r in records if not r["error"] and not r["cached"]]
+    stats = {
+        "turns": len(records),
+        "errors": sum(r["error"] for r in records),
+        "cached": sum(r["cached"] for r in records),
+        "prompt_tokens": sum(r["prompt_tokens"] or 0 for r in records),
+        "completion_tokens": sum(r["completion_tokens"] or 0 for r in records),
+    }
+    for field in TIMING_FIELDS:
+        values = [r[field] for r in measured if r.get(field) is not None]
+        stats[field] = {
+            "mean": sum(values) / len(values) if values else None,
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+        }
+
+    return stats
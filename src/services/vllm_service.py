@@ -1,34 +1,670 @@
+import asyncio
+import gc
+import logging
+import sys
+import threading
 import time
-from vllm import LLM, SamplingParams
-from vllm.config import CompilationConfig
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from typing import TYPE_CHECKING, AsyncIterator, Dict, List, Tuple
 from dotenv import load_dotenv
+from src.config import config
+from src.services.inference_executor import BatchingExecutor
+from src.services.metrics import (
+    REQUEST_ERRORS,
+    REQUESTS_CANCELLED,
+    REQUESTS_IN_FLIGHT,
+    observe_generation,
+    registry,
+)
+from src.services.response_cache import response_cache
+from src.services.throughput import throughput
+from src.services.tracing import traced, tracer
+from src.services.turn_metrics import request_output_timing
+from src.startup import startup_report
+
+if TYPE_CHECKING:
+    from vllm import RequestOutput
 
 load_dotenv()
 
-sampling_params = SamplingParams(temperature=0.8, max_tokens=2000)
+logger = logging.getLogger(__name__)
 
-compilation_config = CompilationConfig(
-    level=2,
-    use_cudagraph=True,
-    cudagraph_num_of_warmups=3,
-    use_inductor=True,
-    cache_dir="/tmp/vllm_compile_cache",
+# Default model of single mode rooms
+SM_MODEL = config.SM_MODELS[0]
+
+ENGINE_LOAD_SECONDS = registry.histogram(
+    "sm_engine_load_seconds",
+    "Time to load an in-process engine",
+    ("model",),
+    buckets=(1, 5, 10, 20, 30, 60, 120, 300, 600),
+)
+ENGINE_EVICT_SECONDS = registry.histogram(
+    "sm_engine_evict_seconds", "Time to unload an evicted in-process engine", ("model",)
 )
+ENGINE_LOAD_FAILURES = registry.counter(
+    "sm_engine_load_failures_total", "In-process engines that failed to load", ("model",)
+)
+ENGINE_LOADED = registry.gauge(
+    "sm_engine_loaded", "Whether the engine of a model is loaded (1) or not (0)", ("model",)
+)
+ENGINE_MEMORY_GB = registry.gauge(
+    "sm_engine_memory_reserved_gb", "GPU memory reserved by loaded in-process engines"
+)
+
+
+class EngineCapacityError(Exception):
+    """Raised when an engine does not fit the memory budget because the others stay busy"""
+
+
+class EngineFactory:
+    """
+    Builds the single mode engine of one model on first use instead of at import time,
+    so the app starts without importing vllm/torch when single mode is not needed.
+
+    Streaming mode needs an engine that yields partial outputs, the offline LLM class
+    only returns finished requests. Only one of them is built to keep a single copy
+    of the weights and KV cache on the GPU.
+    """
+
+    NOT_LOADED = "not_loaded"
+    LOADING = "loading"
+    READY = "ready"
+    FAILED = "failed"
+    DISABLED = "disabled"
+    EVICTED = "evicted"
+
+    def __init__(self, model: str, memory_gb: float | None = None):
+        self.model = model
+        self.memory_gb = memory_gb
+        self.status = self.NOT_LOADED if config.SM_ENABLED else self.DISABLED
+        self.error: str | None = None
+        self._engine = None
+        self._sampling_params = None
+        self._sampling_params_cls = None
+        self._sampling_defaults = {
+            "temperature": config.SM_TEMPERATURE,
+            "max_tokens": config.SM_MAX_TOKENS,
+        }
+        self._lock = threading.Lock()
+
+    @property
+    def is_ready(self) -> bool:
+        return self.status == self.READY
+
+    def _build(self):
+        if config.SM_ENGINE == "fake":
+            # CPU-only benchmarking, see benchmarks/README.md
+            from src.services.fake_engine import (  # pylint: disable=import-outside-toplevel
+                FakeAsyncEngine,
+                FakeLLM,
+                FakeSamplingParams,
+            )
+
+            self._sampling_params_cls = FakeSamplingParams
+            self._sampling_params = FakeSamplingParams(**self._sampling_defaults)
+            fake_engine_settings = {
+                "model": self.model,
+                "prefill_ms": config.FAKE_ENGINE_PREFILL_MS,
+                "tokens_per_sec": config.FAKE_ENGINE_TOKENS_PER_SEC,
+                "output_tokens": config.FAKE_ENGINE_OUTPUT_TOKENS,
+            }
+            engine_cls = FakeAsyncEngine if config.STREAMING else FakeLLM
+            return engine_cls(**fake_engine_settings)
+
+        with startup_report.phase("import:vllm"):
+            # pylint: disable=import-outside-toplevel
+            from vllm import LLM, SamplingParams, AsyncEngineArgs, AsyncLLMEngine
+            from vllm.config import CompilationConfig
+
+        self._sampling_params_cls = SamplingParams
+        self._sampling_params = SamplingParams(**self._sampling_defaults)
+        compilation_config = CompilationConfig(
+            level=2,
+            use_cudagraph=True,
+            cudagraph_num_of_warmups=3,
+            use_inductor=True,
+            cache_dir="/tmp/vllm_compile_cache",
+        )
+
+        engine_args = {"model": self.model, "compilation_config": compilation_config}
+        if config.SM_MEMORY_BUDGET_GB > 0 and self.memory_gb:
+            # Several engines share the GPU, each takes its own slice instead of 90% of it
+            import torch  # pylint: disable=import-outside-toplevel
+
+            total_gb = torch.cuda.mem_get_info()[1] / 1e9
+            engine_args["gpu_memory_utilization"] = min(0.95, self.memory_gb / total_gb)
+
+        if config.STREAMING:
+            return AsyncLLMEngine.from_engine_args(AsyncEngineArgs(**engine_args))
+        return LLM(**engine_args)
+
+    def get(self):
+        """Return the engine, loading it on the calling thread if needed"""
+
+        if self._engine is not None:
+            return self._engine
+
+        with self._lock:
+            if self._engine is None:
+                self.status = self.LOADING
+                start_time = time.monotonic()
+                try:
+                    with startup_report.phase(f"init:sm_engine:{self.model}"):
+                        self._engine = self._build()
+                except Exception as e:
+                    self.status = self.FAILED
+                    self.error = f"{type(e).__name__}: {e}"
+                    ENGINE_LOAD_FAILURES.inc(model=self.model)
+                    raise
+                load_sec = time.monotonic() - start_time
+                self.status = self.READY
+                self.error = None
+                ENGINE_LOAD_SECONDS.observe(load_sec, model=self.model)
+                ENGINE_LOADED.set(1, model=self.model)
+                logger.info("Loaded the %s engine in %.1fs", self.model, load_sec)
+
+        return self._engine
+
+    def detach(self):
+        """Forget the engine, the next get() builds a new one. Returns the old engine"""
+
+        with self._lock:
+            engine, self._engine = self._engine, None
+            if engine is not None:
+                self.status = self.EVICTED
+                ENGINE_LOADED.set(0, model=self.model)
+
+        return engine
+
+    def shutdown(self, engine):
+        """Stop a detached engine and give its GPU memory back"""
+
+        start_time = time.monotonic()
+        # The async engine and the offline engine's core run background processes
+        for target in (engine, getattr(engine, "llm_engine", None)):
+            shutdown = getattr(target, "shutdown", None)
+            if callable(shutdown):
+                try:
+                    shutdown()
+                except Exception as e:
+                    logger.warning("Error shutting down the %s engine: %s", self.model, e)
+        del engine
+        gc.collect()
+        torch = sys.modules.get("torch")
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+        evict_sec = time.monotonic() - start_time
+        ENGINE_EVICT_SECONDS.observe(evict_sec, model=self.model)
+        logger.info("Unloaded the %s engine in %.1fs", self.model, evict_sec)
+
+    @property
+    def sampling_params(self):
+        self.get()
+        return self._sampling_params
+
+    def sampling_params_for(self, sampling: dict | None = None):
+        """
+        Default sampling params with the fields of `sampling` replaced, e.g. per turn.
+        Built anew rather than cloned and patched, so that the overrides are validated
+        and the derived fields (e.g. greedy sampling at temperature 0) are set like
+        for the defaults.
+
+        Raises:
+            ValueError: if vLLM rejects the parameters
+        """
+        self.get()
+        return self._sampling_params_cls(**{**self._sampling_defaults, **(sampling or {})})
+
+    async def get_async(self):
+        """Return the engine without blocking the event loop while it loads"""
+
+        if self._engine is not None:
+            return self._engine
+        return await asyncio.to_thread(self.get)
+
+
+class EngineRegistry:
+    """
+    In-process engines by model name, loaded on demand within a GPU memory budget.
+
+    Before an engine is loaded, the least recently used engines that serve no request
+    are evicted until its declared memory fits `budget_gb`. A budget of 0 keeps a single
+    engine loaded. Engines are pinned while they serve a request (see use/pinned), so an
+    engine is never unloaded under a running generation: a request for a model that does
+    not fit waits up to `swap_timeout_sec` for them to finish. Concurrent requests for a
+    model that is loading wait for that load instead of starting another one.
+    """
+
+    # How often a request waiting for busy engines checks again
+    _WAIT_INTERVAL_SEC = 0.05
+
+    def __init__(
+        self,
+        models: List[str],
+        memory_gb: Dict[str, float] | None = None,
+        default_memory_gb: float = 8.0,
+        budget_gb: float = 0.0,
+        swap_timeout_sec: float = 30.0,
+    ):
+        self.budget_gb = budget_gb
+        self.swap_timeout_sec = swap_timeout_sec
+        self._factories: Dict[str, EngineFactory] = {
+            model: EngineFactory(model, (memory_gb or {}).get(model, default_memory_gb))
+            for model in models
+        }
+        # Loaded or loading models, least recently used first
+        self._resident: OrderedDict = OrderedDict()
+        self._pins: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def models(self) -> List[str]:
+        return list(self._factories)
+
+    def factory(self, model: str) -> EngineFactory:
+        """
+        Raises:
+            KeyError: if the model is not one of SM_MODELS
+        """
+        return self._factories[model]
+
+    def _memory_gb(self, models) -> float:
+        return sum(self._factories[model].memory_gb for model in models)
+
+    def _fits(self, model: str, resident: List[str]) -> bool:
+        if not resident:
+            return True
+        if self.budget_gb <= 0:
+            return False
+        return self._memory_gb(resident) + self._factories[model].memory_gb <= self.budget_gb
+
+    def _reserve(self, model: str) -> List[Tuple[EngineFactory, object]]:
+        """
+        Pin the model and make room for it
+
+        Returns:
+            The evicted factories and their detached engines, to shut down
+
+        Raises:
+            KeyError: if the model is not one of SM_MODELS
+            EngineCapacityError: if engines in use leave no room for the model
+        """
+        factory = self.factory(model)
+
+        with self._lock:
+            if model in self._resident:
+                self._resident.move_to_end(model)
+                self._pins[model] += 1
+                return []
+
+            resident = list(self._resident)
+            victims = []
+            for name in list(resident):
+                if self._fits(model, resident):
+                    break
+                if self._pins[name] == 0:
+                    resident.remove(name)
+                    victims.append(name)
+
+            if not self._fits(model, resident):
+                raise EngineCapacityError(
+                    f"No room for the {model} engine ({factory.memory_gb:g} GB), "
+                    f"engines in use: {', '.join(resident)}"
+                )
+
+            evicted = []
+            for name in victims:
+                del self._resident[name]
+                del self._pins[name]
+                # Detached under the lock, a request for it from now on loads a new engine
+                evicted.append((self._factories[name], self._factories[name].detach()))
+
+            self._resident[model] = None
+            self._pins[model] = 1
+            ENGINE_MEMORY_GB.set(self._memory_gb(self._resident))
+
+        return evicted
+
+    def _release(self, model: str, failed: bool = False):
+        with self._lock:
+            self._pins[model] -= 1
+            if failed and self._pins[model] == 0:
+                # The next request retries the load
+                del self._resident[model]
+                del self._pins[model]
+                ENGINE_MEMORY_GB.set(self._memory_gb(self._resident))
+
+    def _shutdown(self, evicted: List[Tuple[EngineFactory, object]]):
+        for factory, engine in evicted:
+            if engine is not None:
+                logger.info("Evicting the %s engine to make room", factory.model)
+                factory.shutdown(engine)
+
+    @contextmanager
+    def pinned(self, model: str):
+        """Load the engine of a model on the calling thread and keep it loaded in the block"""
+
+        deadline = time.monotonic() + self.swap_timeout_sec
+        while True:
+            try:
+                evicted = self._reserve(model)
+                break
+            except EngineCapacityError:
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(self._WAIT_INTERVAL_SEC)
+
+        self._shutdown(evicted)
+        factory = self.factory(model)
+        try:
+            factory.get()
+        except Exception:
+            self._release(model, failed=True)
+            raise
+
+        try:
+            yield factory
+        finally:
+            self._release(model)
+
+    @asynccontextmanager
+    async def use(self, model: str):
+        """Like pinned, waiting, loading and unloading off the event loop"""
+
+        deadline = time.monotonic() + self.swap_timeout_sec
+        while True:
+            try:
+                evicted = self._reserve(model)
+                break
+            except EngineCapacityError:
+                if time.monotonic() >= deadline:
+                    raise
+                await asyncio.sleep(self._WAIT_INTERVAL_SEC)
+
+        factory = self.factory(model)
+        try:
+            if evicted:
+                await asyncio.to_thread(self._shutdown, evicted)
+            await factory.get_async()
+        except asyncio.CancelledError:
+            # The load goes on in its thread, keep its memory reserved
+            self._release(model)
+            raise
+        except Exception:
+            self._release(model, failed=True)
+            raise
+
+        try:
+            yield factory
+        finally:
+            self._release(model)
+
+    async def warmup(self, model: str = SM_MODEL):
+        """Load the engine and run a one-token generation to trigger compilation"""
+
+        try:
+            async with self.use(model) as factory:
+                engine = factory.get()
+                params = factory.sampling_params_for({"max_tokens": 1})
+                with startup_report.phase("warmup:sm_engine"):
+                    if config.STREAMING:
+                        async for _ in engine.generate("Hi", params, request_id="warmup"):
+                            pass
+                    else:
+                        # The offline engine is not thread-safe, run on the inference thread
+                        await inference_executor.run(
+                            engine.chat, [{"role": "user", "content": "Hi"}], params
+                        )
+        except Exception as e:
+            logger.error("Single mode engine warmup failed: %s", e)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "budget_gb": self.budget_gb,
+                "reserved_gb": self._memory_gb(self._resident),
+                "engines": {
+                    model: {
+                        "status": factory.status,
+                        "memory_gb": factory.memory_gb,
+                        "in_use": self._pins.get(model, 0),
+                    }
+                    for model, factory in self._factories.items()
+                },
+            }
+
+
+engine_registry = EngineRegistry(
+    config.SM_MODELS,
+    memory_gb=config.SM_MODEL_MEMORY_GB,
+    default_memory_gb=config.SM_DEFAULT_MODEL_MEMORY_GB,
+    budget_gb=config.SM_MEMORY_BUDGET_GB,
+    swap_timeout_sec=config.SM_ENGINE_SWAP_TIMEOUT_SEC,
+)
+# Engine of the default model
+engine_factory = engine_registry.factory(SM_MODEL)
+
+
+def _chat_messages(conversation) -> list:
+    """vLLM chat APIs and chat templates take plain dicts"""
+
+    return [
+        message.to_dict() if hasattr(message, "to_dict") else message
+        for message in conversation
+    ]
+
+
+def _observe_output(
+    request_output, duration_sec: float, ttft_sec: float | None = None, model: str = SM_MODEL
+):
+    """Record generation metrics of a finished request"""
+    if ttft_sec is None:
+        metrics = getattr(request_output, "metrics", None)
+        if metrics and metrics.first_token_time and metrics.arrival_time:
+            ttft_sec = metrics.first_token_time - metrics.arrival_time
+
+    output_tokens = None
+    if request_output.outputs:
+        output_tokens = len(request_output.outputs[0].token_ids)
+
+    itl_ms = request_output_timing(request_output, duration_sec)["itl_ms"]
+    observe_generation(
+        model,
+        duration_sec,
+        ttft_sec,
+        output_tokens,
+        itl_sec=itl_ms / 1000 if itl_ms is not None else None,
+    )
+    throughput.observe(
+        model,
+        duration_sec,
+        ttft_sec=ttft_sec,
+        prompt_tokens=len(request_output.prompt_token_ids or []),
+        output_tokens=output_tokens,
+    )
 
-llm = LLM(model="google/gemma-3-1b-it", compilation_config=compilation_config)
 
 class VLLMService:
 
-    def generate_response(self, conversation):
+    @traced("vllm.generate")
+    def generate_response(self, conversation, model: str = SM_MODEL):
         """Generates a response using vLLM."""
         start_time = time.monotonic()
+        REQUESTS_IN_FLIGHT.inc(model=model)
 
         try:
-            output = llm.chat(conversation, sampling_params=sampling_params)
+            with engine_registry.pinned(model) as factory:
+                output = factory.get().chat(
+                    _chat_messages(conversation), sampling_params=factory.sampling_params
+                )
         except Exception as e:
+            REQUEST_ERRORS.inc(model=model, reason="engine")
             raise Exception(f"Error generating response with vLLM: {str(e)}") from e
+        finally:
+            REQUESTS_IN_FLIGHT.dec(model=model)
 
         end_time = time.monotonic()
         duration_sec = end_time - start_time
 
+        if output:
+            _observe_output(output[0], duration_sec, model=model)
+
         return output, duration_sec
+
+    def generate_batch(self, requests, model: str = SM_MODEL):
+        """
+        Generates responses for several conversations with one llm.chat call.
+        Each request is a (messages, sampling params) pair, vLLM samples every
+        conversation of the batch with its own params.
+        """
+        conversations = [messages for messages, _ in requests]
+        sampling_params = [params for _, params in requests]
+        try:
+            with engine_registry.pinned(model) as factory:
+                return factory.get().chat(conversations, sampling_params=sampling_params)
+        except Exception as e:
+            raise Exception(f"Error generating response with vLLM: {str(e)}") from e
+
+    def generate_batches(self, items):
+        """
+        Batch function of the inference executor. Items are (model, messages, sampling params),
+        those of each model go through one llm.chat call of its engine. A model that fails,
+        e.g. does not fit the memory budget, fails the items of that model only.
+        """
+        by_model: Dict[str, List[int]] = {}
+        for i, (model, _, _) in enumerate(items):
+            by_model.setdefault(model, []).append(i)
+
+        results = [None] * len(items)
+        for model, indexes in by_model.items():
+            try:
+                outputs = self.generate_batch([items[i][1:] for i in indexes], model)
+            except Exception as e:
+                logger.error("Batch of %d for %s failed: %s", len(indexes), model, e)
+                outputs = [e] * len(indexes)
+            for i, output in zip(indexes, outputs):
+                results[i] = output
+
+        return results
+
+    @traced("vllm.generate")
+    async def generate_response_async(
+        self, conversation, sampling: dict | None = None, model: str = SM_MODEL
+    ):
+        """
+        Generates a response on the inference thread without blocking the event loop.
+        Concurrent turns are batched together into a single llm.chat call.
+        Identical deterministic requests are answered from the response cache.
+        `sampling` overrides fields of the default sampling params for this request.
+
+        Returns:
+            The request outputs, the duration in seconds, and whether the output was
+            not generated for this request but came from the response cache
+        """
+        start_time = time.monotonic()
+
+        async def generate():
+            REQUESTS_IN_FLIGHT.inc(model=model)
+            try:
+                # Waiting for the batch window, then prefill and decode of the whole batch
+                with tracer.span("vllm.batch"):
+                    output = await inference_executor.submit(
+                        (model, _chat_messages(conversation), params)
+                    )
+            except asyncio.CancelledError:
+                # Dropped from the queue if its batch has not started yet
+                REQUESTS_CANCELLED.inc(model=model)
+                raise
+            except Exception:
+                REQUEST_ERRORS.inc(model=model, reason="engine")
+                raise
+            finally:
+                REQUESTS_IN_FLIGHT.dec(model=model)
+
+            _observe_output(output, time.monotonic() - start_time, model=model)
+            return output
+
+        # Loads off the event loop and keeps the engine from being evicted until done,
+        # the sampling params are known once the engine is built
+        async with engine_registry.use(model) as factory:
+            params = factory.sampling_params_for(sampling)
+            cache_sampling = {
+                "temperature": params.temperature,
+                "top_p": params.top_p,
+                "max_tokens": params.max_tokens,
+            }
+            output, source = await response_cache.get_or_generate(
+                model, conversation, cache_sampling, generate
+            )
+
+        return [output], time.monotonic() - start_time, source != response_cache.GENERATED
+
+    async def stream_response(
+        self, conversation, sampling: dict | None = None, model: str = SM_MODEL
+    ) -> AsyncIterator[Tuple[str, "RequestOutput"]]:
+        """
+        Streams a response using the async vLLM engine.
+        `sampling` overrides fields of the default sampling params for this request.
+
+        Yields:
+            Tuple[str, RequestOutput]: newly generated text and the cumulative request output
+        """
+        if not config.STREAMING:
+            raise Exception("Async vLLM engine is not initialized, set STREAMING=true")
+
+        start_time = time.monotonic()
+        first_token_time = None
+        request_output = None
+        REQUESTS_IN_FLIGHT.inc(model=model)
+
+        try:
+            # Keeps the engine from being evicted until the stream is done
+            async with engine_registry.use(model) as factory:
+                async_engine = factory.get()
+                tokenizer = await async_engine.get_tokenizer()
+                prompt = tokenizer.apply_chat_template(
+                    _chat_messages(conversation), tokenize=False, add_generation_prompt=True
+                )
+                generated_text = ""
+                request_id = str(uuid.uuid4())
+
+                try:
+                    async for request_output in async_engine.generate(
+                        prompt, factory.sampling_params_for(sampling), request_id=request_id
+                    ):
+                        text = request_output.outputs[0].text if request_output.outputs else ""
+                        delta = text[len(generated_text):]
+                        generated_text = text
+                        if delta and first_token_time is None:
+                            first_token_time = time.monotonic()
+
+                        yield delta, request_output
+                except (asyncio.CancelledError, GeneratorExit):
+                    # The consumer went away, free the KV cache of the request right away
+                    await async_engine.abort(request_id)
+                    raise
+        except (asyncio.CancelledError, GeneratorExit):
+            REQUESTS_CANCELLED.inc(model=model)
+            raise
+        except Exception as e:
+            REQUEST_ERRORS.inc(model=model, reason="engine")
+            raise Exception(f"Error streaming response with vLLM: {str(e)}") from e
+        finally:
+            REQUESTS_IN_FLIGHT.dec(model=model)
+
+        if request_output is not None:
+            ttft_sec = first_token_time - start_time if first_token_time else None
+            _observe_output(
+                request_output, time.monotonic() - start_time, ttft_sec, model=model
+            )
+
+
+inference_executor = BatchingExecutor(
+    VLLMService().generate_batches,
+    window_ms=config.SM_BATCH_WINDOW_MS,
+    max_batch_size=config.SM_MAX_BATCH_SIZE,
+    name="vllm-inference",
+)
@@ -1,8 +1,14 @@
 import logging
 import atexit
-from typing import Any
-import wandb
-from vllm import RequestOutput
+import queue
+import threading
+import time
+from typing import TYPE_CHECKING, Any, List
+from src.config import config as app_config
+from src.startup import startup_report
+
+if TYPE_CHECKING:
+    from vllm import RequestOutput
 
 logger = logging.getLogger(__name__)
 
@@ -26,13 +32,18 @@ def init_wandb(
         return
 
     try:
-        _RUN = wandb.init(
-            project=project_name,
-            name=run_name,
-            config=config,
-            job_type=job_type,
-            reinit=True,
-        )
+        # wandb is slow to import, only pay for it when a run is started
+        with startup_report.phase("import:wandb"):
+            import wandb  # pylint: disable=import-outside-toplevel
+
+        with startup_report.phase("init:wandb"):
+            _RUN = wandb.init(
+                project=project_name,
+                name=run_name,
+                config=config,
+                job_type=job_type,
+                reinit=True,
+            )
         _WANDB_INITIALIZED = True
         logger.info(
             f"W&B initialized for project '{project_name}', run_id: {_RUN.id if _RUN else 'N/A'}"
@@ -45,18 +56,125 @@ def init_wandb(
         _RUN = None
 
 
-def log_metrics(metrics: dict, step: int = None):
+class MetricsSink:
     """
-    Logs a dictionary of metrics to W&B.
+    Ships metrics to W&B from a background thread so logging never adds latency to a turn.
+    Records go to a bounded queue and are flushed in batches when `batch_size` records
+    are collected or every `flush_interval_sec`. When the queue is full the record is
+    dropped and counted instead of blocking the caller.
     """
-    if _WANDB_INITIALIZED and _RUN:
+
+    def __init__(
+        self,
+        max_queue_size: int = 10000,
+        batch_size: int = 100,
+        flush_interval_sec: float = 5.0,
+    ):
+        self.batch_size = batch_size
+        self.flush_interval_sec = flush_interval_sec
+        self.dropped = 0
+        self.logged = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+        # Records taken off the queue but not yet written, owned by the worker thread
+        self._batch: List[tuple] = []
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(
+                    target=self._run, name="wandb-metrics-sink", daemon=True
+                )
+                self._thread.start()
+
+    def submit(self, metrics: dict, step: int = None) -> bool:
+        """Queue a record without blocking, return False if it was dropped"""
+
         try:
-            _RUN.log(metrics, step=step)
-            logger.debug("Logged metrics to W&B: %s", metrics)
-        except Exception as e:
-            logger.error("Failed to log metrics to W&B: %s", e)
-    elif not _WANDB_INITIALIZED:
+            self._queue.put_nowait((metrics, step))
+        except queue.Full:
+            self.dropped += 1
+            logger.debug("Metrics queue is full, dropped record (%d dropped)", self.dropped)
+            return False
+
+        if self._thread is None:
+            self.start()
+
+        return True
+
+    def _drain(self, limit: int) -> List[tuple]:
+        batch = []
+        while len(batch) < limit:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch: List[tuple]):
+        if not batch:
+            return
+        if not (_WANDB_INITIALIZED and _RUN):
+            logger.debug("W&B not initialized. Skipping %d metric records.", len(batch))
+            return
+
+        for metrics, step in batch:
+            try:
+                _RUN.log(metrics, step=step)
+                self.logged += 1
+            except Exception as e:
+                logger.error("Failed to log metrics to W&B: %s", e)
+        logger.debug("Logged %d metric records to W&B", len(batch))
+
+    def _run(self):
+        next_flush = time.monotonic() + self.flush_interval_sec
+
+        while not self._stop.is_set():
+            # Wake up regularly so close() does not wait for a whole flush interval
+            timeout = min(0.5, max(0.0, next_flush - time.monotonic()))
+            try:
+                self._batch.append(self._queue.get(timeout=timeout))
+                self._batch.extend(self._drain(self.batch_size - len(self._batch)))
+            except queue.Empty:
+                pass
+
+            if len(self._batch) >= self.batch_size or time.monotonic() >= next_flush:
+                batch, self._batch = self._batch, []
+                self._write(batch)
+                next_flush = time.monotonic() + self.flush_interval_sec
+
+    def close(self, timeout: float = 10.0):
+        """Stop the worker and flush every queued record"""
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+            self._thread = None
+
+        batch, self._batch = self._batch, []
+        batch.extend(self._drain(self._queue.qsize()))
+        self._write(batch)
+
+
+metrics_sink = MetricsSink(
+    max_queue_size=app_config.METRICS_QUEUE_SIZE,
+    batch_size=app_config.METRICS_BATCH_SIZE,
+    flush_interval_sec=app_config.METRICS_FLUSH_INTERVAL_SEC,
+)
+
+
+def log_metrics(metrics: dict, step: int = None):
+    """
+    Queues a dictionary of metrics for W&B, never blocks.
+    """
+    if not _WANDB_INITIALIZED:
         logger.debug("W&B not initialized. Skipping metrics logging.")
+        return
+
+    metrics_sink.submit(metrics, step=step)
 
 
 def log_generation_data(
@@ -88,9 +206,13 @@ def finish_wandb_run():
     Called automatically on exit if init_wandb was successful.
     """
     global _WANDB_INITIALIZED, _RUN
+    # Flush queued records while the run is still active
+    metrics_sink.close()
     if _WANDB_INITIALIZED and _RUN:
         logger.info(f"Attempting to finish W&B run: {_RUN.id}")
         try:
+            import wandb  # pylint: disable=import-outside-toplevel
+
             wandb.finish()  # wandb.finish() uses the current active run
             logger.info(f"W&B run {_RUN.id} finished.")
         except Exception as e:
@@ -102,17 +224,12 @@ def finish_wandb_run():
         _RUN = None
 
 
-def log_vllm_request_output_metrics(
-    vllm_request_output: RequestOutput | Any,
+def extract_vllm_request_output_metrics(
+    vllm_request_output: "RequestOutput | Any",
     manual_duration_sec: float = None,
-):
-    """Extracts metrics from vLLM's RequestOutput and logs them to W&B."""
-    if not vllm_request_output:
-        logger.warning("log_vllm_request_output_metrics called with None input.")
-        return
-
-    # Always calculate token counts
-    num_prompt_tokens = len(vllm_request_output.prompt_token_ids)
+) -> dict:
+    """Extracts one flat metrics record from vLLM's RequestOutput."""
+    num_prompt_tokens = len(vllm_request_output.prompt_token_ids or [])
     num_generated_tokens = 0
     if vllm_request_output.outputs and len(vllm_request_output.outputs) > 0:
         num_generated_tokens = len(vllm_request_output.outputs[0].token_ids)
@@ -142,74 +259,64 @@ def log_vllm_request_output_metrics(
         elif num_generated_tokens == 0:
             metrics_to_log["manual_output_tok_per_sec"] = 0.0
 
-    # Process and add detailed metrics from vLLM if they exist
-    if vllm_request_output.metrics:
-        metrics = vllm_request_output.metrics
-        num_prompt_tokens = len(vllm_request_output.prompt_token_ids)
-
-        num_generated_tokens = 0
-        if vllm_request_output.outputs and len(vllm_request_output.outputs) > 0:
-            num_generated_tokens = len(vllm_request_output.outputs[0].token_ids)
-        else:
-            logger.warning(
-                "No outputs found in vLLM RequestOutput for request_id: %s",
-                vllm_request_output.request_id,
+    metrics = vllm_request_output.metrics
+    if not metrics:
+        # This refers to vLLM's internal detailed metrics, manual metrics are still logged
+        logger.debug(
+            "No internal detailed metrics (vllm_request_output.metrics) found in vLLM RequestOutput for request_id: %s.",
+            vllm_request_output.request_id,
+        )
+        return {k: v for k, v in metrics_to_log.items() if v is not None}
+
+    # Initialize metrics to None
+    prompt_processing_time_sec = None
+    generation_time_sec = None
+    input_tok_per_sec = None
+    output_tok_per_sec = None
+    total_latency_ms = None
+    time_to_first_token_ms = None
+
+    # Calculate metrics based on available timestamps
+    if metrics.arrival_time is not None:
+        if (
+            metrics.first_scheduled_time is not None
+            and metrics.first_token_time is not None
+        ):
+            prompt_processing_time_sec = (
+                metrics.first_token_time - metrics.first_scheduled_time
             )
 
-        # Initialize metrics to None
-        prompt_processing_time_sec = None
-        generation_time_sec = None
-        input_tok_per_sec = None
-        output_tok_per_sec = None
-        total_latency_ms = None
-        time_to_first_token_ms = None
-
-        # Calculate metrics based on available timestamps
-        if metrics.arrival_time is not None:
-            if (
-                metrics.first_scheduled_time is not None
-                and metrics.first_token_time is not None
-            ):
-                prompt_processing_time_sec = (
-                    metrics.first_token_time - metrics.first_scheduled_time
-                )
-
-            if metrics.first_token_time is not None:
-                time_to_first_token_ms = (
-                    metrics.first_token_time - metrics.arrival_time
-                ) * 1000
-
-            if metrics.finished_time is not None:
-                total_latency_ms = (metrics.finished_time - metrics.arrival_time) * 1000
-
-        if metrics.first_token_time is not None and metrics.last_token_time is not None:
-            generation_time_sec = metrics.last_token_time - metrics.first_token_time
-
-        # Calculate input tokens per second
-        if num_prompt_tokens > 0:
-            if (
-                prompt_processing_time_sec is not None
-                and prompt_processing_time_sec > 0
-            ):
-                input_tok_per_sec = num_prompt_tokens / prompt_processing_time_sec
-            elif prompt_processing_time_sec == 0:  # Effectively infinite if tokens > 0
-                input_tok_per_sec = float("inf")
-        elif num_prompt_tokens == 0:
-            input_tok_per_sec = 0.0
-
-        # Calculate output tokens per second
-        if num_generated_tokens > 0:
-            if generation_time_sec is not None and generation_time_sec > 0:
-                output_tok_per_sec = num_generated_tokens / generation_time_sec
-            elif generation_time_sec == 0:  # Effectively infinite if tokens > 0
-                output_tok_per_sec = float("inf")
-        elif num_generated_tokens == 0:  # No generated tokens
-            output_tok_per_sec = 0.0
-
-        metrics_to_log = {
-            "request_id": vllm_request_output.request_id,
-            "num_prompt_tokens": num_prompt_tokens,
-            "num_generated_tokens": num_generated_tokens,
+        if metrics.first_token_time is not None:
+            time_to_first_token_ms = (
+                metrics.first_token_time - metrics.arrival_time
+            ) * 1000
+
+        if metrics.finished_time is not None:
+            total_latency_ms = (metrics.finished_time - metrics.arrival_time) * 1000
+
+    if metrics.first_token_time is not None and metrics.last_token_time is not None:
+        generation_time_sec = metrics.last_token_time - metrics.first_token_time
+
+    # Calculate input tokens per second
+    if num_prompt_tokens > 0:
+        if prompt_processing_time_sec is not None and prompt_processing_time_sec > 0:
+            input_tok_per_sec = num_prompt_tokens / prompt_processing_time_sec
+        elif prompt_processing_time_sec == 0:  # Effectively infinite if tokens > 0
+            input_tok_per_sec = float("inf")
+    elif num_prompt_tokens == 0:
+        input_tok_per_sec = 0.0
+
+    # Calculate output tokens per second
+    if num_generated_tokens > 0:
+        if generation_time_sec is not None and generation_time_sec > 0:
+            output_tok_per_sec = num_generated_tokens / generation_time_sec
+        elif generation_time_sec == 0:  # Effectively infinite if tokens > 0
+            output_tok_per_sec = float("inf")
+    elif num_generated_tokens == 0:  # No generated tokens
+        output_tok_per_sec = 0.0
+
+    metrics_to_log.update(
+        {
             "time_in_queue_sec": metrics.time_in_queue,  # Directly available
             "prompt_processing_time_sec": prompt_processing_time_sec,
             "time_to_first_token_ms": time_to_first_token_ms,
@@ -218,46 +325,29 @@ def log_vllm_request_output_metrics(
             "input_tok_per_sec": input_tok_per_sec,
             "output_tok_per_sec": output_tok_per_sec,
         }
+    )
 
-        # Add other simple metrics if they exist and are useful, e.g., scheduler_time
-        if hasattr(metrics, "scheduler_time") and isinstance(
-            metrics.scheduler_time, (int, float)
-        ):
-            metrics_to_log["vllm_scheduler_time_sec"] = metrics.scheduler_time
+    # Add other simple metrics if they exist and are useful, e.g., scheduler_time
+    if hasattr(metrics, "scheduler_time") and isinstance(
+        metrics.scheduler_time, (int, float)
+    ):
+        metrics_to_log["vllm_scheduler_time_sec"] = metrics.scheduler_time
 
-        # Filter out None values before logging
-        metrics_to_log_filtered = {
-            k: v for k, v in metrics_to_log.items() if v is not None
-        }
+    # Filter out None values before logging
+    return {k: v for k, v in metrics_to_log.items() if v is not None}
 
-        if metrics_to_log_filtered:
-            log_metrics(metrics_to_log_filtered)
-        else:
-            logger.info(
-                "No valid metrics to log for request_id: %s",
-                vllm_request_output.request_id,
-            )
 
-    else:
-        # This warning now specifically refers to vLLM's internal detailed metrics
-        logger.warning(
-            "No internal detailed metrics (vllm_request_output.metrics) found in vLLM RequestOutput for request_id: %s. Manual metrics may still be logged.",
-            vllm_request_output.request_id,
-        )
-
-    # Filter out ALL None values from the combined metrics_to_log before logging
-    metrics_to_log_filtered = {k: v for k, v in metrics_to_log.items() if v is not None}
+def log_vllm_request_output_metrics(
+    vllm_request_output: "RequestOutput | Any",
+    manual_duration_sec: float = None,
+):
+    """Extracts metrics from vLLM's RequestOutput and queues exactly one W&B record."""
+    if not vllm_request_output:
+        logger.warning("log_vllm_request_output_metrics called with None input.")
+        return
 
-    if metrics_to_log_filtered:
-        # Ensure request_id is always present if it somehow became None (it shouldn't from RequestOutput)
-        if "request_id" not in metrics_to_log_filtered and hasattr(
-            vllm_request_output, "request_id"
-        ):
-            metrics_to_log_filtered["request_id"] = vllm_request_output.request_id
-        log_metrics(metrics_to_log_filtered)
-    else:
-        # This case should be rare now, as we always have token counts and request_id
-        logger.info(
-            "No valid metrics to log after filtering for request_id: %s",
-            vllm_request_output.request_id,
+    log_metrics(
+        extract_vllm_request_output_metrics(
+            vllm_request_output, manual_duration_sec=manual_duration_sec
         )
+    )
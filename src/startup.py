@@ -0,0 +1,55 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+_PROCESS_START = time.perf_counter()
+
+
+class StartupReport:
+    """Records how long each import and initialization phase of the app takes"""
+
+    def __init__(self):
+        self._phases: List[Dict] = []
+        self._lock = threading.Lock()
+        self.ready_after_sec: float | None = None
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            with self._lock:
+                self._phases.append(
+                    {
+                        "phase": name,
+                        "started_at_sec": start - _PROCESS_START,
+                        "duration_sec": duration,
+                        "error": error,
+                    }
+                )
+            logger.info("Startup phase %s took %.3fs", name, duration)
+
+    def mark_ready(self):
+        """Record when the app started accepting requests"""
+
+        self.ready_after_sec = time.perf_counter() - _PROCESS_START
+        logger.info("Application ready after %.3fs", self.ready_after_sec)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            phases = list(self._phases)
+
+        return {"ready_after_sec": self.ready_after_sec, "phases": phases}
+
+
+startup_report = StartupReport()
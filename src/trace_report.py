@@ -0,0 +1,142 @@
+"""
+Per-stage latency report over exported trace spans.
+
+    python -m src.trace_report                  # every span file in TRACE_DIR
+    python -m src.trace_report spans-123.jsonl  # given files
+    python -m src.trace_report --trace <trace_id>
+
+For every span name it prints the count, mean, p50, p95, p99 and max duration and
+the share of the total time of root spans (the turns) it accounts for. Nested stages
+are included in their parents, so the shares do not add up to 100%.
+With --trace it prints the span tree of one trace instead.
+"""
+
+import argparse
+import statistics
+import sys
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List
+from src.config import config
+from src.services import json_codec
+
+
+def span_files(paths: List[str]) -> List[Path]:
+    if paths:
+        return [Path(path) for path in paths]
+    return sorted(Path(config.TRACE_DIR).glob("spans-*.jsonl*"))
+
+
+def read_spans(files: List[Path]) -> List[dict]:
+    spans = []
+    for path in files:
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    spans.append(json_codec.loads(line))
+                except ValueError:
+                    # A line cut short by a crash
+                    continue
+
+    return spans
+
+
+def stage_report(spans: List[dict]) -> List[dict]:
+    durations: Dict[str, List[float]] = defaultdict(list)
+    root_ms = 0.0
+    for span in spans:
+        durations[span["name"]].append(span["duration_ms"])
+        if span["parent_id"] is None:
+            root_ms += span["duration_ms"]
+
+    rows = []
+    for name, values in durations.items():
+        # quantiles needs two points, a single span is every percentile
+        quantiles = (
+            statistics.quantiles(values, n=100, method="inclusive")
+            if len(values) > 1
+            else values * 99
+        )
+        total = sum(values)
+        rows.append(
+            {
+                "name": name,
+                "count": len(values),
+                "mean_ms": total / len(values),
+                "p50_ms": quantiles[49],
+                "p95_ms": quantiles[94],
+                "p99_ms": quantiles[98],
+                "max_ms": max(values),
+                "share": total / root_ms if root_ms else None,
+            }
+        )
+
+    return sorted(rows, key=lambda row: row["mean_ms"] * row["count"], reverse=True)
+
+
+def print_report(rows: List[dict], traces: int):
+    print(f"{traces} traces")
+    header = ("stage", "count", "mean", "p50", "p95", "p99", "max", "share")
+    print(f"{header[0]:<28}" + "".join(f"{column:>10}" for column in header[1:]))
+    for row in rows:
+        share = f"{row['share']:.1%}" if row["share"] is not None else "-"
+        print(
+            f"{row['name']:<28}{row['count']:>10}"
+            + "".join(
+                f"{row[key]:>10.1f}" for key in ("mean_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms")
+            )
+            + f"{share:>10}"
+        )
+
+
+def print_trace(spans: List[dict], trace_id: str):
+    spans = [span for span in spans if span["trace_id"] == trace_id]
+    if not spans:
+        print(f"No spans of trace {trace_id}", file=sys.stderr)
+        sys.exit(1)
+
+    children: Dict[str | None, List[dict]] = defaultdict(list)
+    span_ids = {span["span_id"] for span in spans}
+    for span in spans:
+        # Spans whose parent was not exported are shown at the top
+        parent = span["parent_id"] if span["parent_id"] in span_ids else None
+        children[parent].append(span)
+
+    start = min(span["start"] for span in spans)
+
+    def show(parent: str | None, depth: int):
+        for span in sorted(children[parent], key=lambda span: span["start"]):
+            offset_ms = (span["start"] - start) * 1000
+            attributes = " ".join(f"{key}={value}" for key, value in span["attributes"].items())
+            error = f" error={span['error']}" if span["error"] else ""
+            print(
+                f"{offset_ms:>9.1f} {span['duration_ms']:>9.1f} ms  "
+                f"{'  ' * depth}{span['name']} {attributes}{error}".rstrip()
+            )
+            show(span["span_id"], depth + 1)
+
+    print(f"{'offset':>9} {'duration':>12}  span")
+    show(None, 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("paths", nargs="*", help=f"span files, default {config.TRACE_DIR}")
+    parser.add_argument("--trace", help="print the span tree of this trace ID")
+    args = parser.parse_args()
+
+    spans = read_spans(span_files(args.paths))
+    if args.trace:
+        print_trace(spans, args.trace)
+        return
+
+    if not spans:
+        print("No spans found, is TRACE_SAMPLE_RATE set?", file=sys.stderr)
+        sys.exit(1)
+
+    traces = len({span["trace_id"] for span in spans})
+    print_report(stage_report(spans), traces)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+"""
+EngineRegistry with the fake engine: loading within the memory budget, eviction and pinning.
+
+    python -m pytest tests
+"""
+
+import asyncio
+import threading
+import time
+import pytest
+from src.config import config
+from src.services import vllm_service
+from src.services.inference_executor import BatchingExecutor
+from src.services.vllm_service import (
+    ENGINE_EVICT_SECONDS,
+    ENGINE_LOAD_FAILURES,
+    ENGINE_LOAD_SECONDS,
+    ENGINE_LOADED,
+    EngineCapacityError,
+    EngineFactory,
+    EngineRegistry,
+)
+from src.services.fake_engine import FakeLLM
+
+
+@pytest.fixture(autouse=True)
+def fake_engine(monkeypatch):
+    monkeypatch.setattr(config, "SM_ENGINE", "fake")
+    monkeypatch.setattr(config, "SM_ENABLED", True)
+    monkeypatch.setattr(config, "STREAMING", False)
+    monkeypatch.setattr(config, "FAKE_ENGINE_PREFILL_MS", 0.0)
+    monkeypatch.setattr(config, "FAKE_ENGINE_TOKENS_PER_SEC", 0.0)
+
+
+@pytest.fixture
+def slow_build(monkeypatch):
+    """Engines take a while to load and count their builds, per model"""
+
+    builds = {}
+    build = EngineFactory._build  # pylint: disable=protected-access
+
+    def counted_build(self):
+        builds[self.model] = builds.get(self.model, 0) + 1
+        time.sleep(0.1)
+        return build(self)
+
+    monkeypatch.setattr(EngineFactory, "_build", counted_build)
+    return builds
+
+
+def registry(models, budget_gb=20.0, swap_timeout_sec=0.0, **memory_gb):
+    return EngineRegistry(
+        models,
+        memory_gb=memory_gb,
+        default_memory_gb=8.0,
+        budget_gb=budget_gb,
+        swap_timeout_sec=swap_timeout_sec,
+    )
+
+
+def load(engines: EngineRegistry, model: str):
+    with engines.pinned(model):
+        pass
+
+
+def resident(engines: EngineRegistry):
+    return [
+        model
+        for model, engine in engines.stats()["engines"].items()
+        if engine["status"] == EngineFactory.READY
+    ]
+
+
+def test_loads_the_fake_engine():
+    engines = registry(["test-fake-a"])
+
+    with engines.pinned("test-fake-a") as factory:
+        assert isinstance(factory.get(), FakeLLM)
+        params = factory.sampling_params_for({"max_tokens": 1, "top_p": 0.5})
+        assert (params.temperature, params.top_p, params.max_tokens) == (
+            config.SM_TEMPERATURE,
+            0.5,
+            1,
+        )
+        assert factory.sampling_params.max_tokens == config.SM_MAX_TOKENS
+
+
+def test_evicts_least_recently_used_over_budget():
+    engines = registry(["test-lru-a", "test-lru-b", "test-lru-c"], budget_gb=20.0)
+
+    load(engines, "test-lru-a")
+    load(engines, "test-lru-b")
+    assert resident(engines) == ["test-lru-a", "test-lru-b"]
+
+    # a is used again, b is now the least recently used
+    load(engines, "test-lru-a")
+    load(engines, "test-lru-c")
+
+    assert resident(engines) == ["test-lru-a", "test-lru-c"]
+    assert engines.factory("test-lru-b").status == EngineFactory.EVICTED
+    assert engines.stats()["reserved_gb"] == 16.0
+
+
+def test_budget_counts_declared_memory():
+    engines = registry(
+        ["test-mem-a", "test-mem-b", "test-mem-c"], budget_gb=20.0, **{"test-mem-c": 4.0}
+    )
+
+    load(engines, "test-mem-a")
+    load(engines, "test-mem-b")
+    load(engines, "test-mem-c")
+
+    assert resident(engines) == ["test-mem-a", "test-mem-b", "test-mem-c"]
+    assert engines.stats()["reserved_gb"] == 20.0
+
+
+def test_zero_budget_keeps_a_single_engine():
+    engines = registry(["test-single-a", "test-single-b"], budget_gb=0.0)
+
+    load(engines, "test-single-a")
+    load(engines, "test-single-b")
+
+    assert resident(engines) == ["test-single-b"]
+
+
+def test_concurrent_use_loads_once(slow_build):
+    engines = registry(["test-once-a"])
+
+    async def use():
+        async with engines.use("test-once-a") as factory:
+            return factory.get()
+
+    async def main():
+        return await asyncio.gather(use(), use(), use())
+
+    first, second, third = asyncio.run(main())
+
+    assert first is second is third
+    assert slow_build == {"test-once-a": 1}
+
+
+def test_concurrent_pinned_loads_once(slow_build):
+    engines = registry(["test-once-b"])
+    threads = [
+        threading.Thread(target=load, args=(engines, "test-once-b")) for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert slow_build == {"test-once-b": 1}
+
+
+def test_pinned_engine_is_not_evicted():
+    engines = registry(["test-pin-a", "test-pin-b"], budget_gb=0.0)
+
+    with engines.pinned("test-pin-a"):
+        with pytest.raises(EngineCapacityError):
+            load(engines, "test-pin-b")
+        assert engines.factory("test-pin-a").is_ready
+        assert engines.stats()["engines"]["test-pin-a"]["in_use"] == 1
+
+    # Once released it can be evicted
+    load(engines, "test-pin-b")
+    assert resident(engines) == ["test-pin-b"]
+
+
+def test_engine_in_use_is_not_evicted():
+    engines = registry(["test-use-a", "test-use-b", "test-use-c"], budget_gb=16.0)
+
+    async def main():
+        async with engines.use("test-use-a"):
+            async with engines.use("test-use-b"):
+                with pytest.raises(EngineCapacityError):
+                    async with engines.use("test-use-c"):
+                        pass
+                assert resident(engines) == ["test-use-a", "test-use-b"]
+
+    asyncio.run(main())
+
+
+def test_waits_for_an_engine_in_use():
+    engines = registry(["test-wait-a", "test-wait-b"], budget_gb=0.0, swap_timeout_sec=5.0)
+
+    async def hold_a(loaded: asyncio.Event):
+        async with engines.use("test-wait-a"):
+            loaded.set()
+            await asyncio.sleep(0.2)
+
+    async def main():
+        loaded = asyncio.Event()
+        holder = asyncio.create_task(hold_a(loaded))
+        await loaded.wait()
+        async with engines.use("test-wait-b"):
+            assert holder.done()
+            assert resident(engines) == ["test-wait-b"]
+
+    asyncio.run(main())
+
+
+def test_capacity_error_without_any_evictable_engine():
+    engines = registry(["test-cap-a", "test-cap-b"], budget_gb=8.0, **{"test-cap-b": 12.0})
+
+    with engines.pinned("test-cap-a"):
+        with pytest.raises(EngineCapacityError):
+            load(engines, "test-cap-b")
+
+    assert engines.stats()["engines"]["test-cap-b"]["status"] == EngineFactory.NOT_LOADED
+
+
+def test_failed_load_releases_its_reservation(monkeypatch):
+    engines = registry(["test-fail-a"])
+    build = EngineFactory._build  # pylint: disable=protected-access
+
+    def failing_build(self):
+        raise RuntimeError("out of memory")
+
+    monkeypatch.setattr(EngineFactory, "_build", failing_build)
+    with pytest.raises(RuntimeError):
+        load(engines, "test-fail-a")
+
+    stats = engines.stats()
+    assert stats["reserved_gb"] == 0
+    assert stats["engines"]["test-fail-a"]["status"] == EngineFactory.FAILED
+    assert ENGINE_LOAD_FAILURES.value(model="test-fail-a") == 1
+
+    monkeypatch.setattr(EngineFactory, "_build", build)
+    load(engines, "test-fail-a")
+    assert engines.factory("test-fail-a").is_ready
+
+
+def test_load_and_evict_metrics_and_stats():
+    engines = registry(["test-metrics-a", "test-metrics-b"], budget_gb=0.0)
+
+    load(engines, "test-metrics-a")
+    assert ENGINE_LOADED.value(model="test-metrics-a") == 1
+    load(engines, "test-metrics-b")
+    load(engines, "test-metrics-a")
+
+    assert ENGINE_LOAD_SECONDS.count(model="test-metrics-a") == 2
+    assert ENGINE_LOAD_SECONDS.count(model="test-metrics-b") == 1
+    assert ENGINE_EVICT_SECONDS.count(model="test-metrics-a") == 1
+    assert ENGINE_EVICT_SECONDS.count(model="test-metrics-b") == 1
+    assert ENGINE_LOADED.value(model="test-metrics-a") == 1
+    assert ENGINE_LOADED.value(model="test-metrics-b") == 0
+
+    with engines.pinned("test-metrics-a"):
+        assert engines.stats() == {
+            "budget_gb": 0.0,
+            "reserved_gb": 8.0,
+            "engines": {
+                "test-metrics-a": {
+                    "status": EngineFactory.READY,
+                    "memory_gb": 8.0,
+                    "in_use": 1,
+                },
+                "test-metrics-b": {
+                    "status": EngineFactory.EVICTED,
+                    "memory_gb": 8.0,
+                    "in_use": 0,
+                },
+            },
+        }
+
+
+def test_failing_model_fails_only_its_batch_items(monkeypatch):
+    engines = registry(["test-batch-a", "test-batch-b"])
+    monkeypatch.setattr(vllm_service, "engine_registry", engines)
+    build = EngineFactory._build  # pylint: disable=protected-access
+
+    def build_all_but_b(self):
+        if self.model == "test-batch-b":
+            raise RuntimeError("weights not found")
+        return build(self)
+
+    monkeypatch.setattr(EngineFactory, "_build", build_all_but_b)
+    messages = [{"role": "user", "content": "Hi"}]
+
+    async def main():
+        executor = BatchingExecutor(
+            vllm_service.VLLMService().generate_batches, window_ms=50, name="test-batch"
+        )
+        try:
+            return await asyncio.gather(
+                executor.submit(("test-batch-a", messages, None)),
+                executor.submit(("test-batch-b", messages, None)),
+                executor.submit(("test-batch-a", messages, None)),
+                return_exceptions=True,
+            )
+        finally:
+            await executor.aclose()
+
+    first, failed, second = asyncio.run(main())
+
+    assert first.outputs and second.outputs
+    assert isinstance(failed, Exception)
+    assert "weights not found" in str(failed)